@@ -11,6 +11,7 @@ sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '/..'))
 #from collections import namedtuple
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 
+from ete4 import Tree
 from treeprofiler import tree_annotate
 from treeprofiler.src import utils
 import time
@@ -87,7 +88,7 @@ class TestAnalytic(unittest.TestCase):
                 utils.add_suffix(prop, "delta"): float
             })
             
-        dump_tree = test_tree_annotated.copy()
+        dump_tree = utils.topology_clone(test_tree_annotated)
         utils.clear_extra_features([test_tree_annotated], prop2type.keys())
 
         prop2array = {}
@@ -138,11 +139,74 @@ class TestAnalytic(unittest.TestCase):
         acr_results, test_tree_annotated = tree_annotate.run_acr_discrete(test_tree_annotated, acr_discrete_columns_dict, \
         prediction_method=prediction_method, threads=4, outdir="./")
     
-        dump_tree = test_tree_annotated.copy()
+        dump_tree = utils.topology_clone(test_tree_annotated)
         utils.clear_extra_features([test_tree_annotated], prop2type.keys())
         expected_tree_with_root = '(A:1[&&NHX:alphabet_type=vowel],(B:1[&&NHX:alphabet_type=vowel],(E:1[&&NHX:alphabet_type=consonant],D:1[&&NHX:alphabet_type=consonant])Internal_1:0.5[&&NHX:alphabet_type=consonant:alphabet_type_counter=consonant--2])Internal_2:0.5[&&NHX:alphabet_type=vowel:alphabet_type_counter=consonant--2||vowel--1])Root[&&NHX:alphabet_type=vowel:alphabet_type_counter=consonant--2||vowel--2];'
         self.assertEqual(test_tree_annotated.write(props=None, parser=parser, format_root_node=True), expected_tree_with_root)
 
+    def test_acr_discrete_04(self):
+        # traits reconstructed in parallel processes give the same result as serially
+        from treeprofiler.src import phylosignal
+        results = []
+        for threads in [1, 2]:
+            test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser="name")
+            columns = {'alphabet_type': ['vowel', 'vowel', 'consonant', 'consonant'], 'shape': ['round', 'flat', 'round', 'flat']}
+            for name, alphabet_type, shape in zip('ABED', columns['alphabet_type'], columns['shape']):
+                test_tree[name].add_prop('alphabet_type', alphabet_type)
+                test_tree[name].add_prop('shape', shape)
+            acr_results, test_tree = phylosignal.run_acr_discrete(test_tree, columns, threads=threads, outdir=None)
+            utils.clear_extra_features([test_tree], ['alphabet_type', 'shape'])
+            results.append((
+                {prop: acr_result[0]['log_likelihood'] for prop, acr_result in acr_results.items()},
+                [(node.name, sorted(node.props)) for node in test_tree.traverse()],
+                acr_results['shape'][0]['marginal_probabilities'].round(6).to_dict()))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(phylosignal.get_acr_threads(8, 2), (2, 4))
+        self.assertEqual(phylosignal.get_acr_threads(4, 50), (4, 1))
+
+    def test_acr_discrete_05(self):
+        # batched engine gives the same reconstruction as pastml
+        from treeprofiler.src import phylosignal
+        newick = "(((A:0.1,B:0.2)N1:0.3,(C:0.1,D:0.1)N2:0.2)N3:0.4,((E:0.2,F:0.1)N4:0.5,(G:0.3,H:0)N5:0.1)N6:0.2)Root;"
+        columns = {
+            'habitat': ['sea', 'sea', 'sea', 'land', 'land', 'land', 'land', 'land'],
+            'color': ['red', 'red', 'blue', 'blue', 'green', 'green', 'green', 'red']
+        }
+        for prediction_method, model, pastml_model in [('MPPA', 'F81', 'EFT'), ('MAP', 'JC', 'JC')]:
+            results = []
+            for method, acr_model in [(prediction_method, pastml_model), ('BATCH_' + prediction_method, model)]:
+                test_tree = utils.ete4_parse(newick, internal_parser="name")
+                for prop, values in columns.items():
+                    for name, value in zip('ABCDEFGH', values):
+                        test_tree[name].add_prop(prop, value)
+                acr_results, test_tree = phylosignal.run_acr_discrete(test_tree, columns,
+                    prediction_method=method, model=acr_model, threads=1, outdir=None)
+                utils.clear_extra_features([test_tree], list(columns))
+                results.append((acr_results, {node.name: node.props.get(prop) for node in test_tree.traverse() for prop in columns}))
+
+            (pastml_results, pastml_states), (batch_results, batch_states) = results
+            self.assertEqual(pastml_states, batch_states)
+            for prop in columns:
+                self.assertAlmostEqual(pastml_results[prop][0]['log_likelihood'], batch_results[prop][0]['log_likelihood'], places=4)
+                pastml_probs = pastml_results[prop][0]['marginal_probabilities']
+                batch_probs = batch_results[prop][0]['marginal_probabilities'].loc[pastml_probs.index]
+                self.assertTrue(np.allclose(pastml_probs.values, batch_probs.values, atol=1e-4))
+
+    def test_acr_discrete_06(self):
+        # node names of the tree are kept, marginal probabilities are in preorder
+        from treeprofiler.src import phylosignal
+        leaf2state = {'A': 'x', 'B': 'x', 'C': 'y', 'D': 'y'}
+        for prediction_method, threads in [('MPPA', 1), ('MPPA', 2), ('BATCH_MPPA', 1)]:
+            test_tree = utils.ete4_parse("((A:1,B:1):1,(C:1,D:1)X:1)MyRoot;", internal_parser="name")
+            for name, state in leaf2state.items():
+                test_tree[name].add_prop('letter', state)
+            acr_results, test_tree = phylosignal.run_acr_discrete(test_tree, {'letter': list(leaf2state.values())},
+                prediction_method=prediction_method, threads=threads, outdir=None)
+            self.assertEqual([node.name for node in test_tree.traverse('preorder')],
+                ['MyRoot', None, 'A', 'B', 'X', 'C', 'D'])
+            self.assertEqual(test_tree['X'].props['letter'], {'y'})
+            self.assertEqual(len(acr_results['letter'][0]['marginal_probabilities']), 7)
+
     def test_acr_continuous_01(self):
         # test acr continuous with default
         # load tree
@@ -272,6 +336,120 @@ class TestAnalytic(unittest.TestCase):
         self.assertTrue(-3 <= float(test_tree_annotated['Internal_2'].props.get('length')) <= 3)
         self.assertTrue(-2 <= float(test_tree_annotated['Internal_1'].props.get('length')) <= 2)
 
+    def test_acr_continuous_04(self):
+        # test ML acr continuous against the dense variance-covariance solution
+        from treeprofiler.src.acr_continuous import ml_acr
+        newick = "(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;"
+        observed_traits = {'A': 1.0, 'B': 0.6, 'E': 0.3, 'D': 0.1}
+        y = np.array([1.0, 0.6, 0.3, 0.1])
+        ones = np.ones(4)
+
+        # BM, shared path lengths from the root among leaves and internal nodes
+        test_tree = utils.ete4_parse(newick, internal_parser="name")
+        test_tree, results = ml_acr(test_tree, 'length', observed_traits, model='BM')
+        V = np.array([[1, 0, 0, 0], [0, 1.5, .5, .5], [0, .5, 2, 1], [0, .5, 1, 2]])
+        C = np.array([[0, .5, .5, .5], [0, .5, 1, 1]])
+        V_inv = np.linalg.inv(V)
+        root = (ones @ V_inv @ y) / (ones @ V_inv @ ones)
+        expected = root + C @ V_inv @ (y - root)
+        self.assertAlmostEqual(test_tree.props.get('length'), root)
+        self.assertAlmostEqual(test_tree['Internal_2'].props.get('length'), expected[0])
+        self.assertAlmostEqual(test_tree['Internal_1'].props.get('length'), expected[1])
+        self.assertAlmostEqual(results['sigma2'], (y - root) @ V_inv @ (y - root) / 4)
+        lower, upper = results['root']['confidence_interval']
+        self.assertAlmostEqual((upper - lower) / 2, 1.959964 * np.sqrt(results['sigma2'] / (ones @ V_inv @ ones)), places=5)
+        self.assertEqual(test_tree.props.get('length_ci_lower'), lower)
+
+        # OU with fixed parameters and stationary root, path lengths among leaves and nodes
+        alpha, theta = 0.5, 0.5
+        test_tree = utils.ete4_parse(newick, internal_parser="name")
+        test_tree, results = ml_acr(test_tree, 'length', observed_traits, model='OU', sigma=1.0, alpha=alpha, theta=theta)
+        D = np.array([[0, 2.5, 3, 3], [2.5, 0, 2.5, 2.5], [3, 2.5, 0, 2], [3, 2.5, 2, 0]])
+        C = np.array([[1, 1.5, 2, 2], [1.5, 1, 1.5, 1.5], [2, 1.5, 1, 1]])
+        K_inv = np.linalg.inv(np.exp(-alpha * D) / (2 * alpha))
+        expected = theta + np.exp(-alpha * C) / (2 * alpha) @ K_inv @ (y - theta)
+        for name, value in zip(['Root', 'Internal_2', 'Internal_1'], expected):
+            self.assertAlmostEqual(test_tree[name].props.get('length'), value)
+
+    def test_acr_continuous_05(self):
+        # test Bayesian acr continuous of several traits sampled in one model against ML
+        from treeprofiler.src.acr_continuous import by_acr_traits, ml_acr
+        newick = "((A:1,B:1)Internal_1:0.5,((C:1,D:0.5)Internal_2:0.5,(E:1,F:1)Internal_3:1)Internal_4:0.5)Root;"
+        prop2traits = {
+            'length': {'A': 1.0, 'B': 1.2, 'C': 3.0, 'D': 2.8, 'E': 5.0, 'F': 5.4},
+            'width': {'A': 10.0, 'B': 9.0, 'C': 8.0, 'D': 8.5, 'F': 6.0},
+        }
+        test_tree = utils.ete4_parse(newick, internal_parser="name")
+        test_tree, prop2results = by_acr_traits(test_tree, prop2traits, model='BM', draws=1000, tune=500, seed=42)
+        self.assertEqual(set(prop2results), {'length', 'width'})
+        for prop, observed_traits in prop2traits.items():
+            ml_tree, ml_results = ml_acr(utils.ete4_parse(newick, internal_parser="name"), prop, observed_traits)
+            # missing leaf E of width is predicted as an internal node
+            for name in ['Internal_1', 'Internal_2', 'Internal_3', 'Internal_4'] + (['E'] if prop == 'width' else []):
+                node = test_tree[name]
+                self.assertAlmostEqual(node.props.get(prop), ml_tree[name].props.get(prop), delta=0.5)
+                self.assertTrue(node.props.get(f'{prop}_ci_lower') < node.props.get(prop) < node.props.get(f'{prop}_ci_upper'))
+            self.assertEqual(test_tree['A'].props.get(prop), observed_traits['A'])
+
+    def test_acr_continuous_06(self):
+        # test ML acr continuous of several traits in the same passes against one trait at a time
+        from treeprofiler.src.acr_continuous import ml_acr_traits, ml_acr
+        newick = "((A:1,B:1)Internal_1:0.5,((C:1,D:0.5)Internal_2:0.5,(E:1,F:1)Internal_3:1)Internal_4:0.5)Root;"
+        prop2traits = {
+            'length': {'A': 1.0, 'B': 1.2, 'C': 3.0, 'D': 2.8, 'E': 5.0, 'F': 5.4},
+            'width': {'A': 10.0, 'B': 9.0, 'C': 8.0, 'D': 8.5, 'F': 6.0},
+            'depth': {'A': 0.1, 'B': 0.7, 'C': 0.2, 'D': 0.9, 'E': 0.4, 'F': 0.3},
+        }
+        for model in ['BM', 'OU']:
+            test_tree, prop2results = ml_acr_traits(utils.ete4_parse(newick, internal_parser="name"), prop2traits, model=model)
+            self.assertEqual(list(prop2results), list(prop2traits))
+            for prop, observed_traits in prop2traits.items():
+                single_tree, results = ml_acr(utils.ete4_parse(newick, internal_parser="name"), prop, observed_traits, model=model)
+                for key in ['sigma2', 'alpha', 'theta', 'log_likelihood']:
+                    self.assertAlmostEqual(prop2results[prop][key], results[key])
+                for name in ['Root', 'Internal_1', 'Internal_2', 'Internal_3', 'Internal_4', 'E']:
+                    for suffix in ['', '_ci_lower', '_ci_upper']:
+                        self.assertAlmostEqual(test_tree[name].props.get(prop + suffix), single_tree[name].props.get(prop + suffix))
+
+    def test_signal_01(self):
+        # test Pagel's lambda and Blomberg's K against the dense variance-covariance solution
+        from scipy.optimize import minimize_scalar
+        from treeprofiler.src.phylosignal import run_lambda, run_kappa
+        test_tree = utils.ete4_parse("((A:1,B:1)Internal_1:0.5,((C:1,D:0.5)Internal_2:0.5,(E:1,F:1)Internal_3:1)Internal_4:0.5)Root;", internal_parser="name")
+        prop2traits = {'length': {'A': 1.0, 'B': 1.4, 'C': 3.0, 'D': 2.2, 'E': 5.0, 'F': 5.9}}
+        y = np.array([1.0, 1.4, 3.0, 2.2, 5.0, 5.9])
+        C = np.array([
+            [1.5, .5, 0, 0, 0, 0], [.5, 1.5, 0, 0, 0, 0],
+            [0, 0, 2, 1, .5, .5], [0, 0, 1, 1.5, .5, .5],
+            [0, 0, .5, .5, 2.5, 1.5], [0, 0, .5, .5, 1.5, 2.5]])
+        ones = np.ones(6)
+
+        def profile(lam):
+            V = C * lam + np.diag(np.diag(C)) * (1 - lam)
+            V_inv = np.linalg.inv(V)
+            root = (ones @ V_inv @ y) / (ones @ V_inv @ ones)
+            quad = (y - root) @ V_inv @ (y - root)
+            return -0.5 * (6 * np.log(2 * np.pi * quad / 6) + np.linalg.slogdet(V)[1] + 6)
+        expected_lambda = minimize_scalar(lambda lam: -profile(lam), bounds=(0, 1), method='bounded').x
+
+        C_inv = np.linalg.inv(C)
+        root = (ones @ C_inv @ y) / (ones @ C_inv @ ones)
+        expected_k = ((y - root) @ (y - root)) / ((y - root) @ C_inv @ (y - root)) \
+            / ((np.trace(C) - 6 / (ones @ C_inv @ ones)) / 5)
+
+        prop2lambda = run_lambda(test_tree, prop2traits, permutations=50, threads=1, seed=1)
+        prop2k = run_kappa(test_tree, prop2traits, permutations=50, threads=1, seed=1)
+        self.assertAlmostEqual(prop2lambda['length']['lambda'], expected_lambda, places=3)
+        self.assertAlmostEqual(prop2k['length']['K'], expected_k)
+        self.assertTrue(0 < prop2k['length']['pval'] <= 1)
+
+        # permutations are reproducible whatever the number of threads, with small batches run in a pool
+        from unittest import mock
+        from treeprofiler.src import phylosignal
+        with mock.patch.object(phylosignal, 'SIGNAL_CELLS', 100):
+            self.assertEqual(run_kappa(test_tree, prop2traits, permutations=50, threads=1, seed=1),
+                run_kappa(test_tree, prop2traits, permutations=50, threads=2, seed=1))
+
     def test_ls_01(self):
         # test acr discrete with default
         # load tree
@@ -303,5 +481,166 @@ class TestAnalytic(unittest.TestCase):
         self.assertEqual(best_node.name, "Internal_16")
         
 
+    def test_emcmc_chains_01(self):
+        # chains run together keep the thinned samples of each chain apart
+        from treeprofiler.src import phylosignal
+        x = np.random.RandomState(0).uniform(0.05, 0.95, 50)
+        np.random.seed(1)
+        samples = phylosignal.emcmc_chains(1.0, 1.0, x, 0.1, 0.5, sim=1000, thin=10, burn=100, chains=3)
+        self.assertEqual(samples.shape, (3, 91, 2))
+        self.assertTrue(np.all(samples > 0))
+        self.assertFalse(np.array_equal(samples[0], samples[1]))
+
+        # same seed gives the same chain
+        np.random.seed(1)
+        single = phylosignal.emcmc((1.0, 1.0, x, 0.1, 0.5, 1000, 10, 100))
+        np.random.seed(1)
+        self.assertTrue(np.array_equal(single, phylosignal.emcmc((1.0, 1.0, x, 0.1, 0.5, 1000, 10, 100))))
+
+    def test_delta_01(self):
+        # strong phylogenetic signal (certain ancestors) gives a larger delta than none
+        from treeprofiler.src import phylosignal
+        certain = np.tile([[0.98, 0.01, 0.01], [0.01, 0.98, 0.01]], (20, 1))
+        uncertain = np.full((40, 3), 1 / 3) + np.random.RandomState(0).uniform(-0.01, 0.01, (40, 3))
+        uncertain = uncertain / uncertain.sum(axis=1, keepdims=True)
+        np.random.seed(42)
+        delta_certain = phylosignal.delta(certain, 0.1, 0.5, 2000, 10, 100, 'SE')
+        np.random.seed(42)
+        delta_uncertain = phylosignal.delta(uncertain, 0.1, 0.5, 2000, 10, 100, 'SE')
+        self.assertGreater(delta_certain, delta_uncertain)
+
+    def test_delta_02(self):
+        # several chains stop early once converged, diagnostics are reported
+        from treeprofiler.src import phylosignal
+        probs = np.random.RandomState(0).dirichlet([0.5, 0.5, 0.5], size=100)
+        np.random.seed(42)
+        full, full_diagnostics = phylosignal.delta(probs, 0.1, 0.5, 5000, 10, 100, 'SE', return_diagnostics=True)
+        self.assertEqual(full_diagnostics['iterations'], 5001)
+        np.random.seed(42)
+        early, diagnostics = phylosignal.delta(probs, 0.1, 0.5, 5000, 10, 100, 'SE', chains=4, 
+                                               target_ess=200, return_diagnostics=True)
+        self.assertLess(diagnostics['iterations'], 5001)
+        self.assertLess(diagnostics['rhat'], 1.01)
+        self.assertGreaterEqual(diagnostics['ess'], 200)
+        self.assertAlmostEqual(early, full, delta=0.05 * full)
+
+    def test_delta_05(self):
+        # each chain has its own generator, delta and diagnostics do not depend on threads
+        from treeprofiler.src import phylosignal
+        probs = np.random.RandomState(0).dirichlet([0.5, 0.5, 0.5], size=100)
+        thread2delta = {}
+        for threads in [1, 2]:
+            np.random.seed(42)
+            thread2delta[threads] = phylosignal.delta(probs, 0.1, 0.5, 2000, 10, 100, 'SE', threads=threads, 
+                chains=3, target_ess=100, check_every=200, return_diagnostics=True)
+        self.assertEqual(thread2delta[1], thread2delta[2])
+
+    def test_delta_03(self):
+        # delta of each clade on its slice of the marginal probabilities, independent of threads
+        import pandas as pd
+        from treeprofiler.src import phylosignal
+        tree = Tree()
+        tree.populate(40, dist_fn=lambda: 0.5)
+        for i, node in enumerate(tree.traverse()):
+            node.name = f'n{i}'
+        # rows in preorder, as run_acr_discrete returns them
+        names = [node.name for node in tree.traverse('preorder')]
+        marginals = pd.DataFrame(np.random.RandomState(0).dirichlet([0.5, 0.5, 0.5], size=len(names)), index=names)
+        acr_results = {'trait': [{'marginal_probabilities': marginals}]}
+
+        nodes, ends, sizes = phylosignal.clade_slices(tree)
+        for i, node in enumerate(nodes):
+            internal = [n.name for n in node.traverse('preorder') if not n.is_leaf]
+            self.assertEqual([n.name for n in nodes[i:ends[i]]], internal)
+            self.assertEqual(sizes[i], len(list(node.leaves())))
+
+        prop2delta, prop2diagnostics = phylosignal.run_delta(acr_results, tree, run_whole_tree=True, sim=500, 
+            min_clade_size=5, return_diagnostics=True)
+        self.assertEqual(prop2delta['trait'], tree.props['trait_delta'])
+        self.assertEqual(prop2diagnostics['trait']['iterations'], 501)
+        node2delta = {node.name: node.props.get('trait_delta') for node in nodes}
+        for node in nodes:
+            if len(list(node.leaves())) < 5 and not node.is_root:
+                self.assertIsNone(node2delta[node.name])
+                continue
+            np.random.seed(42)
+            internal = [n.name for n in node.traverse('preorder') if not n.is_leaf]
+            expected = phylosignal.delta(marginals.loc[internal].to_numpy(), 0.1, 0.5, 500, 10, 100, 'LSE')
+            self.assertAlmostEqual(node2delta[node.name], expected)
+
+        for node in nodes:
+            node.del_prop('trait_delta')
+        phylosignal.run_delta(acr_results, tree, run_whole_tree=True, sim=500, min_clade_size=5, threads=3)
+        self.assertEqual({node.name: node.props.get('trait_delta') for node in nodes}, node2delta)
+
+    def test_delta_04(self):
+        # permutations with the model parameters of the observed trait, for pastml and the batched engine
+        from treeprofiler.src.acr_discrete import TreeArrays, fixed_marginals, model_parameters
+        newick = "((A:1,B:1)Internal_1:0.5,((C:1,D:0.5)Internal_2:0.5,(E:1,F:1)Internal_3:1)Internal_4:0.5)Root;"
+        leaf2state = {'A': 'x', 'B': 'x', 'C': 'y', 'D': 'y', 'E': 'z', 'F': 'y'}
+        trait = list(leaf2state.values())
+        for prediction_method in ['MPPA', 'BATCH_MPPA']:
+            test_tree = utils.ete4_parse(newick, internal_parser="name")
+            for name, state in leaf2state.items():
+                test_tree[name].add_prop('letter', state)
+            acr_results, test_tree = tree_annotate.run_acr_discrete(test_tree, {'letter': trait}, 
+                prediction_method=prediction_method, model='F81', outdir=None)
+            prop2params = {prop: model_parameters(acr_result[0]) for prop, acr_result in acr_results.items()}
+
+            # the observed trait gets back its marginal probabilities
+            dump_tree = utils.topology_clone(test_tree)
+            for name, state in leaf2state.items():
+                dump_tree[name].add_prop('letter', state)
+            arrays = TreeArrays(dump_tree)
+            expected = acr_results['letter'][0]['marginal_probabilities'].loc[[node.name for node in arrays.nodes]]
+            self.assertTrue(np.allclose(fixed_marginals(arrays, prop2params)['letter'], expected.to_numpy()))
+            # fixed parameters do not need the pastml tree statistics
+            self.assertIsNone(arrays._stats)
+
+            prop2array = {'letter': [list(leaf2state), trait]}
+            prop2delta_array = tree_annotate.get_pval(prop2array, utils.topology_clone(test_tree), {'letter': trait}, 
+                iteration=5, prediction_method=prediction_method, sim=200, prop2params=prop2params)
+            self.assertEqual(len(prop2delta_array['letter']), 5)
+            self.assertTrue(np.all(np.isfinite(prop2delta_array['letter'])))
+
+    def test_pval_01(self):
+        # sequential permutations stop on the seeded sequence, whatever the threads
+        newick = "((A:1,B:1)Internal_1:0.5,((C:1,D:0.5)Internal_2:0.5,(E:1,F:1)Internal_3:1)Internal_4:0.5)Root;"
+        leaf2state = {'A': 'x', 'B': 'x', 'C': 'y', 'D': 'y', 'E': 'z', 'F': 'y'}
+        trait = list(leaf2state.values())
+        test_tree = utils.ete4_parse(newick, internal_parser="name")
+        prop2array = {'letter': [list(leaf2state), trait]}
+
+        # every permuted delta exceeds 0, the test stops after min_iteration
+        thread2deltas = {}
+        for threads in [1, 3]:
+            np.random.seed(7)
+            thread2deltas[threads] = tree_annotate.get_pval(prop2array, utils.topology_clone(test_tree), 
+                {'letter': trait}, iteration=60, prediction_method='BATCH_MPPA', sim=200, 
+                prop2delta={'letter': 0.0}, min_iteration=20, threads=threads)['letter']
+        self.assertEqual(len(thread2deltas[1]), 20)
+        self.assertEqual(thread2deltas[1], thread2deltas[3])
+
+    def test_rhat_ess_01(self):
+        from treeprofiler.src import phylosignal
+        rng = np.random.RandomState(0)
+        independent = rng.normal(size=(4, 1000))
+        self.assertAlmostEqual(phylosignal.rhat(independent), 1.0, delta=0.01)
+        self.assertGreater(phylosignal.ess(independent), 2500)
+        # chains stuck at different values have not converged
+        self.assertGreater(phylosignal.rhat(independent + np.arange(4)[:, None]), 1.5)
+        # autocorrelated draws have fewer effective samples
+        walk = np.cumsum(rng.normal(size=(4, 1000)), axis=1)
+        self.assertLess(phylosignal.ess(walk), 100)
+
+    def test_pval_decided_01(self):
+        # null trait, enough permuted deltas above the observed one
+        self.assertTrue(tree_annotate.pval_decided(10, 20))
+        # clearly significant once enough permutations excluded 0.05
+        self.assertFalse(tree_annotate.pval_decided(0, 20))
+        self.assertTrue(tree_annotate.pval_decided(0, 80))
+        # p_value close to alpha stays undecided
+        self.assertFalse(tree_annotate.pval_decided(4, 80))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -531,6 +531,38 @@ class TestAnnotate(unittest.TestCase):
         expected_tree_avgs = "(A:1[&&NHX:data_matrix.tsv=1.0],(B:1[&&NHX:data_matrix.tsv=2.0],(E:1[&&NHX:data_matrix.tsv=4.0],D:1[&&NHX:data_matrix.tsv=3.0])Internal_1:0.5[&&NHX:data_matrix.tsv_avg=3.5])Internal_2:0.5[&&NHX:data_matrix.tsv_avg=3.0])Root[&&NHX:data_matrix.tsv_avg=2.5];"
         self.assertEqual(test_tree_annotated.write(props=None, parser=parser, format_root_node=True), expected_tree_avgs)
 
+    def test_array_parsimony_01(self):
+        # presence-absence columns reconstructed by bitset ACCTRAN, over more than one 64 bits word
+        import numpy as np
+        from treeprofiler.src.acr_discrete import decode_bit_states
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser='name')
+        with NamedTemporaryFile(suffix='.tsv') as f_matrix:
+            f_matrix.write(b''.join(name + b'\t' + b'\t'.join([row] * 24) + b'\n' for name, row in
+                [(b'A', b'1\t0\t1'), (b'B', b'1\t0\t'), (b'E', b'0\t1\t1'), (b'D', b'0\t1\t0')]))
+            f_matrix.flush()
+            array_dict = tree_annotate.parse_tsv_to_array([f_matrix.name])
+            prop = os.path.basename(f_matrix.name)
+
+        prop2type = {}
+        test_tree = tree_annotate.run_array_parsimony(test_tree, array_dict, prop2type=prop2type)
+        self.assertEqual(prop2type[utils.add_suffix(prop, 'parsimony')], list)
+        # two 64 bits words of each bit plane
+        self.assertEqual([len(bits) for bits in test_tree.props[utils.add_suffix(prop, 'parsimony')]], [32, 32])
+        states = lambda node: decode_bit_states(node.props[utils.add_suffix(prop, 'parsimony')], 72).tolist()
+        self.assertEqual(states(test_tree), [1.0, 0.0, 1.0] * 24)
+        self.assertEqual(states(test_tree['Internal_2']), [1.0, 0.0, 1.0] * 24)
+        self.assertEqual(states(test_tree['Internal_1']), [0.0, 1.0, 1.0] * 24)
+        self.assertEqual(test_tree.props[utils.add_suffix(prop, 'steps')], [1, 1, 1] * 24)
+        self.assertEqual(test_tree.props[utils.add_suffix(prop, 'gains')], [0, 1, 0] * 24)
+        self.assertEqual(test_tree.props[utils.add_suffix(prop, 'losses')], [1, 0, 1] * 24)
+        self.assertNotIn(utils.add_suffix(prop, 'parsimony'), test_tree['A'].props)
+
+        # a tie at the root is left unresolved
+        test_tree = utils.ete4_parse("(A:1,B:1)Root;", internal_parser='name')
+        test_tree = tree_annotate.run_array_parsimony(test_tree, {'m': {'A': [1.0], 'B': [0.0]}})
+        self.assertTrue(np.isnan(decode_bit_states(test_tree.props['m_parsimony'], 1)[0]))
+        self.assertEqual((test_tree.props['m_steps'], test_tree.props['m_gains'], test_tree.props['m_losses']), ([1], [0], [0]))
+
     def test_internal_parser_01(self):
         parser='name'
         test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser=parser)
@@ -550,5 +582,234 @@ class TestAnnotate(unittest.TestCase):
         self.assertEqual(test_tree.write(props=None, parser=1, format_root_node=True), expected_tree_paser_1)
         self.assertEqual(test_tree.write(props=None, parser=0), expected_tree_paser_0)
 
+    def test_target_clade_01(self):
+        # resolve target clade by name, common ancestor and query
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser='name')
+        test_tree['E'].add_prop('alphabet_type', 'vowel')
+
+        self.assertEqual(utils.get_target_clade(test_tree, ['Internal_2']).name, 'Internal_2')
+        self.assertEqual(utils.get_target_clade(test_tree, ['B', 'D']).name, 'Internal_2')
+        self.assertEqual(utils.get_target_clade(test_tree, ['E||D']).name, 'Internal_1')
+        self.assertEqual(utils.get_target_clade(test_tree, ['alphabet_type=vowel'], {'alphabet_type': str}).name, 'E')
+        self.assertIsNone(utils.get_target_clade(test_tree, ['F']))
+
+    def test_target_clade_02(self):
+        # annotate only target clade, the rest of the tree is untouched
+        internal_parser = "name"
+        parser = utils.get_internal_parser(internal_parser)
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser=internal_parser)
+
+        with NamedTemporaryFile(suffix='.tsv') as f_annotation:
+            f_annotation.write(b'#name\talphabet_type\nA\tvowel\nB\tconsonant\nD\tconsonant\nE\tvowel\n')
+            f_annotation.flush()
+
+            target_clade = utils.get_target_clade(test_tree, ['Internal_1'])
+            node_names = {node.name for node in target_clade.traverse()}
+            metadata_dict, node_props, columns, prop2type = tree_annotate.parse_csv([f_annotation.name], target_nodes=node_names)
+
+        clade_parent = target_clade.up
+        clade_index = clade_parent.children.index(target_clade)
+        target_clade.detach()
+        clade_annotated, annotated_prop2type = tree_annotate.run_tree_annotate(target_clade,
+            metadata_dict=metadata_dict, node_props=node_props,
+            columns=columns, prop2type=prop2type)
+        clade_parent.children.insert(clade_index, clade_annotated)
+        clade_annotated.up = clade_parent
+
+        expected_tree = '(A:1,(B:1,(E:1[&&NHX:alphabet_type=vowel],D:1[&&NHX:alphabet_type=consonant])Internal_1:0.5[&&NHX:alphabet_type_counter=consonant--1||vowel--1])Internal_2:0.5)Root;'
+        self.assertEqual(test_tree.write(props=None, parser=parser, format_root_node=True), expected_tree)
+
+    def test_target_clade_03(self):
+        # query on a metadata column resolves the target clade of a newick tree
+        import argparse
+        from treeprofiler.main import populate_main_args
+        parser = argparse.ArgumentParser()
+        populate_main_args(parser)
+        tree_annotate.populate_annotate_args(parser)
+        with TemporaryDirectory() as tmpdir:
+            tree_path = os.path.join(tmpdir, 'tree.nw')
+            with open(tree_path, 'w') as f:
+                f.write("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;\n")
+            metadata_path = os.path.join(tmpdir, 'metadata.tsv')
+            with open(metadata_path, 'w') as f:
+                f.write("#name\talphabet_type\tgroup\nA\tvowel\tout\nB\tconsonant\tout\nD\tconsonant\tin\nE\tvowel\tin\n")
+            args = parser.parse_args(['-t', tree_path, '-m', metadata_path, '--internal', 'name',
+                '--target-clade', 'group=in', '-o', tmpdir, '--quiet'])
+            tree_annotate.run(args)
+
+            tree = utils.ete4_parse(open(os.path.join(tmpdir, 'tree_annotated.nw')).read(), internal_parser='name')
+        self.assertEqual(tree['Internal_1'].props['alphabet_type_counter'], 'consonant--1||vowel--1')
+        self.assertEqual(tree['E'].props['group'], 'in')
+        self.assertNotIn('alphabet_type', tree['A'].props)
+        self.assertNotIn('alphabet_type_counter', tree['Internal_2'].props)
+
+    def test_tree2table_01(self):
+        # one row per named node, missing props empty and lists joined
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser='name')
+        test_tree['A'].add_prop('alphabet_type', 'vowel')
+        test_tree['B'].add_prop('count', 3)
+        test_tree['Internal_1'].add_prop('list_data', ['a', 'b'])
+
+        with NamedTemporaryFile(suffix='.tsv', mode='r') as f_table:
+            tree_annotate.tree2table(test_tree, internal_node=True, props=None, outfile=f_table.name, block_size=2)
+            lines = f_table.read().splitlines()
+
+        self.assertEqual(lines[0], 'name\tdist\tsupport\talphabet_type\tcount\tlist_data')
+        self.assertEqual(len(lines), 8)
+        self.assertIn('A\t1.0\t\tvowel\t\t', lines)
+        self.assertIn('B\t1.0\t\t\t3\t', lines)
+        self.assertIn('Internal_1\t0.5\t\t\t\ta|b', lines)
+
+    def test_dump_newick_01(self):
+        # list props are joined by '||' in newick output, without changing the tree
+        parser = utils.get_internal_parser("name")
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser="name")
+        test_tree['A'].add_prop('list_data', ['a', 'b'])
+        test_tree['Internal_1'].add_prop('list_data_avg', [0.5, 1.0])
+
+        output = StringIO()
+        utils.dump_newick(test_tree, output, props=['list_data', 'list_data_avg'], parser=parser, format_root_node=True, chunk_size=4)
+        expected_tree = '(A:1[&&NHX:list_data=a||b],(B:1,(E:1,D:1)Internal_1:0.5[&&NHX:list_data_avg=0.5||1.0])Internal_2:0.5)Root;\n'
+        self.assertEqual(output.getvalue(), expected_tree)
+        self.assertEqual(utils.dumps_newick(test_tree, props=['list_data'], parser=parser, format_root_node=False),
+            '(A:1[&&NHX:list_data=a||b],(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5);')
+        self.assertEqual(test_tree['A'].props['list_data'], ['a', 'b'])
+
+    @unittest.skipIf(tree_annotate.pa is None, "pyarrow is not installed")
+    def test_parse_arrow_01(self):
+        # parquet metadata is read with its column types, projected and filtered by target nodes
+        import pyarrow.parquet as pq
+        table = tree_annotate.pa.table({
+            '#name': ['A', 'B', 'D', 'F'],
+            'alphabet_type': ['vowel', 'consonant', None, 'consonant'],
+            'count': [1, 2, 3, 4],
+            'flag': [True, False, True, False],
+        })
+        with NamedTemporaryFile(suffix='.parquet') as f_annotation:
+            pq.write_table(table, f_annotation.name)
+            metadata_dict, node_props, columns, prop2type = tree_annotate.parse_csv([f_annotation.name],
+                target_nodes={'A', 'B', 'D'})
+            self.assertEqual(prop2type, {'alphabet_type': str, 'count': float, 'flag': bool})
+            self.assertEqual(metadata_dict['A'], {'alphabet_type': 'vowel', 'count': 1.0, 'flag': 'True'})
+            self.assertEqual(metadata_dict['D'], {'count': 3.0, 'flag': 'True'})
+            self.assertNotIn('F', metadata_dict)
+
+            metadata_dict, node_props, columns, prop2type = tree_annotate.parse_csv([f_annotation.name],
+                include_props=['count'])
+            self.assertEqual(node_props, ['count'])
+            self.assertEqual(metadata_dict['F'], {'count': 4.0})
+
+    def test_sparse_annotate_01(self):
+        # sparse presence-absence matrix summarized as clade sums and prevalence
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser='name')
+        with NamedTemporaryFile(suffix='.tsv') as f_matrix:
+            f_matrix.write(b'A\tOG1\nB\tOG1\nB\tOG2\nE\tOG2\nD\tOG3\t0\nX\tOG1\n')
+            f_matrix.flush()
+            sparse_dict = tree_annotate.parse_sparse_matrix([f_matrix.name], target_nodes={'A', 'B', 'D', 'E'})
+            prop = os.path.basename(f_matrix.name)
+
+        self.assertEqual(sparse_dict[prop], {'A': {'OG1': 1}, 'B': {'OG1': 1, 'OG2': 1}, 'E': {'OG2': 1}})
+        prop2type = {}
+        test_tree = tree_annotate.run_sparse_annotate(test_tree, sparse_dict, prop2type=prop2type)
+        self.assertEqual(prop2type[prop], dict)
+        self.assertEqual(test_tree['B'].props[prop], {'OG1': 1, 'OG2': 1})
+        self.assertNotIn(prop, test_tree['D'].props)
+        self.assertEqual(test_tree['Internal_1'].props[utils.add_suffix(prop, 'sum')], {'OG2': 1})
+        self.assertEqual(test_tree['Internal_1'].props[utils.add_suffix(prop, 'prevalence')], {'OG2': 0.5})
+        self.assertEqual(test_tree['Root'].props[utils.add_suffix(prop, 'sum')], {'OG1': 2, 'OG2': 2})
+        self.assertEqual(test_tree['Root'].props[utils.add_suffix(prop, 'prevalence')], {'OG1': 0.5, 'OG2': 0.5})
+
+    def test_sparse_annotate_02(self):
+        # scipy npz input with names, values are summed and counted apart
+        import numpy as np
+        from scipy import sparse
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser='name')
+        matrix = sparse.csr_matrix(np.array([[2, 0], [0, 1], [3, 0]]))
+        with TemporaryDirectory() as tmpdir:
+            matrix_path = os.path.join(tmpdir, 'counts.npz')
+            np.savez(matrix_path, format=b'csr', shape=matrix.shape, data=matrix.data,
+                indices=matrix.indices, indptr=matrix.indptr,
+                row_names=np.array(['A', 'E', 'D']), col_names=np.array(['OG1', 'OG2']))
+            sparse_dict = tree_annotate.parse_sparse_matrix([matrix_path])
+
+        self.assertEqual(sparse_dict['counts.npz'], {'A': {'OG1': 2}, 'E': {'OG2': 1}, 'D': {'OG1': 3}})
+        test_tree = tree_annotate.run_sparse_annotate(test_tree, sparse_dict)
+        self.assertEqual(test_tree['Internal_1'].props['counts.npz_sum'], {'OG2': 1, 'OG1': 3})
+        self.assertEqual(test_tree['Root'].props['counts.npz_sum'], {'OG1': 5, 'OG2': 1})
+        self.assertEqual(test_tree['Root'].props['counts.npz_prevalence'], {'OG1': 0.5, 'OG2': 0.25})
+
+    def test_topology_clone_01(self):
+        # only name, dist and support are copied, the source tree is untouched
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser='name')
+        test_tree['Internal_1'].add_prop('trait', ['x', 'y'])
+        clone = utils.topology_clone(test_tree)
+        self.assertEqual(type(clone), type(test_tree))
+        self.assertEqual(clone.write(props=[], parser=1, format_root_node=True),
+            test_tree.write(props=[], parser=1, format_root_node=True))
+        self.assertNotIn('trait', clone['Internal_1'].props)
+        clone['A'].add_prop('trait', 'z')
+        self.assertNotIn('trait', test_tree['A'].props)
+
+    def test_split_newicks_01(self):
+        # ';' inside quoted names and comments does not end a tree
+        lines = ["(A:1,'B;1':1);(C:1,\n", "D:1[&&NHX:x=;]);\n"]
+        newicks = list(tree_annotate.split_newicks(lines))
+        self.assertEqual(newicks, ["(A:1,'B;1':1);", "(C:1,\nD:1[&&NHX:x=;]);"])
+
+    def test_forest_01(self):
+        # multi-newick forest, the broken tree is reported and the rest annotated
+        import argparse
+        from treeprofiler.main import populate_main_args
+        parser = argparse.ArgumentParser()
+        populate_main_args(parser)
+        tree_annotate.populate_annotate_args(parser)
+        with TemporaryDirectory() as tmpdir:
+            forest_path = os.path.join(tmpdir, 'forest.nw')
+            with open(forest_path, 'w') as f:
+                f.write("(A:1,(B:1,C:1):1);\n(A:1,B:1;\n((A:1,D:1):1,E:1);\n")
+            metadata_path = os.path.join(tmpdir, 'metadata.tsv')
+            with open(metadata_path, 'w') as f:
+                f.write("#name\tcol1\nA\tx\nB\ty\nC\tx\nD\ty\nE\tx\n")
+            args = parser.parse_args(['-t', forest_path, '--forest', '-m', metadata_path,
+                '-o', tmpdir, '--threads', '2', '--quiet'])
+            tree_annotate.run(args)
+
+            with open(os.path.join(tmpdir, 'forest_report.tsv')) as f:
+                report = sorted(line.split('\t')[:2] for line in f if not line.startswith('#'))
+            self.assertEqual(report, [['forest_1', 'ok'], ['forest_2', 'failed'], ['forest_3', 'ok']])
+
+            tree = utils.ete4_parse(open(os.path.join(tmpdir, 'forest_3_annotated.nw')).read(), internal_parser='name')
+            self.assertEqual(tree.props['col1_counter'], 'x--2||y--1')
+            self.assertEqual(tree['D'].props['col1'], 'y')
+
+    def test_forest_02(self):
+        # ACR of each tree of the forest only sees the states of its own leaves
+        import argparse
+        from unittest import mock
+        from treeprofiler.main import populate_main_args
+        parser = argparse.ArgumentParser()
+        populate_main_args(parser)
+        tree_annotate.populate_annotate_args(parser)
+        with TemporaryDirectory() as tmpdir:
+            forest_path = os.path.join(tmpdir, 'forest.nw')
+            with open(forest_path, 'w') as f:
+                f.write("((A:1,B:1):1,(C:1,D:1):1);\n((E:1,F:1):1,(G:1,H:1):1);\n")
+            metadata_path = os.path.join(tmpdir, 'metadata.tsv')
+            with open(metadata_path, 'w') as f:
+                f.write("#name\tcol1\nA\tx\nB\tx\nC\ty\nD\ty\nE\tz\nF\tw\nG\tz\nH\tz\n")
+            args = parser.parse_args(['-t', forest_path, '--forest', '-m', metadata_path,
+                '--acr-discrete-columns', 'col1', '--prediction-method', 'BATCH_MPPA', 
+                '-o', tmpdir, '--threads', '1', '--quiet'])
+            with mock.patch.object(tree_annotate, 'run_acr_discrete', wraps=tree_annotate.run_acr_discrete) as acr:
+                tree_annotate.run(args)
+            self.assertEqual(sorted(sorted(call.args[1]['col1']) for call in acr.call_args_list),
+                [['w', 'z', 'z', 'z'], ['x', 'x', 'y', 'y']])
+
+            with open(os.path.join(tmpdir, 'forest_report.tsv')) as f:
+                report = sorted(line.split('\t')[:2] for line in f if not line.startswith('#'))
+            self.assertEqual(report, [['forest_1', 'ok'], ['forest_2', 'ok']])
+            tree = utils.ete4_parse(open(os.path.join(tmpdir, 'forest_2_annotated.nw')).read(), internal_parser='name')
+            self.assertTrue(set(tree.props['col1'].split('||')) <= {'z', 'w'})
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
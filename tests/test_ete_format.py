@@ -0,0 +1,148 @@
+
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '/..'))
+
+from tempfile import NamedTemporaryFile
+import numpy as np
+
+from treeprofiler.src import utils
+from treeprofiler.src import ete_format
+
+def get_test_tree():
+    test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser='name')
+    test_tree['A'].add_prop('alphabet_type', 'vowel')
+    test_tree['E'].add_prop('alphabet_type', 'vowel')
+    test_tree['B'].add_prop('count', 3)
+    test_tree['D'].add_prop('flag', True)
+    test_tree['Internal_1'].add_prop('alphabet_type_counter', 'vowel--1')
+    test_tree['Internal_1'].add_prop('score_avg', np.float64(0.5))
+    test_tree['Internal_2'].add_prop('list_data', ['a', 'b'])
+    return test_tree
+
+class TestEteFormat(unittest.TestCase):
+    def test_columnar_01(self):
+        # round trip keeps topology, children order and props
+        test_tree = get_test_tree()
+        data = ete_format.dumps_columnar(test_tree)
+        self.assertTrue(ete_format.is_columnar(data))
+
+        loaded_tree = ete_format.loads_columnar(data)
+        expected = [(n.name, n.props) for n in test_tree.traverse()]
+        result = [(n.name, n.props) for n in loaded_tree.traverse()]
+        self.assertEqual(result, expected)
+        self.assertEqual(loaded_tree['Internal_1'].up.name, 'Internal_2')
+        self.assertIsInstance(loaded_tree['B'].props['count'], int)
+        self.assertIsInstance(loaded_tree['D'].props['flag'], bool)
+        self.assertIsNone(loaded_tree['A'].props.get('count'))
+
+        header, _ = ete_format.read_columnar_header(data)
+        name2type = {column['name']: column['type'] for column in header['columns']}
+        self.assertEqual(name2type['name'], 'str')
+        self.assertEqual(name2type['dist'], 'float')
+        self.assertEqual(name2type['score_avg'], 'float')
+        self.assertEqual(name2type['list_data'], 'pickle')
+
+    def test_columnar_02(self):
+        # validate_tree detects both .ete versions
+        test_tree = get_test_tree()
+        for content, mode in [(ete_format.dumps_columnar(test_tree), 'wb'),
+                (ete_format.dumps(test_tree), 'w')]:
+            with NamedTemporaryFile(suffix='.ete', mode=mode) as f_tree:
+                f_tree.write(content)
+                f_tree.flush()
+                loaded_tree, eteformat_flag = utils.validate_tree(f_tree.name, 'auto')
+            self.assertTrue(eteformat_flag)
+            self.assertEqual(sorted(n.name for n in loaded_tree.traverse()),
+                sorted(n.name for n in test_tree.traverse()))
+
+    def test_columnar_03(self):
+        # load only requested columns, and the rest on demand
+        test_tree = get_test_tree()
+        loader = ete_format.ColumnarLoader(ete_format.dumps_columnar(test_tree))
+        self.assertEqual(loader.get_prop2type()['score_avg'], float)
+        self.assertEqual(loader.get_prop2type()['list_data'], list)
+        self.assertEqual(loader.get_prop2type()['alphabet_type'], str)
+
+        loaded_tree = loader.load(['name', 'alphabet_type'])
+        self.assertEqual(loaded_tree['E'].props, {'name': 'E', 'alphabet_type': 'vowel'})
+        self.assertNotIn('score_avg', loaded_tree['Internal_1'].props)
+
+        loader.load(['score_avg'])
+        self.assertEqual(loaded_tree['Internal_1'].props['score_avg'], 0.5)
+        self.assertEqual(loader.loaded, {'name', 'alphabet_type', 'score_avg'})
+
+    def test_columnar_04(self):
+        # validate_tree keeps tree basics when loading a projection of both .ete versions
+        test_tree = get_test_tree()
+        for content, mode in [(ete_format.dumps_columnar(test_tree), 'wb'),
+                (ete_format.dumps(test_tree), 'w')]:
+            with NamedTemporaryFile(suffix='.ete', mode=mode) as f_tree:
+                f_tree.write(content)
+                f_tree.flush()
+                loaded_tree, _ = utils.validate_tree(f_tree.name, 'auto', include_props=['count'])
+            self.assertEqual(loaded_tree['B'].props, {'name': 'B', 'dist': 1.0, 'count': 3})
+            self.assertEqual(loaded_tree['Internal_1'].props, {'name': 'Internal_1', 'dist': 0.5})
+
+    def test_stream_01(self):
+        # streaming decoder matches loads, for plain and packed content, in batches and with workers
+        import io
+        test_tree = get_test_tree()
+        expected = [(n.name, n.props) for n in ete_format.loads(ete_format.dumps(test_tree)).traverse()]
+        for unpack in [False, True]:
+            content = ete_format.dumps(test_tree, pack=unpack)
+            for threads in [1, 2]:
+                loaded_tree = ete_format.load(io.StringIO(content), unpack=unpack,
+                    threads=threads, batch_size=2)
+                result = [(n.name, n.props) for n in loaded_tree.traverse()]
+                self.assertEqual(result, expected)
+
+        loaded_tree = ete_format.load(io.StringIO(ete_format.dumps(test_tree)), include_props=['name', 'count'])
+        self.assertEqual(loaded_tree['B'].props, {'name': 'B', 'count': 3})
+
+    def test_stream_02(self):
+        # streaming writer matches dumps, and compressed output is detected by validate_tree
+        import io
+        test_tree = get_test_tree()
+        OUT = io.StringIO()
+        ete_format.dump(test_tree, OUT, buffer_size=10)
+        self.assertEqual(OUT.getvalue(), ete_format.dumps(test_tree))
+
+        compressions = ['gzip'] + (['zstd'] if ete_format.zstandard is not None else [])
+        for compression in compressions:
+            with NamedTemporaryFile(suffix='.ete', mode='wb') as f_tree:
+                ete_format.dump(test_tree, f_tree, compression=compression, level=1)
+                f_tree.flush()
+                loaded_tree, eteformat_flag = utils.validate_tree(f_tree.name, 'auto')
+            self.assertTrue(eteformat_flag)
+            self.assertEqual(loaded_tree['B'].props['count'], 3)
+            self.assertEqual(loaded_tree['Internal_2'].props['list_data'], ['a', 'b'])
+
+    def test_tree_cache_01(self):
+        # parsed newick is cached next to the tree, and invalidated when the tree changes
+        from tempfile import TemporaryDirectory
+        with TemporaryDirectory() as tmpdir:
+            tree_path = os.path.join(tmpdir, 'tree.nw')
+            with open(tree_path, 'w') as f:
+                f.write("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;")
+            self.assertFalse(ete_format.sniff_ete(tree_path))
+
+            tree, eteformat_flag = utils.validate_tree(tree_path, 'auto', 'name', cache=True)
+            self.assertFalse(eteformat_flag)
+            self.assertTrue(os.path.exists(tree_path + utils.TREE_CACHE_SUFFIX))
+
+            cached_tree = utils.load_tree_cache(tree_path, 'name')
+            self.assertEqual([(n.name, n.dist) for n in cached_tree.traverse()],
+                [(n.name, n.dist) for n in tree.traverse()])
+            self.assertIsNone(utils.load_tree_cache(tree_path, 'support'))
+
+            with open(tree_path, 'w') as f:
+                f.write("(A:1,B:1)Root;")
+            self.assertIsNone(utils.load_tree_cache(tree_path, 'name'))
+            tree, _ = utils.validate_tree(tree_path, 'auto', 'name', cache=True)
+            self.assertEqual(sorted(tree.leaf_names()), ['A', 'B'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '/..'))
+
+from treeprofiler.src import utils
+from treeprofiler.src import planner
+
+class TestPlanner(unittest.TestCase):
+    def test_inspect_inputs(self):
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser='name')
+        info = planner.inspect_inputs(test_tree)
+        self.assertEqual(info['leaves'], 4)
+        self.assertEqual(info['nodes'], 7)
+        self.assertEqual(info['internal'], 3)
+        # Root has 4 leaves, Internal_2 has 3, Internal_1 has 2
+        self.assertEqual(info['clade_load'], 9)
+
+    def test_inspect_inputs_02(self):
+        # the header is not a row, states of discrete ACR columns are counted without missing values
+        from tempfile import NamedTemporaryFile
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser='name')
+        with NamedTemporaryFile(suffix='.tsv', mode='w') as f_metadata:
+            f_metadata.write("#name\tletter\tsize\nA\tx\t1\nB\ty\t2\nC\tz\t3\nD\tNaN\t4\nE\tx\t5\n")
+            f_metadata.flush()
+            info = planner.inspect_inputs(test_tree, metadata=[f_metadata.name], acr_discrete_columns=['letter'])
+            self.assertEqual((info['metadata_rows'], info['metadata_columns']), (5, 2))
+            self.assertEqual(info['acr_states'], {'letter': 3})
+
+            info = planner.inspect_inputs(test_tree, metadata=[f_metadata.name], no_headers=True,
+                acr_discrete_columns=['col1'])
+            self.assertEqual(info['metadata_rows'], 6)
+            self.assertEqual(info['acr_states'], {'col1': 4})
+
+    def test_choose_threads(self):
+        # too small to pay for worker processes
+        self.assertEqual(planner.choose_threads(0.05, 1000, 8), 1)
+        # single task cannot be split
+        self.assertEqual(planner.choose_threads(1000, 1, 8), 1)
+        # long stage uses all workers
+        self.assertEqual(planner.choose_threads(1000, 1000, 8), 8)
+        # transfer cost dominates
+        self.assertEqual(planner.choose_threads(10, 1000, 8, transfer_time=100), 1)
+
+    def test_estimate_stages(self):
+        info = {
+            'leaves': 1000, 'nodes': 1999, 'internal': 999, 'clade_load': 20000,
+            'metadata_rows': 1000, 'metadata_columns': 5,
+            'matrix_columns': 0, 'alignment_length': 0,
+        }
+        costs = {'speed': 1.0, 'summary': 1e-6, 'pickle': 5e-6, 'mcmc_step': 5e-5, 'mcmc_elem': 1e-8}
+        options = {
+            'acr_discrete_columns': ['a'],
+            'prediction_method': 'MPPA',
+            'delta_stats': True,
+            'iteration': 10000,
+        }
+        stages = planner.estimate_stages(info, options, costs, max_threads=4)
+        stage2threads = planner.get_stage2threads(stages)
+        self.assertEqual(list(stage2threads.keys()),
+            ['parse_metadata', 'summary', 'acr_discrete', 'delta', 'delta_pval', 'output'])
+        self.assertEqual(stage2threads['summary'], 1)
+        self.assertEqual(stage2threads['delta_pval'], 4)
+        self.assertIn('total', planner.format_plan(info, stages))
+
+        # one delta per clade runs in the process pool
+        options['delta_per_clade'] = True
+        stage2threads = planner.get_stage2threads(planner.estimate_stages(info, options, costs, max_threads=4))
+        self.assertEqual(stage2threads['delta'], 4)
+
+        # permutations with fixed model parameters skip the acr
+        full = planner.estimate_stages(info, options, costs, max_threads=1)
+        options['delta_fixed_parameters'] = True
+        fixed = planner.estimate_stages(info, options, costs, max_threads=1)
+        stage2time = lambda stages: {stage['stage']: stage['time'] for stage in stages}
+        self.assertLess(stage2time(fixed)['delta_pval'], stage2time(full)['delta_pval'])
+
+        # more states cost more than linearly
+        options['delta_fixed_parameters'] = False
+        many = planner.estimate_stages(dict(info, acr_states={'a': 20}), options, costs, max_threads=1)
+        self.assertGreater(stage2time(many)['acr_discrete'], 20 * stage2time(full)['acr_discrete'])
+
+        # continuous ACR only supports ML and BAYESIAN
+        continuous = {'acr_continuous_columns': ['b'], 'prediction_method': 'MPPA'}
+        stages = planner.estimate_stages(info, continuous, costs, max_threads=4)
+        self.assertIn('not supported', stages[-2]['strategy'])
+        continuous['prediction_method'] = 'BAYESIAN'
+        stages = planner.estimate_stages(info, continuous, costs, max_threads=4)
+        self.assertTrue(stages[-2]['strategy'].startswith('BAYESIAN'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -330,19 +330,8 @@ def process_upload_job(job_args):
         if 'support' in avail_props:
             del avail_props[avail_props.index('support')]
 
-        # convert list data to string
-        list_keys = [key for key, value in prop2type.items() if value == list]
-        
-        # Replace all commas in the tree with '||'
-        list_sep = '||'
-        for node in tree.leaves():
-            for key in list_keys:
-                if node.props.get(key):
-                    
-                    list2str = list_sep.join(map(str, node.props.get(key)))
-                    node.add_prop(key, list2str)
-
-        annotated_newick = tree.write(props=avail_props, 
+        # list data is written joined by '||', as ',' is not allowed in newick
+        annotated_newick = utils.dumps_newick(tree, props=avail_props, 
         parser=utils.get_internal_parser(treeparser),format_root_node=True)
         
         # check if alignment pro is there
@@ -502,7 +491,6 @@ def process_upload_job(job_args):
         if treename == 'gtdb_r202_example':
             extracted_tree_file = extract_tar_gz(GTDBEXAMPLE_FILE, EXTRACTED_METADATA_DIR)  # Extract before using
             if extracted_tree_file:
-                annotated_tree, eteformat_flag = utils.validate_tree(extracted_tree_file, 'ete')
                 prop2type = {
                     'gc_percentage': float, 
                     'genome_size': float, 
@@ -547,6 +535,9 @@ def process_upload_job(job_args):
                     'common_name': str, 
                     'species': str
                 }
+                # only load the properties used in the example
+                annotated_tree, eteformat_flag = utils.validate_tree(extracted_tree_file, 'ete',
+                    include_props=list(prop2type.keys()))
             else:
                 raise FileNotFoundError("GTDB example file extraction failed!")
         else:
@@ -588,24 +579,14 @@ def process_upload_job(job_args):
         else:
             rank_list = []
 
-        # Post-processing of annotated tree properties
-        list_keys = [key for key, value in prop2type.items() if value == list]
-
-        list_sep = '||'
-        for node in annotated_tree.traverse():
-            for key in list_keys:
-                if node.props.get(key):
-                    cont2str = list(map(str, node.props.get(key)))
-                    list2str = list_sep.join(cont2str)
-                    node.add_prop(key, list2str)
-        
         # Name the nodes
         annotated_tree = name_nodes(annotated_tree)
 
         #avail_props = [key for key in prop2type.keys() if key not in ['name', 'dist', 'support']]
         avail_props = list(prop2type.keys())
 
-        annotated_newick = annotated_tree.write(props=avail_props, format_root_node=True)
+        # list data is written joined by '||', as ',' is not allowed in newick
+        annotated_newick = utils.dumps_newick(annotated_tree, props=avail_props, format_root_node=True)
 
         # Add node properties for display
         node_props = metadata_options.get('node_props', [])
@@ -40,6 +40,11 @@ def populate_main_args(main_args_p):
         default="auto",
         choices=["auto", "newick", "ete"],
         help="Specify input tree format. [newick, ete]. [default: ete]")
+    group.add_argument('--tree-cache',
+        default=False,
+        action='store_true',
+        required=False,
+        help="Cache the parsed newick tree in a binary sidecar file (<tree>.tpcache), reused while the tree file is unchanged.")
     group.add_argument('--prop2type',
         type=str,
         help="config tsv file where determine the datatype of target properties, if your input tree type is .ete, it's note necessary")
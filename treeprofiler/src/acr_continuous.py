@@ -1,200 +1,595 @@
 # methods.py
+import logging
+
 import numpy as np
 import pymc as pm
+import pytensor.tensor as pt
+
+from treeprofiler.src.acr_discrete import TreeArrays, grid_golden_search
+from treeprofiler.src.utils import add_suffix
+
+# two-sided 95% quantile of the normal distribution
+CI_Z = 1.959963984540054
+# OU selection strength search, bounds in units of 1 / tree height
+ALPHA_BOUNDS = (0.01, 100.)
+ALPHA_GRID = 9
+ALPHA_ITERATIONS = 20
+# Pagel's lambda search in [0, 1]
+LAMBDA_GRID = 11
+LAMBDA_ITERATIONS = 12
+# posterior draws summarised for each reconstructed node, and nodes summarised at once
+NODE_DRAWS = 1000
+NODE_CHUNK = 2000
+
+logger = logging.getLogger(__name__)
 
-def build_variance_covariance_matrix(tree, species, sigma, alpha=None, model='BM'):
+def ml_acr(tree, prop, observed_traits, model='BM', sigma=None, alpha=None, theta=None):
     """
-    Build the variance-covariance matrix for BM or OU models.
-    
+    Maximum Likelihood Ancestral Character Reconstruction.
+
     Parameters:
     - tree: Phylogenetic tree
-    - species: List of species names
-    - sigma: Drift rate (variance scaling)
-    - alpha: Selection strength (OU model only)
-    - model: 'BM' or 'OU' to select the model type
-    
+    - prop: name of the trait
+    - observed_traits: Observed trait values by leaf name
+    - model, sigma, alpha, theta: see ml_acr_traits
+
     Returns:
-    - Variance-covariance matrix (V)
-    """
-    n = len(species)
-    V = np.zeros((n, n))
-
-    for i in range(n):
-        for j in range(i, n):
-            leaf_i = next(tree.search_leaves_by_name(name=species[i]))
-            leaf_j = next(tree.search_leaves_by_name(name=species[j]))
-            mrca = tree.common_ancestor([leaf_i, leaf_j])
-            shared_time = tree.get_distance(tree, mrca)
-            
-            if model == 'BM':
-                V[i, j] = V[j, i] = sigma ** 2 * shared_time
-            elif model == 'OU':
-                V[i, j] = V[j, i] = (sigma ** 2 / (2 * alpha)) * (1 - np.exp(-2 * alpha * shared_time))
-    return V
-
-def bm_model(V, Y, sigma):
-    """
-    Likelihood function for Brownian Motion model.
-    
+    - Annotated tree with estimated traits and their 95% confidence interval
+    - Results with node values and confidence intervals
+    """
+    tree, prop2results = ml_acr_traits(tree, {prop: observed_traits}, model=model, 
+        sigma=sigma, alpha=alpha, theta=theta)
+    return tree, prop2results[prop]
+
+def ml_acr_traits(tree, prop2traits, model='BM', sigma=None, alpha=None, theta=None):
+    """
+    Maximum Likelihood Ancestral Character Reconstruction of several traits.
+
+    The traits are the columns of one (nodes, traits) matrix on the same tree
+    arrays, and their likelihoods are computed by Felsenstein's pruning in one
+    bottom-up pass and the node estimates by one top-down pass, in linear
+    time. Leaves without observed value are predicted as internal nodes.
+
     Parameters:
-    - V: Variance-covariance matrix
-    - Y: Observed trait values vector
-    - sigma: Drift rate
-    
+    - tree: Phylogenetic tree
+    - prop2traits: dict of trait name to observed trait values by leaf name
+    - model: 'BM' or 'OU'
+    - sigma: Drift rate, estimated for each trait if None
+    - alpha: Selection strength (OU model only), estimated for each trait if None
+    - theta: Optimal trait value (OU model only), estimated for each trait if None
+
     Returns:
-    - Likelihood of the observed data
+    - Annotated tree with estimated traits and their 95% confidence interval
+    - dict of trait name to results with node values and confidence intervals
     """
-    # Placeholder function structure; for Bayesian, the actual likelihood computation happens in PyMC3
-    return V, Y
+    props = list(prop2traits)
+    arrays = TreeArrays(tree)
+    values = np.array([[prop2traits[prop].get(node.name, np.nan) if leaf else np.nan for prop in props]
+        for node, leaf in zip(arrays.nodes, arrays.is_leaf)], dtype=float)
+    fit = fit_continuous(arrays, values, model=model, sigma=sigma, alpha=alpha, theta=theta)
+
+    observed = arrays.is_leaf[:, None] & ~np.isnan(values)
+    half_width = CI_Z * np.sqrt(fit['variances'])
+    lower = fit['estimates'] - half_width
+    upper = fit['estimates'] + half_width
+    prop2results = {}
+    for t, prop in enumerate(props):
+        results = {
+            'model': model,
+            'sigma2': fit['sigma2'][t],
+            'alpha': fit['alpha'][t],
+            'theta': fit['theta'][t],
+            'log_likelihood': fit['log_likelihood'][t],
+        }
+        for i, node in enumerate(arrays.nodes):
+            if observed[i, t]:
+                results[node.name] = {prop: values[i, t]}
+                node.add_prop(prop, values[i, t])
+                continue
+            interval = (lower[i, t], upper[i, t])
+            node.add_prop(prop, fit['estimates'][i, t])
+            node.add_prop(add_suffix(prop, 'ci_lower'), interval[0])
+            node.add_prop(add_suffix(prop, 'ci_upper'), interval[1])
+            name = 'root' if not i else (node.name or 'Unnamed')
+            results[name] = {prop: fit['estimates'][i, t], 'confidence_interval': interval}
+
+        print(f"Estimated ancestral {prop} value at the root ({model}-ML): {fit['estimates'][0, t]:.2f}")
+        prop2results[prop] = results
+    return tree, prop2results
 
-def ou_model(V, Y, sigma, alpha, theta):
+def _transition(arrays, idx, alpha, floor, dist=None):
     """
-    Likelihood function for Ornstein-Uhlenbeck model.
-    
+    Coefficients of the Gaussian transition along the branches above the nodes
+    idx: the child value is a * parent + (1 - a) * theta plus a noise of
+    variance sigma2 * q. Brownian motion is the limit alpha = 0. dist gives
+    other branch lengths than the tree ones, one column per trait if 2-d.
+    """
+    t = np.maximum((arrays.dist if dist is None else dist)[idx], floor)
+    if t.ndim == 1:
+        t = t[:, None]
+    alpha = alpha[None, :]
+    a = np.exp(-alpha * t)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = np.where(alpha > 0, -np.expm1(-2 * alpha * t) / (2 * alpha), t)
+    return a, q
+
+def _branch_floor(arrays):
+    # zero-length branches would make conditional variances singular
+    positive = arrays.dist[arrays.dist > 0]
+    return 1e-6 * (positive.mean() if len(positive) else 1.)
+
+def prune(arrays, values, alpha, theta, dist=None):
+    """
+    Bottom-up pass of Felsenstein's pruning for Gaussian traits, with unit
+    drift rate. The likelihood of the subtree of each node, as a function of
+    the node value, is a Gaussian kernel whose mean and variance are computed
+    from the messages of its children.
+
     Parameters:
-    - V: Variance-covariance matrix
-    - Y: Observed trait values vector
-    - sigma: Drift rate
-    - alpha: Selection strength
-    - theta: Optimal trait value
-    
+    - arrays: TreeArrays of the tree
+    - values: (nodes, traits) array of leaf values, NaN when missing
+    - alpha: (traits,) selection strength, 0 for Brownian motion
+    - theta: (traits,) optimal trait value
+    - dist: (nodes,) or (nodes, traits) branch lengths, the tree ones if None
+
     Returns:
-    - Likelihood of the observed data
+    - mean, var: (nodes, traits) mean and variance of the subtree kernel of each node
+    - msg_mean, msg_prec: (nodes, traits) mean and precision of the message of each node to its parent
+    - quad: (traits,) quadratic form of the subtree of the root
+    - logdet: (traits,) log-determinant of the subtree of the root
     """
-    # Placeholder function structure; for Bayesian, the actual likelihood computation happens in PyMC3
-    return V, Y, alpha, theta
+    n, n_traits = values.shape
+    floor = _branch_floor(arrays)
+    observed = ~np.isnan(values) & arrays.is_leaf[:, None]
+    mean = np.where(observed, values, 0.)
+    var = np.where(observed, 0., np.inf)
+    msg_mean = np.zeros((n, n_traits))
+    msg_prec = np.zeros((n, n_traits))
+    # sums of the children messages: precision, weighted mean, weighted square and log-variance
+    s0, s1, s2, sl = (np.zeros((n, n_traits)) for _ in range(4))
+    quad = np.zeros(n_traits)
+    logdet = np.zeros(n_traits)
+
+    for idx in arrays.up_levels:
+        internal = idx[~arrays.is_leaf[idx]]
+        if len(internal):
+            prec = s0[internal]
+            has = prec > 0
+            safe = np.where(has, prec, 1.)
+            var[internal] = np.where(has, 1 / safe, np.inf)
+            mean[internal] = np.where(has, s1[internal] / safe, 0.)
+            quad += np.where(has, s2[internal] - s1[internal] ** 2 / safe, 0.).sum(axis=0)
+            logdet += np.where(has, sl[internal] + np.log(safe), 0.).sum(axis=0)
+
+        idx = idx[idx > 0]
+        if not len(idx):
+            continue
+        a, q = _transition(arrays, idx, alpha, floor, dist)
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            mv = (var[idx] + q) / a ** 2
+            mm = (mean[idx] - theta * (1 - a)) / a
+        informative = np.isfinite(mv)
+        mv = np.where(informative, mv, 1.)
+        prec = np.where(informative, 1 / mv, 0.)
+        mm = np.where(informative, mm, 0.)
+        msg_mean[idx] = mm
+        msg_prec[idx] = prec
+
+        # sum the messages of the siblings of this level into their parents
+        order = np.argsort(arrays.parents[idx], kind='stable')
+        parents = arrays.parents[idx][order]
+        starts = np.flatnonzero(np.r_[True, parents[1:] != parents[:-1]])
+        parents = parents[starts]
+        for total, term in ((s0, prec), (s1, prec * mm), (s2, prec * mm ** 2),
+                            (sl, np.where(informative, np.log(mv), 0.))):
+            total[parents] += np.add.reduceat(term[order], starts, axis=0)
+        # the message is a kernel in the parent value scaled by 1 / a
+        logdet += np.where(informative, 2 * np.log(a), 0.).sum(axis=0)
 
-def ml_acr(tree, prop, observed_traits, model='BM', sigma=1.0, alpha=None, theta=None):
+    return mean, var, msg_mean, msg_prec, quad, logdet
+
+def _root_prior(mean, var, alpha, theta):
     """
-    Maximum Likelihood Ancestral Character Reconstruction.
-    
+    Combine the subtree kernel of the root with the root distribution: flat
+    for Brownian motion (the root value is estimated by maximum likelihood)
+    and the stationary distribution for Ornstein-Uhlenbeck.
+
+    Returns:
+    - quad, logdet: (traits,) root terms of the likelihood
+    - root_mean, root_var: (traits,) conditional mean and variance of the root
+    """
+    m, v = mean[0], var[0]
+    ou = alpha > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stationary = np.where(ou, 1 / (2 * alpha), np.inf)
+        total = np.where(ou, v + stationary, v)
+        quad = np.where(ou, (m - theta) ** 2 / total, 0.)
+        prec = 1 / v + np.where(ou, 1 / stationary, 0.)
+        root_mean = np.where(ou, (m / v + theta / stationary) / prec, m)
+    return quad, np.log(total), root_mean, 1 / prec
+
+def smooth(arrays, mean, var, msg_mean, msg_prec, alpha, theta, root_mean, root_var):
+    """
+    Top-down pass: combine the subtree kernel of each node with the message
+    from the rest of the tree, giving the conditional mean and variance of
+    every node value given all the observed leaves.
+
+    Returns:
+    - estimates, variances: (nodes, traits) arrays, with unit drift rate
+    """
+    floor = _branch_floor(arrays)
+    estimates = mean.copy()
+    variances = var.copy()
+    estimates[0] = root_mean
+    variances[0] = root_var
+    for idx in arrays.down_levels:
+        parents = arrays.parents[idx]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # a parent with zero variance is a root fixed to a given value
+            fixed_parent = variances[parents] == 0
+            parent_prec = 1 / variances[parents]
+            # parent kernel without the message of this child
+            rest_prec = parent_prec - msg_prec[idx]
+            informative = fixed_parent | (rest_prec > 1e-12 * parent_prec)
+            rest_prec = np.where(informative & ~fixed_parent, rest_prec, 1.)
+            rest_mean = np.where(fixed_parent, estimates[parents],
+                (estimates[parents] * parent_prec - msg_mean[idx] * msg_prec[idx]) / rest_prec)
+            a, q = _transition(arrays, idx, alpha, floor)
+            out_mean = a * rest_mean + theta * (1 - a)
+            out_var = np.where(fixed_parent, 0., a ** 2 / rest_prec) + q
+            out_prec = np.where(informative, 1 / out_var, 0.)
+            sub_prec = np.where(np.isfinite(var[idx]), 1 / var[idx], 0.)
+            prec = sub_prec + out_prec
+            combined = (mean[idx] * sub_prec + np.where(informative, out_mean, 0.) * out_prec) / prec
+        # observed leaves keep their value
+        fixed = var[idx] == 0
+        estimates[idx] = np.where(fixed, mean[idx], combined)
+        variances[idx] = np.where(fixed, 0., 1 / prec)
+    return estimates, variances
+
+def _profile(arrays, values, alpha):
+    """
+    Profile likelihood of the Ornstein-Uhlenbeck model for the given alpha:
+    the likelihood is quadratic in theta and sigma2 scales the covariance, so
+    both have closed-form estimates from three pruning passes, batched as
+    extra columns.
+
+    Returns:
+    - log_likelihood, theta, sigma2: (traits,) arrays
+    """
+    n_traits = values.shape[1]
+    n_obs = (~np.isnan(values) & arrays.is_leaf[:, None]).sum(axis=0)
+    thetas = np.repeat([0., 1., -1.], n_traits)
+    mean, var, _, _, quad, logdet = prune(arrays, np.tile(values, 3), np.tile(alpha, 3), thetas)
+    root_quad, root_logdet, _, _ = _root_prior(mean, var, np.tile(alpha, 3), thetas)
+    quad = (quad + root_quad).reshape(3, n_traits)
+    logdet = (logdet + root_logdet)[:n_traits]
+    curvature = (quad[1] + quad[2]) / 2 - quad[0]
+    slope = (quad[1] - quad[2]) / 2
+    theta = -slope / (2 * curvature)
+    sigma2 = np.maximum(quad[0] - slope ** 2 / (4 * curvature), 1e-300) / n_obs
+    log_likelihood = -0.5 * (n_obs * np.log(2 * np.pi * sigma2) + logdet + n_obs)
+    return log_likelihood, theta, sigma2
+
+def _root_distances(arrays):
+    root_dist = np.zeros(len(arrays.nodes))
+    for idx in arrays.down_levels:
+        root_dist[idx] = root_dist[arrays.parents[idx]] + arrays.dist[idx]
+    return root_dist
+
+def optimise_alpha(arrays, values):
+    """
+    Maximise the profile likelihood of the Ornstein-Uhlenbeck model of each
+    trait on the selection strength: a log-spaced grid scaled by the tree
+    height, refined by a golden section search on log alpha.
+
+    Returns:
+    - (traits,) array of alpha
+    """
+    n_traits = values.shape[1]
+    height = _root_distances(arrays).max() or 1.
+    grid = np.geomspace(ALPHA_BOUNDS[0] / height, ALPHA_BOUNDS[1] / height, ALPHA_GRID)
+
+    def evaluate(log_alpha):
+        # log_alpha: (points, traits)
+        points = log_alpha.shape[0]
+        return _profile(arrays, np.tile(values, points), np.exp(log_alpha).ravel())[0].reshape(points, n_traits)
+
+    return np.exp(grid_golden_search(evaluate, np.log(grid), ALPHA_ITERATIONS, n_traits)[0])
+
+def fit_continuous(arrays, values, model='BM', sigma=None, alpha=None, theta=None):
+    """
+    Fit a Brownian motion or Ornstein-Uhlenbeck model to continuous traits and
+    reconstruct the ancestral values, in linear time in the tree size.
+
     Parameters:
-    - tree: Phylogenetic tree
-    - observed_traits: Observed trait values
+    - arrays: TreeArrays of the tree
+    - values: (nodes, traits) array of leaf values, NaN when missing
     - model: 'BM' or 'OU'
-    - sigma: Drift rate
-    - alpha: Selection strength (OU model only)
-    - theta: Optimal trait value (OU model only)
-    
+    - sigma: Drift rate, estimated if None
+    - alpha: Selection strength (OU model only), estimated if None
+    - theta: Optimal trait value (OU model only), estimated if None
+
     Returns:
-    - Annotated tree with estimated traits
-    - Results with node values and credible intervals
+    - dict with (nodes, traits) 'estimates' and 'variances' and (traits,)
+      'sigma2', 'alpha', 'theta' and 'log_likelihood'
     """
-    species = list(observed_traits.keys())
-    V = build_variance_covariance_matrix(tree, species, sigma, alpha, model)
-    Y = np.array([observed_traits[sp] for sp in species])
-
-    # Compute ML estimate for the root value
-    V_inv = np.linalg.inv(V)
-    ones = np.ones(len(species))
-    root_value = (ones @ V_inv @ Y) / (ones @ V_inv @ ones)
-    
-    results = {'root': {prop: root_value}}
-    print(f"Estimated ancestral {prop} value at the root ({model}-ML): {root_value:.2f}")
-
-    # Recursive estimation for internal nodes
-    def estimate_internal_states(node, parent_value):
-        if node.is_leaf:
-            node.add_prop(prop, observed_traits[node.name])
-            results[node.name] = {prop: observed_traits[node.name]}
-        else:
-            left_child, right_child = node.children
-            branch_length = node.dist if node.dist is not None else 1  # Ensure branch length is not None
-            
-            # Calculate expected value based on the model
-            expected_value = parent_value * np.exp(-alpha * branch_length) + theta * (1 - np.exp(-alpha * branch_length)) if model == 'OU' else parent_value
-            
-            # Estimate values for child nodes with noise based on branch length
-            left_child_value = expected_value + np.random.normal(0, np.sqrt(branch_length) if branch_length > 0 else 0)
-            right_child_value = expected_value + np.random.normal(0, np.sqrt(branch_length) if branch_length > 0 else 0)
+    n_traits = values.shape[1]
+    n_obs = (~np.isnan(values) & arrays.is_leaf[:, None]).sum(axis=0)
+    if model == 'BM':
+        alpha = np.zeros(n_traits)
+        theta = np.zeros(n_traits)
+    elif model == 'OU':
+        alpha = optimise_alpha(arrays, values) if alpha is None else np.full(n_traits, float(alpha))
+        theta = _profile(arrays, values, alpha)[1] if theta is None else np.full(n_traits, float(theta))
+    else:
+        raise ValueError(f"Unsupported model {model}, choose from BM and OU.")
+
+    mean, var, msg_mean, msg_prec, quad, logdet = prune(arrays, values, alpha, theta)
+    root_quad, root_logdet, root_mean, root_var = _root_prior(mean, var, alpha, theta)
+    quad += root_quad
+    logdet += root_logdet
+    sigma2 = quad / n_obs if sigma is None else np.full(n_traits, float(sigma) ** 2)
+    log_likelihood = -0.5 * (n_obs * np.log(2 * np.pi * sigma2) + logdet + quad / sigma2)
+    estimates, variances = smooth(arrays, mean, var, msg_mean, msg_prec, alpha, theta, root_mean, root_var)
+    return {
+        'estimates': estimates,
+        'variances': variances * sigma2,
+        'sigma2': sigma2,
+        'alpha': alpha,
+        'theta': theta,
+        'log_likelihood': log_likelihood,
+    }
+
+def _lambda_dist(arrays, lambdas, root_dist):
+    """
+    Branch lengths of Pagel's lambda transformation, one column per lambda:
+    internal branches are scaled by lambda and the leaf branches extended so
+    that the root-to-leaf distances are kept.
+    """
+    dist = arrays.dist[:, np.newaxis] * lambdas
+    leaves = np.flatnonzero(arrays.is_leaf)
+    dist[leaves] = arrays.dist[leaves, np.newaxis] + (1 - lambdas) * root_dist[arrays.parents[leaves], np.newaxis]
+    return dist
+
+def _bm_profile(arrays, values, dist=None):
+    """
+    Profile log-likelihood of Brownian motion, with the root value and the
+    drift rate at their ML estimates.
+
+    Returns:
+    - log_likelihood: (traits,) array
+    - mean, var, quad: outputs of prune() with unit drift rate
+    """
+    n_traits = values.shape[1]
+    n_obs = (~np.isnan(values) & arrays.is_leaf[:, None]).sum(axis=0)
+    mean, var, _, _, quad, logdet = prune(arrays, values, np.zeros(n_traits), np.zeros(n_traits), dist)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_likelihood = -0.5 * (n_obs * np.log(2 * np.pi * quad / n_obs) + logdet + np.log(var[0]) + n_obs)
+    return log_likelihood, mean, var, quad
+
+def pagel_lambda(arrays, values):
+    """
+    ML estimate of Pagel's lambda in [0, 1] of each trait: a grid refined by
+    a golden section search, each likelihood evaluation is a pruning pass.
+
+    Parameters:
+    - arrays: TreeArrays of the tree
+    - values: (nodes, traits) array of leaf values, NaN when missing
+
+    Returns:
+    - lambdas: (traits,) array
+    - log_likelihood: (traits,) log-likelihood at lambda
+    """
+    n_traits = values.shape[1]
+    root_dist = _root_distances(arrays)
+
+    def evaluate(lambdas):
+        # lambdas: (points, traits)
+        points = lambdas.shape[0]
+        dist = _lambda_dist(arrays, lambdas.ravel(), root_dist)
+        return _bm_profile(arrays, np.tile(values, points), dist)[0].reshape(points, n_traits)
+
+    return grid_golden_search(evaluate, np.linspace(0, 1, LAMBDA_GRID), LAMBDA_ITERATIONS, n_traits)
+
+def blomberg_k(arrays, values):
+    """
+    Blomberg's K of each trait: the ratio of the mean squared error of the
+    leaf values around the phylogenetic mean to the one given the
+    variance-covariance matrix C, divided by its expectation under Brownian
+    motion (tr(C) - n / (1' C^-1 1)) / (n - 1). All the terms come from one
+    pruning pass.
 
-            # Assign the estimated trait to the current node
-            node.add_prop(prop, expected_value)
-            results[node.name or 'Unnamed'] = {prop: expected_value}
+    Parameters:
+    - arrays: TreeArrays of the tree
+    - values: (nodes, traits) array of leaf values, NaN when missing
 
-            # Recurse to estimate states for children nodes
-            estimate_internal_states(left_child, left_child_value)
-            estimate_internal_states(right_child, right_child_value)
+    Returns:
+    - (traits,) array of K
+    """
+    observed = ~np.isnan(values) & arrays.is_leaf[:, None]
+    n_obs = observed.sum(axis=0)
+    _, mean, var, quad = _bm_profile(arrays, values)
+    root_dist = _root_distances(arrays)
+    mse0 = np.where(observed, values - mean[0], 0.) ** 2
+    expected = ((observed * root_dist[:, None]).sum(axis=0) - n_obs * var[0]) / (n_obs - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return mse0.sum(axis=0) / quad / expected
 
-    estimate_internal_states(tree, root_value)
-    return tree, results
+def _fixed_root_terms(arrays, values, alpha):
+    """
+    Sufficient statistics of the likelihood of the leaves given the root value,
+    the optimum theta and the drift rate. With unit drift rate the subtree
+    kernel of the root is C(theta) * N(root; M(theta), V), with M affine and
+    log C quadratic in theta, so three pruning passes (batched as extra
+    columns) give the likelihood of any parameter values in constant time.
 
+    Returns:
+    - terms: dict of (traits,) arrays
+    - pruned: outputs of prune() for theta 0, 1 and -1, stacked on the columns
+    """
+    n_traits = values.shape[1]
+    thetas = np.repeat([0., 1., -1.], n_traits)
+    pruned = prune(arrays, np.tile(values, 3), np.tile(alpha, 3), thetas)
+    mean, var, _, _, quad, logdet = pruned
+    quad = quad.reshape(3, n_traits)
+    root_mean = mean[0].reshape(3, n_traits)
+    terms = {
+        'n': (~np.isnan(values) & arrays.is_leaf[:, None]).sum(axis=0),
+        'logdet': logdet[:n_traits] + np.log(var[0, :n_traits]),
+        'var': var[0, :n_traits],
+        'mean': root_mean[0],
+        'mean_theta': root_mean[1] - root_mean[0],
+        'quad': quad[0],
+        'quad_theta': (quad[1] - quad[2]) / 2,
+        'quad_theta2': (quad[1] + quad[2]) / 2 - quad[0],
+    }
+    return terms, pruned[:4]
 
+def _node_coefficients(arrays, alpha, pruned, n_traits):
+    """
+    Conditional distribution of every node given the leaves, the root value r
+    and the optimum theta: the mean is A + B * r + C * theta and the variance
+    W times the drift rate, from three top-down passes with a fixed root.
 
-def by_acr(tree, prop, observed_traits, model='BM', sigma_prior=10, sigma_drift=5.0, alpha=None, theta=None):
+    Returns:
+    - A, B, C, W: (nodes, traits) arrays
+    """
+    blocks = np.r_[0:n_traits, 0:n_traits, n_traits:2 * n_traits]
+    roots = np.repeat([0., 1., 0.], n_traits)
+    thetas = np.repeat([0., 0., 1.], n_traits)
+    estimates, variances = smooth(arrays, *(x[:, blocks] for x in pruned),
+        np.tile(alpha, 3), thetas, roots, np.zeros(3 * n_traits))
+    estimates = estimates.reshape(-1, 3, n_traits)
+    return estimates[:, 0], estimates[:, 1] - estimates[:, 0], estimates[:, 2] - estimates[:, 0], \
+        variances[:, :n_traits]
+
+def by_acr(tree, prop, observed_traits, model='BM', sigma_prior=10, sigma_drift=5.0, alpha=None, theta=None,
+           draws=2000, tune=1000, cores=1, seed=None, verbose=False):
     """
     Bayesian Inference Ancestral Character Reconstruction using PyMC.
-    
+
     Parameters:
     - tree: Phylogenetic tree
-    - observed_traits: Observed trait values
-    - model: 'BM' or 'OU'
-    - sigma_prior: Prior standard deviation
-    - sigma_drift: Drift rate
-    - alpha: Selection strength (OU model only)
-    - theta: Optimal trait value (OU model only)
-    
+    - prop: name of the trait
+    - observed_traits: Observed trait values by leaf name
+    - model, sigma_prior, sigma_drift, alpha, theta, draws, tune, cores, seed, verbose: see by_acr_traits
+
     Returns:
     - Annotated tree with estimated traits and credible intervals
     - Results with node values and credible intervals
     """
-    species = list(observed_traits.keys())
-    Y = np.array([observed_traits[sp] for sp in species])
-    
-    # Build the variance-covariance matrix
-    V = build_variance_covariance_matrix(tree, species, sigma_drift, alpha, model)
-
-    # Ensure V is a proper float64 NumPy array
-    V = np.array(V, dtype=np.float64)
-
-    with pm.Model() as bayesian_model:
-        # Define priors for root_value
-        root_value = pm.Normal('root_value', mu=theta if model == 'OU' else 30, sigma=sigma_prior)
-        
-        # Use Data within the model context
-        V_tensor = pm.Data("V", V)
-
-        # Define the likelihood based on the multivariate normal distribution
-        pm.MvNormal('Y', mu=root_value, cov=V_tensor, observed=Y)
-
-        # Perform sampling
-        trace = pm.sample(2000, tune=1000)
-    
-    # Extract the root_value samples
-    root_samples = trace.posterior['root_value'].values.flatten()
-
-    mean_value = np.mean(root_samples)
-    lower_bound = np.percentile(root_samples, 2.5)
-    upper_bound = np.percentile(root_samples, 97.5)
-    
-    results = {'root': {prop: mean_value, 'credible_interval': (lower_bound, upper_bound)}}
-    root_node = tree
-    root_node.add_prop(prop, mean_value)
-
-    print(f"Root node ({model}-Bayesian): Estimated Trait = {mean_value:.2f}, 95% CI = [{lower_bound:.2f}, {upper_bound:.2f}]")
-
-    # Recursive estimation for internal nodes
-    def infer_ancestral_state(node, parent_samples, sigma):
-        if node.is_leaf:
-            node.add_prop(prop, observed_traits[node.name])
-            results[node.name] = {prop: observed_traits[node.name]}
-            return np.array([observed_traits[node.name]] * len(parent_samples))
-        else:
-            branch_length = node.dist
-            node_samples = parent_samples + np.random.normal(0, np.sqrt(sigma ** 2 * branch_length), len(parent_samples))
-            mean_value = np.mean(node_samples)
-            lower_bound = np.percentile(node_samples, 2.5)
-            upper_bound = np.percentile(node_samples, 97.5)
+    tree, prop2results = by_acr_traits(tree, {prop: observed_traits}, model=model,
+        sigma_prior=sigma_prior, sigma_drift=sigma_drift, alpha=alpha, theta=theta,
+        draws=draws, tune=tune, cores=cores, seed=seed, verbose=verbose)
+    return tree, prop2results[prop]
+
+def by_acr_traits(tree, prop2traits, model='BM', sigma_prior=10, sigma_drift=5.0, alpha=None, theta=None,
+                  draws=2000, tune=1000, cores=1, seed=None, verbose=False):
+    """
+    Bayesian Inference Ancestral Character Reconstruction of several traits
+    sampled in one PyMC model. The likelihood of the leaves is the pruning
+    likelihood reduced to sufficient statistics, so each gradient evaluation
+    costs constant time whatever the tree size; the node values are drawn
+    from their conditional distribution given each posterior sample.
+
+    Parameters:
+    - tree: Phylogenetic tree
+    - prop2traits: dict of trait name to observed trait values by leaf name
+    - model: 'BM' or 'OU'
+    - sigma_prior: Prior standard deviation of the root value (and of theta for OU)
+    - sigma_drift: Prior scale of the half-normal drift rate
+    - alpha: Selection strength (OU model only), ML estimate if None
+    - theta: Optimal trait value (OU model only), sampled if None
+    - draws, tune: samples kept and tuning samples of each chain
+    - cores: number of chains sampled in parallel
+    - seed: random seed of the sampler and of the node draws
+    - verbose: show the progress bar and the sampler messages
+
+    Returns:
+    - Annotated tree with estimated traits and credible intervals
+    - dict of trait name to results with node values and credible intervals
+    """
+    props = list(prop2traits)
+    n_traits = len(props)
+    arrays = TreeArrays(tree)
+    values = np.array([[prop2traits[prop].get(node.name, np.nan) if leaf else np.nan for prop in props]
+        for node, leaf in zip(arrays.nodes, arrays.is_leaf)], dtype=float)
+    tip_mean = np.nanmean(np.where(arrays.is_leaf[:, None], values, np.nan), axis=0)
 
-            node.add_prop(prop, mean_value)
-            results[node.name] = {prop: mean_value, 'credible_interval': (lower_bound, upper_bound)}
+    if model == 'BM':
+        alpha = np.zeros(n_traits)
+    elif model == 'OU':
+        alpha = optimise_alpha(arrays, values) if alpha is None else np.full(n_traits, float(alpha))
+    else:
+        raise ValueError(f"Unsupported model {model}, choose from BM and OU.")
+    terms, pruned = _fixed_root_terms(arrays, values, alpha)
 
-            print(f"Internal node {node.name or 'Unnamed'}: Estimated Trait = {mean_value:.2f}, 95% CI = [{lower_bound:.2f}, {upper_bound:.2f}]")
+    with pm.Model():
+        root_value = pm.Normal('root_value', mu=tip_mean, sigma=sigma_prior, shape=n_traits)
+        drift = pm.HalfNormal('sigma', sigma=sigma_drift, shape=n_traits)
+        if model == 'OU' and theta is None:
+            optimum = pm.Normal('theta', mu=tip_mean, sigma=sigma_prior, shape=n_traits)
+        else:
+            optimum = np.full(n_traits, 0. if model == 'BM' else float(theta))
+        sigma2 = drift ** 2
+        quad = terms['quad'] + terms['quad_theta'] * optimum + terms['quad_theta2'] * optimum ** 2
+        deviation = root_value - terms['mean'] - terms['mean_theta'] * optimum
+        pm.Potential('tree_likelihood', -0.5 * pt.sum(terms['n'] * pt.log(2 * np.pi * sigma2)
+            + terms['logdet'] + (quad + deviation ** 2 / terms['var']) / sigma2))
 
-            for child in node.children:
-                infer_ancestral_state(child, node_samples, sigma)
+        pymc_logger = logging.getLogger('pymc')
+        level = pymc_logger.level
+        if not verbose:
+            pymc_logger.setLevel(logging.WARNING)
+        try:
+            trace = pm.sample(draws, tune=tune, cores=max(cores, 1), random_seed=seed, progressbar=verbose)
+        finally:
+            pymc_logger.setLevel(level)
 
-    for child in root_node.children:
-        infer_ancestral_state(child, root_samples, sigma_drift)
+    posterior = trace.posterior
+    samples = {name: posterior[name].values.reshape(-1, n_traits) for name in ('root_value', 'sigma')}
+    samples['theta'] = posterior['theta'].values.reshape(-1, n_traits) if 'theta' in posterior \
+        else np.broadcast_to(optimum, samples['sigma'].shape)
+    # thin the posterior samples used to draw the node values
+    rng = np.random.default_rng(seed)
+    keep = rng.choice(len(samples['sigma']), min(NODE_DRAWS, len(samples['sigma'])), replace=False)
 
-    return tree, results
+    A, B, C, W = _node_coefficients(arrays, alpha, pruned, n_traits)
+    # internal nodes and leaves missing the value of at least one trait
+    observed = arrays.is_leaf[:, None] & ~np.isnan(values)
+    reconstructed = np.flatnonzero(~observed.all(axis=1))
+    prop2results = {}
+    for t, prop in enumerate(props):
+        root_draws, theta_draws = samples['root_value'][keep, t], samples['theta'][keep, t]
+        # the node summaries are marginal, so the nodes can share the normal deviates
+        noise = samples['sigma'][keep, t] * rng.standard_normal(len(keep))
+        results = {
+            'model': model,
+            'sigma2': (samples['sigma'][:, t] ** 2).mean(),
+            'alpha': alpha[t],
+            'theta': samples['theta'][:, t].mean(),
+        }
+        for i, node in enumerate(arrays.nodes):
+            if observed[i, t]:
+                node.add_prop(prop, values[i, t])
+                results[node.name] = {prop: values[i, t]}
+        for start in range(0, len(reconstructed), NODE_CHUNK):
+            chunk = reconstructed[start:start + NODE_CHUNK]
+            chunk = chunk[~observed[chunk, t]]
+            node_draws = A[chunk, t, None] + B[chunk, t, None] * root_draws + C[chunk, t, None] * theta_draws \
+                + np.sqrt(W[chunk, t, None]) * noise
+            node_means = node_draws.mean(axis=1)
+            lower, upper = np.percentile(node_draws, [2.5, 97.5], axis=1)
+            for i, mean_value, low, high in zip(chunk, node_means, lower, upper):
+                node = arrays.nodes[i]
+                node.add_prop(prop, mean_value)
+                node.add_prop(add_suffix(prop, 'ci_lower'), low)
+                node.add_prop(add_suffix(prop, 'ci_upper'), high)
+                name = 'root' if not i else (node.name or 'Unnamed')
+                results[name] = {prop: mean_value, 'credible_interval': (low, high)}
+        root = results['root']
+        logger.info(f"Root node {prop} ({model}-Bayesian): Estimated Trait = {root[prop]:.2f}, "
+            f"95% CI = [{root['credible_interval'][0]:.2f}, {root['credible_interval'][1]:.2f}]")
+        prop2results[prop] = results
+    return tree, prop2results
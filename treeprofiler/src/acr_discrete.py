@@ -0,0 +1,575 @@
+import numpy as np
+import pandas as pd
+
+from pastml import METHOD, STATES, CHARACTER, NUM_SCENARIOS, NUM_UNRESOLVED_NODES, \
+    NUM_STATES_PER_NODE, PERC_UNRESOLVED
+from pastml.annotation import ForestStats
+from pastml.ml import LOG_LIKELIHOOD, MARGINAL_PROBABILITIES, MPPA, MAP
+from pastml.models import MODEL
+from pastml.models.F81Model import F81Model
+from pastml.models.JCModel import JCModel
+from pastml.models.EFTModel import EFTModel
+
+# prediction methods of the batched engine and the pastml state selection they apply
+BATCH_METHODS = {'BATCH_MPPA': MPPA, 'BATCH_MAP': MAP}
+BATCH_MODELS = ['JC', 'F81', 'EFT']
+
+# bounds of the scaling factor relative to the average non-zero branch length, as in pastml
+SF_BOUNDS = (0.001, 10.)
+SF_GRID = 13
+SF_ITERATIONS = 30
+
+class TreeArrays(object):
+    """
+    Node arrays of a tree: the nodes in preorder, the parent index, children
+    and branch length of each node, and the node indices grouped by height
+    (for the bottom-up pass) and by depth (for the top-down pass). The pastml
+    statistics of the tree are computed on first use of stats.
+    """
+    def __init__(self, tree):
+        self.nodes = list(tree.traverse('preorder'))
+        node2index = {node: i for i, node in enumerate(self.nodes)}
+        n = len(self.nodes)
+        self.parents = np.full(n, -1, dtype=int)
+        self.dist = np.zeros(n)
+        self.is_leaf = np.array([node.is_leaf for node in self.nodes])
+        self.children = [[] for _ in range(n)]
+        depth = np.zeros(n, dtype=int)
+        for i, node in enumerate(self.nodes):
+            if i:
+                self.parents[i] = node2index[node.up]
+                self.children[self.parents[i]].append(i)
+                self.dist[i] = node.dist or 0
+                depth[i] = depth[self.parents[i]] + 1
+
+        height = np.zeros(n, dtype=int)
+        for i in range(n - 1, 0, -1):
+            p = self.parents[i]
+            height[p] = max(height[p], height[i] + 1)
+        self.up_levels = _group_by(height)
+        self.down_levels = _group_by(depth)[1:]
+
+        # clusters of nodes connected by zero-length branches
+        cluster = np.arange(n)
+        for i in range(1, n):
+            if self.dist[i] == 0:
+                cluster[i] = cluster[self.parents[i]]
+        self.zero_clusters = [idx for idx in _group_by(cluster) if len(idx) > 1]
+
+        self.tree = tree
+        self._stats = None
+
+    @property
+    def stats(self):
+        # pastml tree statistics, only needed by the discrete models
+        if self._stats is None:
+            self._stats = ForestStats([self.tree])
+        return self._stats
+
+def _group_by(values):
+    order = np.argsort(values, kind='stable')
+    bounds = np.flatnonzero(np.diff(values[order])) + 1
+    return np.split(order, bounds)
+
+def load_allowed_states(arrays, columns, states):
+    """
+    Build the allowed states of the traits sharing the same number of states.
+
+    Parameters:
+    - arrays: TreeArrays of the tree
+    - columns: list of trait names
+    - states: list of the state arrays of the traits
+
+    Returns:
+    - allowed: (nodes, traits, states) array, all ones for nodes without observed state
+    - observed: (nodes, traits) boolean array of the nodes with observed state
+    """
+    n_states = len(states[0])
+    allowed = np.ones((len(arrays.nodes), len(columns), n_states))
+    observed = np.zeros((len(arrays.nodes), len(columns)), dtype=bool)
+    for t, (column, trait_states) in enumerate(zip(columns, states)):
+        state2index = {state: i for i, state in enumerate(trait_states)}
+        for i, node in enumerate(arrays.nodes):
+            value = node.props.get(column)
+            if value is None or value == '':
+                continue
+            value = {value} if isinstance(value, str) else set(value)
+            indices = [state2index[state] for state in value if state in state2index]
+            if indices:
+                allowed[i, t] = 0
+                allowed[i, t, indices] = 1
+                observed[i, t] = True
+    return allowed, observed
+
+def alter_zero_clusters(arrays, allowed, observed):
+    """
+    Replace the states of the observed nodes of a zero-length branch cluster
+    by their union when they do not share a common state, as pastml does.
+    """
+    altered = allowed.copy()
+    for idx in arrays.zero_clusters:
+        member = observed[idx]
+        n_observed = member.sum(axis=0)
+        counts = (allowed[idx] * member[:, :, np.newaxis]).sum(axis=0)
+        conflict = (n_observed > 1) & (counts.max(axis=-1) < n_observed)
+        if conflict.any():
+            union = (counts > 0).astype(float)
+            change = member & conflict[np.newaxis, :]
+            altered[idx] = np.where(change[:, :, np.newaxis], union[np.newaxis], allowed[idx])
+    return altered
+
+def _transition(e, freqs, likelihoods):
+    """
+    Apply the F81 transition probabilities P(t) = exp(-mu t) I + (1 - exp(-mu t)) pi
+    to the likelihood arrays of a batch of nodes.
+    """
+    e = e[:, :, np.newaxis]
+    return e * likelihoods + (1 - e) * (likelihoods * freqs).sum(axis=-1, keepdims=True)
+
+def bottom_up(arrays, allowed, freqs, rate, joint=False):
+    """
+    Felsenstein pruning of all the traits at once, level by level from the tips.
+
+    Parameters:
+    - arrays: TreeArrays of the tree
+    - allowed: (nodes, traits, states) allowed state array
+    - freqs: (traits, states) equilibrium frequencies
+    - rate: (traits,) mutation rate times the scaling factor
+    - joint: maximise instead of summing over the child states
+
+    Returns:
+    - log_likelihood: (traits,) log-likelihood of each trait
+    - likelihoods: (nodes, traits, states) bottom-up likelihoods rescaled to max 1
+    - contributions: (nodes, traits, states) likelihood passed by each node to its parent
+    - joint_states: (nodes, traits, states) best node state given the parent state, if joint
+    """
+    n, n_traits, n_states = allowed.shape
+    with np.errstate(divide='ignore'):
+        log_lh = np.log(allowed)
+    likelihoods = np.empty_like(allowed)
+    contributions = np.ones_like(allowed)
+    scale = np.zeros((n, n_traits))
+    joint_states = np.zeros(allowed.shape, dtype=int) if joint else None
+    state_range = np.arange(n_states)
+
+    for idx in arrays.up_levels:
+        factor = log_lh[idx].max(axis=-1)
+        factor = np.where(np.isfinite(factor), factor, 0)
+        lh = np.exp(log_lh[idx] - factor[:, :, np.newaxis])
+        likelihoods[idx] = lh
+        scale[idx] += factor
+
+        idx = idx[idx > 0]
+        if not len(idx):
+            continue
+        lh = likelihoods[idx]
+        e = np.exp(-np.outer(arrays.dist[idx], rate))
+        if joint:
+            # the child keeps the parent state i, or changes to the best state j
+            stay = (e[:, :, np.newaxis] + (1 - e[:, :, np.newaxis]) * freqs) * lh
+            change = (1 - e[:, :, np.newaxis]) * freqs * lh
+            order = np.argsort(-change, axis=-1, kind='stable')
+            best, second = order[..., :1], order[..., 1:2] if n_states > 1 else order[..., :1]
+            # the best change excluding the parent state itself
+            other = np.where(state_range == best, second, best)
+            other_value = np.take_along_axis(change, other, axis=-1)
+            contribution = np.maximum(stay, other_value)
+            joint_states[idx] = np.where((stay > other_value) | ((stay == other_value) & (state_range < other)),
+                                         state_range, other)
+        else:
+            contribution = _transition(e, freqs, lh)
+        contribution = np.maximum(contribution, 0)
+        contributions[idx] = contribution
+        with np.errstate(divide='ignore'):
+            np.add.at(log_lh, arrays.parents[idx], np.log(contribution))
+        np.add.at(scale, arrays.parents[idx], scale[idx])
+
+    root = (likelihoods[0] * freqs)
+    root = root.max(axis=-1) if joint else root.sum(axis=-1)
+    with np.errstate(divide='ignore'):
+        log_likelihood = np.log(root) + scale[0]
+    return log_likelihood, likelihoods, contributions, joint_states
+
+def top_down(arrays, likelihoods, contributions, freqs, rate):
+    """
+    Top-down likelihoods of all the traits at once, level by level from the root.
+    Each node array is rescaled to max 1, as only the marginal probabilities are needed.
+    """
+    td = np.ones_like(likelihoods)
+    for idx in arrays.down_levels:
+        parents = arrays.parents[idx]
+        contribution = contributions[idx]
+        contribution = np.where(contribution <= 0, 1, contribution)
+        up = td[parents] * likelihoods[parents] / contribution
+        factor = up.max(axis=-1, keepdims=True)
+        up = up / np.where(factor > 0, factor, 1)
+        e = np.exp(-np.outer(arrays.dist[idx], rate))
+        td[idx] = np.maximum(_transition(e, freqs, up), 0)
+    return td
+
+def marginal_probabilities(arrays, allowed, freqs, rate):
+    """
+    Marginal probabilities of the states of all the traits at once, from one
+    bottom-up and one top-down pass.
+
+    Returns:
+    - (nodes, traits, states) array of marginal probabilities
+    """
+    _, bu, contributions, _ = bottom_up(arrays, allowed, freqs, rate)
+    td = top_down(arrays, bu, contributions, freqs, rate)
+    marginal = bu * td * freqs * allowed
+    marginal /= marginal.sum(axis=-1, keepdims=True)
+    return marginal
+
+def model_parameters(acr_result):
+    """
+    States, equilibrium frequencies and rate of a trait from the F81-like
+    model of its acr result, from pastml or from the batched engine.
+    """
+    model = acr_result[MODEL]
+    freqs = np.asarray(model.frequencies, dtype=float)
+    with np.errstate(divide='ignore'):
+        mu = 1. / (1. - (freqs ** 2).sum())
+    mu = mu if np.isfinite(mu) else 0
+    return np.asarray(acr_result[STATES]), freqs, model.sf * mu
+
+def fixed_marginals(arrays, column2params):
+    """
+    Marginal probabilities of discrete traits with fixed model parameters,
+    without optimising the scaling factor, batched over the traits sharing
+    the same number of states.
+
+    Parameters:
+    - arrays: TreeArrays of the tree annotated with the traits
+    - column2params: dict of trait name to (states, frequencies, rate), see model_parameters
+
+    Returns:
+    - dict of trait name to the (nodes, states) array of marginal probabilities
+    """
+    n2columns = {}
+    for column, (states, _, _) in column2params.items():
+        n2columns.setdefault(len(states), []).append(column)
+
+    column2marginals = {}
+    for columns in n2columns.values():
+        states = [column2params[column][0] for column in columns]
+        freqs = np.array([column2params[column][1] for column in columns])
+        rate = np.array([column2params[column][2] for column in columns])
+        allowed, observed = load_allowed_states(arrays, columns, states)
+        altered = alter_zero_clusters(arrays, allowed, observed)
+        marginal = marginal_probabilities(arrays, altered, freqs, rate)
+        for t, column in enumerate(columns):
+            column2marginals[column] = marginal[:, t]
+    return column2marginals
+
+def grid_golden_search(evaluate, grid, iterations, n_traits):
+    """
+    Maximise evaluate for each trait: a grid of points, refined by a golden
+    section search between the neighbours of the best grid point. Traits and
+    points are evaluated in the same passes.
+
+    Parameters:
+    - evaluate: function of a (points, traits) array returning the (points, traits) objective
+    - grid: (points,) increasing array
+    - iterations: number of golden section steps
+    - n_traits: number of traits
+
+    Returns:
+    - (traits,) array of maximising points
+    - (traits,) array of objective values
+    """
+    def objective(x):
+        f = evaluate(x)
+        return np.where(np.isnan(f), -np.inf, f)
+
+    ll = objective(np.repeat(grid[:, np.newaxis], n_traits, axis=1))
+    best = ll.argmax(axis=0)
+    a = grid[np.maximum(best - 1, 0)]
+    b = grid[np.minimum(best + 1, len(grid) - 1)]
+    best_x, best_ll = grid[best], ll[best, np.arange(n_traits)]
+
+    ratio = (np.sqrt(5) - 1) / 2
+    c, d = b - ratio * (b - a), a + ratio * (b - a)
+    fc, fd = objective(np.vstack([c, d]))
+    for _ in range(iterations):
+        left = fc >= fd
+        b = np.where(left, d, b)
+        a = np.where(left, a, c)
+        new = np.where(left, b - ratio * (b - a), a + ratio * (b - a))
+        fnew = objective(new[np.newaxis])[0]
+        c, d, fc, fd = np.where(left, new, d), np.where(left, c, new), \
+            np.where(left, fnew, fd), np.where(left, fc, fnew)
+
+    x = np.where(fc >= fd, c, d)
+    fx = np.maximum(fc, fd)
+    better = fx > best_ll
+    return np.where(better, x, best_x), np.where(better, fx, best_ll)
+
+def optimise_scaling_factor(arrays, allowed, freqs, mu):
+    """
+    Maximise the likelihood of each trait on the scaling factor of the branch
+    lengths: a log-spaced grid over the pastml bounds, refined by a golden
+    section search on log sf.
+
+    Returns:
+    - sf: (traits,) scaling factors
+    - log_likelihood: (traits,) log-likelihoods at sf
+    """
+    n_traits = len(mu)
+    avg = arrays.stats.avg_nonzero_brlen or 1.
+    grid = np.geomspace(SF_BOUNDS[0] / avg, SF_BOUNDS[1] / avg, SF_GRID)
+
+    def evaluate(log_sf):
+        # log_sf: (points, traits)
+        points = log_sf.shape[0]
+        tiled = np.tile(allowed, (1, points, 1))
+        ll, _, _, _ = bottom_up(arrays, tiled, np.tile(freqs, (points, 1)), (np.exp(log_sf) * mu).ravel())
+        return ll.reshape(points, n_traits)
+
+    log_sf, log_likelihood = grid_golden_search(evaluate, np.log(grid), SF_ITERATIONS, n_traits)
+    return np.exp(log_sf), log_likelihood
+
+def select_states_mppa(probs, joint_index):
+    """
+    Choose the number of states of each node minimising the Brier score
+    of the marginal probabilities, with the joint state forced, as pastml MPPA.
+
+    Returns:
+    - (nodes, traits, states) boolean array of the selected states
+    """
+    n_states = probs.shape[-1]
+    state_range = np.arange(n_states)
+    joint_prob = np.take_along_axis(probs, joint_index[..., np.newaxis], axis=-1)
+    others = np.where(state_range == joint_index[..., np.newaxis], np.inf, probs)
+    others = np.sort(others, axis=-1)[..., :-1]
+    ordered = np.concatenate([others, joint_prob], axis=-1)
+    # |(0, ..., 1/k, ..., 1/k) - p|^2 = sum(p^2) - 2 / k * sum(top k p) + 1 / k
+    k = state_range + 1
+    top_k = np.cumsum(ordered[..., ::-1], axis=-1)
+    correction = (ordered ** 2).sum(axis=-1, keepdims=True) - 2 / k * top_k + 1 / k
+    best_k = correction.argmin(axis=-1) + 1
+    rank = np.argsort(np.argsort(-probs, axis=-1, kind='stable'), axis=-1, kind='stable')
+    return rank < best_k[..., np.newaxis]
+
+def batch_acr(tree, column2states, prediction_method='BATCH_MPPA', model='F81'):
+    """
+    Marginal likelihood ACR of many discrete traits under the JC or F81 model,
+    computed with numpy arrays batched over the traits sharing the same number of states.
+
+    The frequencies are uniform for JC and the observed ones for F81 and EFT,
+    and the branch scaling factor of each trait is optimised.
+    The reconstructed states are set to the nodes as pastml does.
+
+    Parameters:
+    - tree: Phylogenetic tree annotated with the traits
+    - column2states: dict of trait name to the array of its states
+    - prediction_method: 'BATCH_MPPA' or 'BATCH_MAP'
+    - model: 'JC', 'F81' or 'EFT'
+
+    Returns:
+    - dict of trait name to the pastml-like acr result list
+    """
+    method = BATCH_METHODS[prediction_method]
+    arrays = TreeArrays(tree)
+    names = [node.name for node in arrays.nodes]
+    prop2acr = {}
+
+    n2columns = {}
+    for column, states in column2states.items():
+        n2columns.setdefault(len(states), []).append(column)
+
+    for n_states, columns in n2columns.items():
+        states = [column2states[column] for column in columns]
+        allowed, observed = load_allowed_states(arrays, columns, states)
+        if model == 'JC':
+            freqs = np.full((len(columns), n_states), 1. / n_states)
+        else:
+            # observed frequencies of the tips
+            tips = observed & arrays.is_leaf[:, np.newaxis]
+            counts = allowed[tips] / allowed[tips].sum(axis=-1, keepdims=True)
+            freqs = np.zeros((len(columns), n_states))
+            np.add.at(freqs, np.nonzero(tips)[1], counts)
+            freqs = np.maximum(freqs / freqs.sum(axis=-1, keepdims=True), 1e-10)
+            freqs /= freqs.sum(axis=-1, keepdims=True)
+        with np.errstate(divide='ignore'):
+            mu = 1. / (1. - (freqs ** 2).sum(axis=-1))
+        mu = np.where(np.isfinite(mu), mu, 0)
+
+        altered = alter_zero_clusters(arrays, allowed, observed)
+        sf, log_likelihood = optimise_scaling_factor(arrays, altered, freqs, mu)
+        for column, ll in zip(columns, log_likelihood):
+            if not np.isfinite(ll):
+                raise ValueError(f"Failed to calculate the likelihood of {column}, "
+                                 "please check that its states do not contradict on zero-length branches.")
+        rate = sf * mu
+
+        marginal = marginal_probabilities(arrays, altered, freqs, rate)
+        # altered nodes choose among their own states
+        chosen = marginal * allowed
+        chosen /= chosen.sum(axis=-1, keepdims=True)
+
+        if method == MPPA:
+            _, joint_bu, _, joint_states = bottom_up(arrays, altered, freqs, rate, joint=True)
+            first_allowed = allowed.argmax(axis=-1)[..., np.newaxis]
+            consistent = np.take_along_axis(allowed, joint_states, axis=-1) > 0
+            joint_states = np.where(consistent, joint_states, first_allowed)
+            joint_index = np.zeros(allowed.shape[:2], dtype=int)
+            joint_index[0] = (joint_bu[0] * freqs).argmax(axis=-1)
+            for idx in arrays.down_levels:
+                parent_states = joint_index[arrays.parents[idx]][..., np.newaxis]
+                joint_index[idx] = np.take_along_axis(joint_states[idx], parent_states, axis=-1)[..., 0]
+            selected = select_states_mppa(chosen, joint_index)
+        else:
+            selected = chosen.argmax(axis=-1)[..., np.newaxis] == np.arange(n_states)
+
+        for t, column in enumerate(columns):
+            trait_states = states[t]
+            for node, node_selected in zip(arrays.nodes, selected[:, t]):
+                node.add_prop(column, set(trait_states[node_selected]))
+            result = {
+                LOG_LIKELIHOOD: log_likelihood[t],
+                CHARACTER: column,
+                METHOD: method,
+                MODEL: get_model(model, trait_states, arrays.stats, sf[t], freqs[t]),
+                STATES: trait_states,
+                MARGINAL_PROBABILITIES: pd.DataFrame(marginal[:, t], index=names, columns=trait_states)
+            }
+            if method == MPPA:
+                n_selected = selected[:, t].sum(axis=-1)
+                n_nodes = len(arrays.nodes)
+                result[NUM_SCENARIOS] = int(np.prod(n_selected.astype(float)))
+                result[NUM_UNRESOLVED_NODES] = int((n_selected > 1).sum())
+                result[NUM_STATES_PER_NODE] = n_selected.sum() / n_nodes
+                result[PERC_UNRESOLVED] = result[NUM_UNRESOLVED_NODES] * 100 / n_nodes
+            prop2acr[column] = [result]
+    return prop2acr
+
+def get_model(model, states, forest_stats, sf, frequencies):
+    """
+    Fixed pastml model holding the parameters estimated by the batched engine,
+    so that the results are serialized as those of pastml.
+    """
+    if model == 'JC':
+        return JCModel(states=states, forest_stats=forest_stats, sf=sf)
+    if model == 'EFT':
+        return EFTModel(states=states, forest_stats=forest_stats, sf=sf, observed_frequencies=frequencies)
+    return F81Model(states=states, forest_stats=forest_stats, sf=sf, frequencies=frequencies)
+
+def pack_bits(bits, words):
+    """
+    Pack boolean columns (last axis) into little-endian uint64 words.
+    """
+    packed = np.packbits(bits, axis=-1, bitorder='little')
+    padding = words * 8 - packed.shape[-1]
+    if padding:
+        packed = np.concatenate([packed, np.zeros(packed.shape[:-1] + (padding,), dtype=np.uint8)], axis=-1)
+    return packed.view(np.uint64)
+
+def unpack_bits(words, n_columns):
+    """
+    Unpack uint64 words into boolean columns (last axis).
+    """
+    words = np.ascontiguousarray(words)
+    return np.unpackbits(words.view(np.uint8), axis=-1, bitorder='little')[..., :n_columns].astype(bool)
+
+def decode_bit_states(bitsets, n_columns):
+    """
+    State of each column from the hex encoded absent and present bit planes
+    of a node, 1 present, 0 absent and NaN when both are possible.
+    """
+    absent, present = (unpack_bits(np.frombuffer(bytes.fromhex(bits), dtype='<u8'), n_columns) for bits in bitsets)
+    return np.where(absent & present, np.nan, present.astype(float))
+
+def _count_bits(words, n_columns):
+    """
+    Number of nodes (first axis) with each column bit set, accumulated one
+    bit position at a time over the packed words, without unpacking them.
+    """
+    counts = np.empty((words.shape[-1], 64), dtype=np.int64)
+    for bit in range(64):
+        counts[:, bit] = ((words >> np.uint64(bit)) & np.uint64(1)).sum(axis=0)
+    return counts.reshape(-1)[:n_columns]
+
+def load_bit_states(arrays, leaf2values, n_columns):
+    """
+    Pack the presence/absence columns of the leaves into two bit planes, the
+    columns which can be absent (0) and present (1). Missing values and nodes
+    without values can be both.
+    """
+    words = (n_columns + 63) // 64
+    absent = np.full((len(arrays.nodes), words), ~np.uint64(0))
+    present = absent.copy()
+    for i in np.flatnonzero(arrays.is_leaf):
+        values = leaf2values.get(arrays.nodes[i].name)
+        if values is None:
+            continue
+        # short rows are missing the last columns
+        values = np.asarray(values, dtype=np.float64)[:n_columns]
+        values = np.pad(values, (0, n_columns - len(values)), constant_values=np.nan)
+        missing = np.isnan(values)
+        is_present = values > 0
+        present[i] = pack_bits(is_present | missing, words)
+        absent[i] = pack_bits(~is_present, words)
+    return absent, present
+
+def bitset_parsimony(arrays, absent, present, n_columns):
+    """
+    Fitch parsimony of many presence/absence columns at once, the state sets
+    of each node being two bit planes of uint64 words. The bottom-up pass
+    intersects the children sets, or takes their union when they do not
+    intersect, and the top-down pass resolves the sets with ACCTRAN, as
+    pastml DOWNPASS and ACCTRAN methods.
+
+    Parameters:
+    - arrays: TreeArrays of the tree
+    - absent, present: (nodes, words) bit planes of the leaf states
+    - n_columns: number of columns
+
+    Returns:
+    - absent, present: (nodes, words) bit planes of the ACCTRAN states
+    - steps: (columns,) number of state changes of each column
+    - gains, losses: (columns,) number of resolved 0 -> 1 and 1 -> 0 changes
+    """
+    absent, present = absent.copy(), present.copy()
+    steps = np.zeros(n_columns, dtype=int)
+    n_children = np.array([len(children) for children in arrays.children])
+    first = np.array([children[0] if children else 0 for children in arrays.children])
+    second = np.array([children[1] if len(children) > 1 else 0 for children in arrays.children])
+
+    for idx in arrays.up_levels[1:]:
+        # bifurcations, bitwise over all the columns
+        binary = idx[n_children[idx] == 2]
+        if len(binary):
+            c1, c2 = first[binary], second[binary]
+            both_absent = absent[c1] & absent[c2]
+            both_present = present[c1] & present[c2]
+            empty = ~(both_absent | both_present)
+            absent[binary] = both_absent | (empty & (absent[c1] | absent[c2]))
+            present[binary] = both_present | (empty & (present[c1] | present[c2]))
+            steps += _count_bits(empty, n_columns)
+
+        # other nodes keep the states of most of their children
+        for i in idx[n_children[idx] != 2]:
+            children = arrays.children[i]
+            n_absent = _count_bits(absent[children], n_columns)
+            n_present = _count_bits(present[children], n_columns)
+            words = absent.shape[1]
+            absent[i] = pack_bits(n_absent >= n_present, words)
+            present[i] = pack_bits(n_present >= n_absent, words)
+            steps += len(children) - np.maximum(n_absent, n_present)
+
+    # ACCTRAN: the states shared with the parent are kept
+    gains = np.zeros(n_columns, dtype=int)
+    losses = np.zeros(n_columns, dtype=int)
+    for idx in arrays.down_levels:
+        parents = arrays.parents[idx]
+        shared_absent = absent[parents] & absent[idx]
+        shared_present = present[parents] & present[idx]
+        empty = ~(shared_absent | shared_present)
+        absent[idx] = shared_absent | (empty & absent[idx])
+        present[idx] = shared_present | (empty & present[idx])
+        parent_absent, parent_present = absent[parents], present[parents]
+        node_absent, node_present = absent[idx], present[idx]
+        gains += _count_bits(parent_absent & ~parent_present & node_present & ~node_absent, n_columns)
+        losses += _count_bits(parent_present & ~parent_absent & node_absent & ~node_present, n_columns)
+    return absent, present, steps, gains, losses
@@ -5,8 +5,21 @@ import json
 import pickle
 import base64
 import gzip
+import contextlib
+import gc
+import struct
+import numbers
+import zlib
+from collections import deque
+from multiprocessing import Pool
+import numpy as np
 from ete4 import Tree
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 def pickle_pack(data):
     return base64.b64encode(pickle.dumps(data)).decode()
 
@@ -20,8 +33,7 @@ def b64gzip_unpack(data):
     return gzip.decompress(base64.b64decode(data))
 
 
-def dumps(t, encoder='pickle', pack=False):
-    OUT = io.StringIO()
+def _iter_records(t, encoder='pickle'):
     if encoder not in ['pickle', 'json']: 
         raise Exception("Invalid encoder")
 
@@ -38,19 +50,88 @@ def dumps(t, encoder='pickle', pack=False):
         elif encoder == 'pickle':
             packed_content = pickle_pack(n.props)
 
-        print('p', n.props['__id'], packed_content, sep='\t', file=OUT)
+        yield f"p\t{n.props['__id']}\t{packed_content}\n"
         
         if n.up: 
-            print('t', n.props['__id'], n.up.props['__id'], sep='\t', file=OUT)
+            yield f"t\t{n.props['__id']}\t{n.up.props['__id']}\n"
         else: 
-            print('t', n.props['__id'], '', sep='\t', file=OUT)
+            yield f"t\t{n.props['__id']}\t\n"
+
+def dumps(t, encoder='pickle', pack=False):
+    OUT = io.StringIO()
+    for record in _iter_records(t, encoder):
+        OUT.write(record)
 
     if pack: 
         return b64gzip_pack(OUT.getvalue())
     else: 
         return OUT.getvalue()
 
-def loads(INPUT, encoder='pickle', unpack=False):
+# compressed .ete content is detected by the magic bytes of each format
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+COMPRESSIONS = ['gzip', 'zstd']
+
+def _get_compressor(compression, level=None):
+    if compression == 'gzip':
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise Exception("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    raise Exception(f"Invalid compression {compression}")
+
+def dump(t, f, encoder='pickle', compression=None, level=None, buffer_size=2**20):
+    """
+    Streaming version of dumps, writing .ete content to a file handle.
+    Node records are written, and compressed, in blocks of buffer_size
+    characters, so the whole content is never held in memory.
+
+    Parameters:
+    - t: ete4 Tree
+    - f: file handle, text mode without compression, binary mode otherwise
+    - encoder: 'pickle' or 'json'
+    - compression: None, 'gzip' or 'zstd'
+    - level: compression level, the default of each compression if None
+    - buffer_size: number of characters written at once
+    """
+    compressor = _get_compressor(compression, level) if compression else None
+
+    def write(block):
+        if compressor is None:
+            f.write(block)
+        else:
+            f.write(compressor.compress(block.encode()))
+
+    buffer, size = [], 0
+    for record in _iter_records(t, encoder):
+        buffer.append(record)
+        size += len(record)
+        if size >= buffer_size:
+            write(''.join(buffer))
+            buffer, size = [], 0
+    write(''.join(buffer))
+    if compressor is not None:
+        f.write(compressor.flush())
+
+def open_ete(path):
+    """
+    Open a text .ete file for streaming with load, decompressing it on the
+    fly when it was written with gzip or zstd compression.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(len(ZSTD_MAGIC))
+    if head.startswith(GZIP_MAGIC):
+        return gzip.open(path, 'rt')
+    elif head.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise Exception("zstd compressed .ete requires the zstandard package")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')))
+    return open(path)
+
+def loads(INPUT, encoder='pickle', unpack=False, include_props=None):
+    # v1 stores the props of a node in one pickle, include_props only drops
+    # the other props after decoding; use .ete v2 to skip decoding them
     if unpack: 
         INPUT = b64gzip_unpack(INPUT).decode()
 
@@ -69,10 +150,407 @@ def loads(INPUT, encoder='pickle', unpack=False):
                 node.props = pickle_unpack(b)
             if encoder == 'json': 
                 node.props = json.loads(b)
+            if include_props is not None:
+                node.props = {k: v for k, v in node.props.items() if k in include_props}
         elif etype == 't': 
             if b: 
                 id2node[b].add_child(node)
                 node.up = id2node[b]
             else: 
                 root = node
-    return root
\ No newline at end of file
+    return root
+
+def _iter_b64gzip_lines(f, chunk_size=2**20):
+    # decode base64 and gunzip incrementally, keeping one chunk in memory
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    rest = ''
+    pending = b''
+    while True:
+        chunk = f.read(chunk_size)
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode()
+        if chunk:
+            chunk = rest + ''.join(chunk.split())
+            cut = len(chunk) - len(chunk) % 4
+            rest = chunk[cut:]
+            pending += decompressor.decompress(base64.b64decode(chunk[:cut]))
+        else:
+            pending += decompressor.decompress(base64.b64decode(rest)) + decompressor.flush()
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            yield line.decode()
+        if not chunk:
+            break
+    if pending:
+        yield pending.decode()
+
+def _decode_props(data, encoder='pickle', include_props=None):
+    props_list = []
+    for b in data:
+        if encoder == 'pickle':
+            props = pickle_unpack(b)
+        elif encoder == 'json':
+            props = json.loads(b)
+        if include_props is not None:
+            props = {k: v for k, v in props.items() if k in include_props}
+        props_list.append(props)
+    return props_list
+
+def load(f, encoder='pickle', unpack=False, include_props=None, threads=1, batch_size=5000):
+    """
+    Streaming version of loads, reading .ete content from a file handle.
+    Property lines are decoded in batches, by a pool of worker processes when
+    threads > 1, and at most two batches per worker are in flight, so peak
+    memory is the tree plus a few batches.
+
+    Parameters:
+    - f: file handle of the .ete content, text mode unless unpack
+    - encoder: 'pickle' or 'json'
+    - unpack: content was written with pack=True
+    - include_props: list of properties to keep, all of them if None
+    - threads: number of worker processes decoding property lines
+    - batch_size: number of property lines sent to a worker at once
+
+    Returns:
+    - ete4 Tree
+    """
+    if encoder not in ['pickle', 'json']: 
+        raise Exception("Invalid encoder")
+    if include_props is not None:
+        include_props = set(include_props)
+    lines = _iter_b64gzip_lines(f) if unpack else f
+
+    id2node = {}
+    root = None
+    batch_nodes, batch_data = [], []
+    in_flight = deque()
+    pool = None
+
+    def assign(nodes, props_list):
+        for node, props in zip(nodes, props_list):
+            node.props = props
+
+    def flush(last=False):
+        nonlocal pool, batch_nodes, batch_data
+        if not batch_data:
+            return
+        # small contents are decoded here, the pool starts with the second batch
+        if pool is None and threads > 1 and not last:
+            pool = Pool(threads)
+        if pool is None:
+            assign(batch_nodes, _decode_props(batch_data, encoder, include_props))
+        else:
+            while len(in_flight) >= threads * 2:
+                nodes, result = in_flight.popleft()
+                assign(nodes, result.get())
+            in_flight.append((batch_nodes,
+                pool.apply_async(_decode_props, (batch_data, encoder, include_props))))
+        batch_nodes, batch_data = [], []
+
+    try:
+        with _gc_paused():
+            for line in lines:
+                if not line.strip():
+                    continue
+                etype, nid, b = map(str.strip, line.split('\t'))
+                if nid not in id2node:
+                    id2node[nid] = Tree()
+                node = id2node[nid]
+
+                if etype == 'p':
+                    batch_nodes.append(node)
+                    batch_data.append(b)
+                    if len(batch_data) >= batch_size:
+                        flush()
+                elif etype == 't':
+                    if b:
+                        id2node[b].add_child(node)
+                        node.up = id2node[b]
+                    else:
+                        root = node
+            flush(last=True)
+            while in_flight:
+                nodes, result = in_flight.popleft()
+                assign(nodes, result.get())
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return root
+
+# .ete v2, binary columnar format
+#
+# MAGIC | uint32 header length | json header | data blocks (8-byte aligned)
+#
+# The topology is a preorder int32 array with the index of each node's parent
+# (-1 for the root). Each property is one column holding only the nodes where it
+# is present (given by a packed bitmask when not every node has it), encoded as
+#   - float, int, bool: contiguous little-endian array
+#   - str: int32 codes into a dictionary of unique values
+#   - pickle: any other value, one pickled list for the whole column
+MAGIC = b'ETE\x02'
+COLUMNAR_VERSION = 2
+
+def is_columnar(data):
+    return data[:len(MAGIC)] == MAGIC
+
+def sniff_ete(path):
+    """
+    Tell from the first bytes of the file at path whether it is .ete content,
+    of any version and compression, without decoding it.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(len(ZSTD_MAGIC))
+    return (is_columnar(head) or head.startswith(GZIP_MAGIC) or head.startswith(ZSTD_MAGIC)
+        or head[:2] in [b'p\t', b't\t'])
+
+# numpy scalars from the summary stats are stored as python values
+TYPE2COLUMN = {
+    float: 'float', np.float64: 'float', np.float32: 'float',
+    int: 'int', np.int64: 'int', np.int32: 'int',
+    bool: 'bool', np.bool_: 'bool',
+    str: 'str',
+}
+
+def _column_type(values):
+    ctypes = set(TYPE2COLUMN.get(type(v), 'pickle') for v in values)
+    if len(ctypes) != 1:
+        return 'pickle'
+    ctype = ctypes.pop()
+    if ctype == 'int' and not all(-2**63 <= v < 2**63 for v in values):
+        return 'pickle'
+    return ctype
+
+def _column_kind(values):
+    # same datatype rules as utils.get_prop2type, so it can be known without
+    # loading the column
+    values = [v for v in values if v != 'NaN']
+    if values and all(type(v) == list for v in values):
+        return 'list'
+    if values and all(type(v) == dict for v in values):
+        return 'dict'
+    if values and all(isinstance(v, numbers.Number) for v in values):
+        return 'float'
+    return 'str'
+
+def _encode_column(values):
+    ctype = _column_type(values)
+    if ctype == 'float':
+        blocks = {'values': np.array(values, dtype='<f8').tobytes()}
+    elif ctype == 'int':
+        blocks = {'values': np.array(values, dtype='<i8').tobytes()}
+    elif ctype == 'bool':
+        blocks = {'values': np.array(values, dtype='u1').tobytes()}
+    elif ctype == 'str':
+        value2code = {}
+        codes = [value2code.setdefault(v, len(value2code)) for v in values]
+        blocks = {
+            'values': np.array(codes, dtype='<i4').tobytes(),
+            'dictionary': json.dumps(list(value2code)).encode('utf-8'),
+        }
+    else:
+        blocks = {'values': pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL)}
+    return ctype, blocks
+
+def _decode_column(ctype, blocks):
+    values = blocks['values']
+    if ctype == 'float':
+        return np.frombuffer(values, dtype='<f8').tolist()
+    elif ctype == 'int':
+        return np.frombuffer(values, dtype='<i8').tolist()
+    elif ctype == 'bool':
+        return np.frombuffer(values, dtype='u1').astype(bool).tolist()
+    elif ctype == 'str':
+        dictionary = json.loads(blocks['dictionary'].decode('utf-8'))
+        return [dictionary[c] for c in np.frombuffer(values, dtype='<i4').tolist()]
+    elif ctype == 'pickle':
+        return pickle.loads(values)
+    raise Exception(f"Invalid column type {ctype}")
+
+def dumps_columnar(t, meta=None):
+    """
+    Serialize tree t to the binary columnar .ete v2 format.
+
+    Parameters:
+    - t: ete4 Tree
+    - meta: json serializable data stored in the header
+
+    Returns:
+    - bytes
+    """
+    nodes = list(t.traverse('preorder'))
+    node2idx = {id(n): i for i, n in enumerate(nodes)}
+    parents = np.array([node2idx[id(n.up)] if n.up and id(n.up) in node2idx else -1
+        for n in nodes], dtype='<i4')
+
+    # gather each property over the nodes that have it
+    prop2rows = {}
+    for i, n in enumerate(nodes):
+        for prop, value in n.props.items():
+            if prop == '__id':
+                continue
+            prop2rows.setdefault(prop, ([], []))
+            prop2rows[prop][0].append(i)
+            prop2rows[prop][1].append(value)
+
+    data = []
+    offset = 0
+    def add_block(block):
+        nonlocal offset
+        start = offset
+        data.append(block)
+        padding = -len(block) % 8
+        data.append(b'\0' * padding)
+        offset += len(block) + padding
+        return [start, len(block)]
+
+    header = {
+        'version': COLUMNAR_VERSION,
+        'nodes': len(nodes),
+        'parents': add_block(parents.tobytes()),
+        'columns': [],
+    }
+    if meta is not None:
+        header['meta'] = meta
+    for prop, (rows, values) in prop2rows.items():
+        ctype, blocks = _encode_column(values)
+        column = {'name': prop, 'type': ctype, 'kind': _column_kind(values), 'size': len(rows)}
+        if len(rows) == len(nodes):
+            column['present'] = None
+        else:
+            mask = np.zeros(len(nodes), dtype=bool)
+            mask[rows] = True
+            column['present'] = add_block(np.packbits(mask).tobytes())
+        for name, block in blocks.items():
+            column[name] = add_block(block)
+        header['columns'].append(column)
+
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * (-(len(MAGIC) + 4 + len(header)) % 8)
+    return b''.join([MAGIC, struct.pack('<I', len(header)), header] + data)
+
+def read_columnar_header(data):
+    """
+    Read the header of a .ete v2 content.
+
+    Returns:
+    - header dict, and the offset where data blocks start
+    """
+    if not is_columnar(data):
+        raise Exception("Not a columnar .ete content")
+    header_len = struct.unpack('<I', data[len(MAGIC):len(MAGIC)+4])[0]
+    start = len(MAGIC) + 4
+    header = json.loads(bytes(data[start:start+header_len]).decode('utf-8'))
+    if header.get('version') != COLUMNAR_VERSION:
+        raise Exception(f"Unsupported .ete version {header.get('version')}")
+    return header, start + header_len
+
+KIND2TYPE = {'float': float, 'list': list, 'dict': dict, 'str': str}
+
+class ColumnarLoader:
+    """
+    Column loader of .ete v2 content. The topology is built when the loader is
+    created, property columns are decoded into the nodes only when requested
+    with load(), and can be added later with more load() calls.
+
+    Columns are not decoded on access to node.props: ete4 keeps props in a
+    plain dict (a subclass is rejected), so callers request the columns they
+    need, as the plot path does from its layouts and queries.
+    """
+    def __init__(self, data, tree_class=Tree):
+        self.tree_class = tree_class
+        self.data = memoryview(data)
+        self.header, self.base = read_columnar_header(self.data)
+        self.name2column = {column['name']: column for column in self.header['columns']}
+        self.loaded = set()
+        with _gc_paused():
+            self.nodes = self._build_topology()
+        self.tree = self.nodes[0] if self.nodes else None
+
+    def _block(self, entry):
+        start, length = entry
+        return self.data[self.base+start:self.base+start+length]
+
+    def _build_topology(self):
+        parents = np.frombuffer(self._block(self.header['parents']), dtype='<i4').tolist()
+        nodes = []
+        for parent in parents:
+            node = self.tree_class()
+            if parent >= 0:
+                # preorder, parents are always created before children
+                up = nodes[parent]
+                up.children.append(node)
+                node.up = up
+            nodes.append(node)
+        return nodes
+
+    @property
+    def props(self):
+        return list(self.name2column.keys())
+
+    def get_prop2type(self):
+        """
+        Datatype of every property in the content, without loading them.
+        """
+        return {name: KIND2TYPE[column.get('kind', 'str')]
+            for name, column in self.name2column.items()}
+
+    def load(self, include_props=None):
+        """
+        Materialise property columns into the tree nodes. Columns loaded
+        before are skipped.
+
+        Parameters:
+        - include_props: list of properties to load, all of them if None
+
+        Returns:
+        - ete4 Tree
+        """
+        if include_props is None:
+            include_props = self.props
+        with _gc_paused():
+            for name in include_props:
+                if name in self.loaded or name not in self.name2column:
+                    continue
+                self._load_column(self.name2column[name])
+                self.loaded.add(name)
+        return self.tree
+
+    def _load_column(self, column):
+        blocks = {'values': self._block(column['values'])}
+        if 'dictionary' in column:
+            blocks['dictionary'] = bytes(self._block(column['dictionary']))
+        values = _decode_column(column['type'], blocks)
+        if column['present'] is None:
+            nodes = self.nodes
+        else:
+            mask = np.frombuffer(self._block(column['present']), dtype='u1')
+            rows = np.flatnonzero(np.unpackbits(mask, count=len(self.nodes))).tolist()
+            nodes = [self.nodes[i] for i in rows]
+        name = column['name']
+        for node, value in zip(nodes, values):
+            node.props[name] = value
+
+@contextlib.contextmanager
+def _gc_paused():
+    # building many small objects triggers the cyclic gc over and over,
+    # which takes most of the loading time of big trees
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def loads_columnar(data, include_props=None):
+    """
+    Load tree from the binary columnar .ete v2 format.
+
+    Parameters:
+    - data: bytes produced by dumps_columnar
+    - include_props: list of properties to load, all of them if None
+
+    Returns:
+    - ete4 Tree
+    """
+    return ColumnarLoader(data).load(include_props)
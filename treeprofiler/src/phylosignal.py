@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 import os, math, re
+import logging
 from multiprocessing.pool import ThreadPool
+from multiprocessing import Pool, current_process
 import numpy as np
 from scipy.stats import entropy
+from scipy.special import gammaln
 import math
 #from numba import njit, float64, int64
 
@@ -13,8 +16,11 @@ from pastml.annotation import preannotate_forest
 from pastml import col_name2cat
 from collections import defaultdict, Counter
 
-from treeprofiler.src.utils import add_suffix
-from treeprofiler.src.acr_continuous import ml_acr, by_acr
+from treeprofiler.src.utils import add_suffix, topology_clone
+from treeprofiler.src.acr_continuous import ml_acr_traits, by_acr_traits, pagel_lambda, blomberg_k, LAMBDA_GRID
+from treeprofiler.src.acr_discrete import TreeArrays, batch_acr, BATCH_METHODS
+
+logger = logging.getLogger(__name__)
 
 ''' ADDITIONAL INFORMATION
 
@@ -93,6 +99,119 @@ def mhbeta(a, b, x, l0, se):
         return b
 
 
+# number of MCMC steps whose random numbers are drawn at once
+MCMC_BLOCK_SIZE = 1024
+
+def _mh_step(p, other, step, log_u, n, c, se, rng=np.random):
+    """
+    Metropolis-Hastings step of alpha (or beta, swapping both) for all chains.
+    
+    Parameters:
+    - p: The current values of the updated parameter, one per chain.
+    - other: The current values of the other parameter.
+    - step: exp of the random walk steps of the proposals, drawn with standard deviation se.
+    - log_u: Log of the uniform numbers used for acceptance.
+    - n: The number of data points.
+    - c: l0 - sum(log(x)) for alpha, l0 - sum(log(1 - x)) for beta.
+    - se: The standard deviation for the random walk in the Metropolis-Hastings algorithm.
+    - rng: Random generator for proposals drawn again, or a list with the generator of each chain.
+    
+    Returns:
+    - The updated values.
+    """
+    p1 = p * step
+    log_r = n * (gammaln(p1 + other) - gammaln(p1) - gammaln(p + other) + gammaln(p)) - (p1 - p) * c
+    
+    # proposals with undefined acceptance ratio are drawn again
+    redraw = np.isnan(log_r)
+    while redraw.any():
+        if isinstance(rng, list):
+            proposal = np.array([rng[j].normal(0, se) for j in np.flatnonzero(redraw)])
+        else:
+            proposal = rng.normal(0, se, redraw.sum())
+        p1[redraw] = p[redraw] * np.exp(proposal)
+        log_r[redraw] = n * (gammaln(p1[redraw] + other[redraw]) - gammaln(p1[redraw]) - 
+                             gammaln(p[redraw] + other[redraw]) + gammaln(p[redraw])) - (p1[redraw] - p[redraw]) * c
+        redraw = np.isnan(log_r)
+    
+    # Acceptance
+    return np.where(log_u < log_r, p1, p)
+
+def _chain_segment(params):
+    """
+    Run a segment of steps of the Metropolis-Hastings chains.
+    
+    Parameters:
+    - params: tuple (alpha, beta, n, c_alpha, c_beta, se, record, rngs), with
+      alpha and beta the current values of each chain, record the steps of the
+      segment whose values are kept, and rngs the RandomState of each chain
+      (None to use the global numpy generator for all of them).
+    
+    Returns:
+    - The last alpha and beta values, the kept samples of shape (chains, kept, 2),
+      and rngs advanced past the segment.
+    """
+    alpha, beta, n, c_alpha, c_beta, se, record, rngs = params
+    rng = np.random if rngs is None else list(rngs)
+    chains = len(alpha)
+
+    def draw(draw_fn, steps):
+        # (steps, chains), each chain from its own generator when given
+        if rngs is None:
+            return draw_fn(np.random, (steps, chains))
+        return np.stack([draw_fn(r, steps) for r in rng], axis=1)
+
+    gibbs = []
+    for start in range(0, len(record), MCMC_BLOCK_SIZE):
+        steps = min(MCMC_BLOCK_SIZE, len(record) - start)
+        step_alpha = np.exp(draw(lambda r, size: r.normal(0, se, size), steps))
+        step_beta = np.exp(draw(lambda r, size: r.normal(0, se, size), steps))
+        log_u_alpha = np.log(draw(lambda r, size: r.uniform(0, 1, size), steps))
+        log_u_beta = np.log(draw(lambda r, size: r.uniform(0, 1, size), steps))
+        for i in range(steps):
+            alpha = _mh_step(alpha, beta, step_alpha[i], log_u_alpha[i], n, c_alpha, se, rng)
+            beta = _mh_step(beta, alpha, step_beta[i], log_u_beta[i], n, c_beta, se, rng)
+            
+            if record[start + i]:
+                gibbs.append(np.stack((alpha, beta), axis=1))
+    
+    if gibbs:
+        return alpha, beta, np.stack(gibbs, axis=1), rngs
+    return alpha, beta, np.empty((chains, 0, 2)), rngs
+
+def _chain_setup(x, l0, sim, thin, burn):
+    """
+    Sufficient statistics of x and the steps kept from the chains.
+    """
+    x = np.asarray(x, dtype=float)
+    c_alpha = l0 - np.sum(np.log(x))
+    c_beta = l0 - np.sum(np.log(1 - x))
+    
+    n_size = np.linspace(burn, sim, int((sim - burn) / thin + 1))
+    usim = np.round(n_size, 0).astype(int)
+    record = np.zeros(sim + 1, dtype=bool)
+    record[usim[(usim >= 0) & (usim <= sim)]] = True
+    return len(x), c_alpha, c_beta, record
+
+def emcmc_chains(alpha, beta, x, l0, se, sim, thin, burn, chains=1):
+    """
+    Metropolis-Hastings algorithm for alpha and beta parameters, running
+    independent chains in lockstep. The likelihood only depends on x through
+    len(x), sum(log(x)) and sum(log(1 - x)) which are computed once, and random
+    numbers are drawn in blocks of MCMC_BLOCK_SIZE steps.
+    
+    Parameters:
+    - alpha, beta, x, l0, se, sim, thin, burn: as in emcmc.
+    - chains: The number of independent chains, all starting from alpha and beta.
+    
+    Returns:
+    - Gibbs samples of shape (chains, samples, 2) for alpha and beta.
+    """
+    n, c_alpha, c_beta, record = _chain_setup(x, l0, sim, thin, burn)
+    alpha = np.full(chains, alpha, dtype=float)
+    beta = np.full(chains, beta, dtype=float)
+    return _chain_segment((alpha, beta, n, c_alpha, c_beta, se, record, None))[2]
+
 # Metropolis-Hastings algorithm using alpha and beta
 def emcmc(params):
     """
@@ -105,20 +224,117 @@ def emcmc(params):
     - Gibbs samples for alpha and beta.
     """
     alpha, beta, x, l0, se, sim, thin, burn = params
-    n_size = np.linspace(burn, sim, int((sim - burn) / thin + 1))
-    usim = np.round(n_size, 0).astype(int)
-    gibbs = []
-    p = 0
+    return emcmc_chains(alpha, beta, x, l0, se, sim, thin, burn, chains=1)[0]
 
-    for i in range(sim + 1):
-        alpha = mhalpha(alpha, beta, x, l0, se)
-        beta = mhbeta(alpha, beta, x, l0, se)
-        
-        if i == usim[p]:
-            gibbs.append((alpha, beta))
-            p += 1
+# Convergence diagnostics of MCMC samples with shape (chains, draws)
+def rhat(samples):
+    """
+    Split R-hat (Gelman-Rubin) of samples with shape (chains, draws), each
+    chain being split in two halves.
+    """
+    half = samples.shape[1] // 2
+    if half < 2:
+        return np.nan
+    split = np.concatenate((samples[:, :half], samples[:, half:2 * half]), axis=0)
+    n = split.shape[1]
+    within = np.mean(np.var(split, axis=1, ddof=1))
+    between = n * np.var(np.mean(split, axis=1), ddof=1)
+    if within == 0:
+        return np.nan
+    return np.sqrt(((n - 1) / n * within + between / n) / within)
+
+def ess(samples):
+    """
+    Effective sample size of samples with shape (chains, draws), from the
+    autocorrelation combined over chains and truncated with Geyer's initial
+    positive sequence.
+    """
+    m, n = samples.shape
+    if n < 4:
+        return np.nan
+    centered = samples - np.mean(samples, axis=1, keepdims=True)
+    # autocovariance of each chain by FFT
+    f = np.fft.rfft(centered, n=2 * n, axis=1)
+    acov = np.fft.irfft(f * np.conj(f), n=2 * n, axis=1)[:, :n] / n
+    within = np.mean(acov[:, 0]) * n / (n - 1)
+    var_plus = within * (n - 1) / n
+    if m > 1:
+        var_plus += np.var(np.mean(samples, axis=1), ddof=1)
+    if var_plus == 0:
+        return np.nan
+    rho = 1 - (within - np.mean(acov, axis=0)) / var_plus
+    rho[0] = 1
+    
+    # sum of the positive and monotone pairs of autocorrelations
+    pairs = rho[:n - n % 2].reshape(-1, 2).sum(axis=1)
+    positive = np.nonzero(pairs <= 0)[0]
+    pairs = pairs[:positive[0]] if len(positive) else pairs
+    pairs = np.minimum.accumulate(pairs)
+    tau = max(-1 + 2 * np.sum(pairs), 1 / np.log10(m * n))
+    return m * n / tau
+
+def run_chains(alpha, beta, x, l0, se, sim, thin, burn, chains=2, threads=1, 
+               target_ess=0, max_rhat=1.01, check_every=500):
+    """
+    Run chains of the Metropolis-Hastings algorithm for alpha and beta in
+    segments of check_every steps, with the chains split over threads
+    processes. Each chain draws from its own generator, seeded from the
+    global numpy generator, so samples do not depend on threads. With
+    target_ess, sampling stops once the split R-hat of alpha and beta is
+    below max_rhat and both reach target_ess effective samples.
+    
+    Returns:
+    - Gibbs samples of shape (chains, samples, 2) for alpha and beta.
+    - Diagnostics dict with the R-hat, ESS and number of iterations run.
+    """
+    n, c_alpha, c_beta, record = _chain_setup(x, l0, sim, thin, burn)
+    alpha = np.broadcast_to(np.asarray(alpha, dtype=float), chains).copy()
+    beta = np.broadcast_to(np.asarray(beta, dtype=float), chains).copy()
+    
+    # processes of a pool can not start their own pool
+    threads = min(threads, chains)
+    if current_process().daemon:
+        threads = 1
+    groups = np.array_split(np.arange(chains), max(threads, 1))
+    segment = check_every if target_ess else sim + 1
+    rngs = [np.random.RandomState(seed) for seed in np.random.randint(0, 2**32, size=chains, dtype=np.uint64)]
+    
+    pool = Pool(threads) if threads > 1 else None
+    gibbs = []
+    diagnostics = {'rhat': np.nan, 'ess': np.nan, 'iterations': 0}
+    try:
+        for start in range(0, sim + 1, segment):
+            end = min(start + segment, sim + 1)
+            if pool is None:
+                tasks = [(alpha, beta, n, c_alpha, c_beta, se, record[start:end], rngs)]
+                results = map(_chain_segment, tasks)
+            else:
+                tasks = [(alpha[g], beta[g], n, c_alpha, c_beta, se, record[start:end], 
+                          [rngs[i] for i in g]) for g in groups]
+                results = pool.map(_chain_segment, tasks)
+            results = list(results)
+            # generators come back from the processes advanced past the segment
+            rngs = [rng for r in results for rng in r[3]]
+            alpha = np.concatenate([r[0] for r in results])
+            beta = np.concatenate([r[1] for r in results])
+            gibbs.append(np.concatenate([r[2] for r in results], axis=0))
+            diagnostics['iterations'] = end
             
-    return np.asarray(gibbs)
+            if target_ess and end <= sim:
+                samples = np.concatenate(gibbs, axis=1)
+                diagnostics['rhat'] = max(rhat(samples[:, :, 0]), rhat(samples[:, :, 1]))
+                diagnostics['ess'] = min(ess(samples[:, :, 0]), ess(samples[:, :, 1]))
+                if diagnostics['rhat'] < max_rhat and diagnostics['ess'] >= target_ess:
+                    break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    samples = np.concatenate(gibbs, axis=1)
+    diagnostics['rhat'] = float(max(rhat(samples[:, :, 0]), rhat(samples[:, :, 1])))
+    diagnostics['ess'] = float(min(ess(samples[:, :, 0]), ess(samples[:, :, 1])))
+    return samples, diagnostics
 
 # def parallel_emcmc(threads, alpha, beta, x, l0, se, sim, thin, burn):
 #     params = [(alpha, beta, x, l0, se, sim, thin, burn) for _ in range(threads)]
@@ -167,108 +383,364 @@ def entropy_type(prob, ent_type):
 
 
 # Calculate delta-statistic after an MCMC step
-def delta(x,lambda0,se,sim,thin,burn,ent_type, threads=1):
+def delta(x,lambda0,se,sim,thin,burn,ent_type, threads=1, chains=2, target_ess=0, max_rhat=1.01, 
+          check_every=500, return_diagnostics=False):
     '''x     = A matrix of ancestral probabilities.
     lambda0  = A constant value used in the acceptance ratio computations.
     se       = The standard deviation used for the random walk in the Metropolis-Hastings algorithm.
     sim      = The number of total iterations in the Markov Chain Monte Carlo (MCMC) simulation.
     thin     = The thinning parameter, i.e., the number of iterations to discard between saved samples.
     burn     = The number of burn-in iterations to discard at the beginning of the simulation.
-    ent_type = A string specifying the type of entropy calculation (options: 'LSE', 'SE', or any other value for Gini impurity).'''
-    params = (np.random.exponential(),np.random.exponential(),entropy_type(x, ent_type),lambda0,se,sim,thin,burn)
-    # if threads > 1:
-    #     mc1    = parallel_emcmc(threads,np.random.exponential(),np.random.exponential(),entropy_type(x, ent_type),lambda0,se,sim,thin,burn)
-    #     mc2    = parallel_emcmc(threads,np.random.exponential(),np.random.exponential(),entropy_type(x, ent_type),lambda0,se,sim,thin,burn)
-    # else:
-    mc1    = emcmc(params)
-    mc2    = emcmc(params)
-    mchain = np.concatenate((mc1,mc2), axis=0)
+    ent_type = A string specifying the type of entropy calculation (options: 'LSE', 'SE', or any other value for Gini impurity).
+    threads  = The number of processes the chains are split over.
+    chains   = The number of chains, each starting from its own random alpha and beta.
+    target_ess = Stop once this effective sample size and max_rhat are reached, checked every check_every iterations (0 runs all sim iterations).
+    return_diagnostics = Also return the R-hat, ESS and number of iterations of the chains.'''
+    alpha = np.random.exponential(size=chains)
+    beta = np.random.exponential(size=chains)
+    params = (alpha,beta,entropy_type(x, ent_type),lambda0,se,sim,thin,burn)
+    samples, diagnostics = run_chains(*params, chains=chains, threads=threads, target_ess=target_ess, 
+                                      max_rhat=max_rhat, check_every=check_every)
+    mchain = samples.reshape(-1, 2)
     
     deltaA = (np.mean(mchain[:,1]))/(np.mean(mchain[:,0]))
     
+    if return_diagnostics:
+        return deltaA, diagnostics
     return deltaA
 
+# tree shared by the processes of discrete ACR
+ACR_SHARED = {}
+
+def init_acr_worker(tree):
+    ACR_SHARED['tree'] = tree
+
+def _acr_discrete_worker(params):
+    """
+    Run ACR of one discrete trait on the tree of the process, and return the
+    acr result with the states of the nodes in preorder.
+    """
+    key, states, prediction_method, model, threads = params
+    tree = ACR_SHARED['tree']
+    nodes = list(tree.traverse('preorder'))
+    node2props = [set(node.props) for node in nodes]
+    
+    acr_result = acr(forest=[tree], columns=[key], column2states={key: states}, prediction_method=prediction_method, model=model, threads=threads)
+    values = [node.props.get(key) for node in nodes]
+    
+    # remove what pastml added for the trait, so the tree is ready for the next one
+    for node, props in zip(nodes, node2props):
+        for prop in set(node.props) - props:
+            node.del_prop(prop)
+    return key, acr_result, values
+
+def get_acr_threads(threads, n_traits):
+    """
+    Split threads into processes running one trait each and pastml threads
+    inside each process.
+    """
+    workers = max(1, min(threads, n_traits))
+    return workers, max(1, threads // workers)
+
+def _sort_marginals(acr_result, names):
+    # marginal probabilities of the nodes in preorder, so they can be used by position
+    if 'marginal_probabilities' in acr_result:
+        acr_result['marginal_probabilities'] = acr_result['marginal_probabilities'].loc[names]
+
 # Calculate the marginal probabilities for each discrete trait
 def run_acr_discrete(tree, columns, prediction_method="MPPA", model="F81", threads=1, outdir="./"):
+    """
+    ACR of discrete traits. The reconstruction runs on a copy of the tree
+    where nodes are named like the pastml pipeline does, and the states are
+    set back to the nodes of tree, whose names are not changed. Marginal
+    probabilities are indexed by the names of the copy, with the nodes in
+    preorder.
+    """
     prop2acr = {}
     column2states = {c: np.array(sorted(list(set(states)))) for c, states in columns.items()}
     features = list(column2states.keys())
-    forest = [tree]
+    nodes = list(tree.traverse('preorder'))
+    acr_tree = topology_clone(tree, props=['name', 'dist', 'support'] + features)
+    # unique node names, so marginal probabilities have one row per node
+    name_tree(acr_tree)
+    acr_nodes = list(acr_tree.traverse('preorder'))
+    names = [node.name for node in acr_nodes]
+
+    def set_states(key, values):
+        for node, value in zip(nodes, values):
+            if value is not None:
+                node.add_prop(key, value)
+
+    # the batched engine reconstructs all the traits in the same numpy passes
+    if prediction_method in BATCH_METHODS:
+        prop2acr = batch_acr(acr_tree, column2states, prediction_method=prediction_method, model=model)
+        for key, acr_result in prop2acr.items():
+            set_states(key, [node.props.get(key) for node in acr_nodes])
+            if outdir:
+                _serialize_acr((acr_result[0], outdir))
+        return prop2acr, tree
+
+    # processes of a pool can not start their own pool
+    workers, acr_threads = get_acr_threads(threads, len(column2states))
+    if current_process().daemon:
+        workers, acr_threads = 1, threads
+
+    if workers > 1:
+        # the tree is shipped once to each process with only the traits, 
+        # and the reconstructed states are set back to the nodes in preorder
+        params = [(key, column2states[key], prediction_method, model, acr_threads) for key in column2states.keys()]
+        with Pool(workers, initializer=init_acr_worker, initargs=(acr_tree,)) as pool:
+            for key, acr_result, values in pool.imap(_acr_discrete_worker, params):
+                set_states(key, values)
+                _sort_marginals(acr_result[0], names)
+                prop2acr[key] = acr_result
+                if outdir:
+                    _serialize_acr((acr_result[0], outdir))
+        return prop2acr, tree
 
     for key in column2states.keys():
-        single_column = {key:columns[key]}
-        single_column2states = {key:column2states[key]}
-        # Run ACR
-        acr_result = acr(forest=forest, columns=single_column.keys(), column2states=single_column2states, prediction_method=prediction_method, model=model, threads=threads)
+        init_acr_worker(acr_tree)
+        key, acr_result, values = _acr_discrete_worker((key, column2states[key], prediction_method, model, threads))
+        set_states(key, values)
+        _sort_marginals(acr_result[0], names)
         prop2acr[key] = acr_result
         if outdir:
             _serialize_acr((acr_result[0], outdir))
-    return prop2acr, forest[0]
+    return prop2acr, tree
 
 # Calculate the marginal probabilities for each continuous trait
 def run_acr_continuous(tree, transformed_dict, model="BM", prediction_method="ML", threads=1, outdir="./"):
     acr_results = {}
 
-    # Parameters for OU model
-    alpha = 1.0
-    theta = 30.0
-    sigma = 5.0
-    sigma_prior = 10
-    sigma_drift = 5.0
+    if prediction_method == 'ML':
+        # all the traits in the same pruning passes, drift rate and OU parameters 
+        # are estimated by maximum likelihood for each trait
+        tree, acr_results = ml_acr_traits(tree, transformed_dict, model=model)
+    elif prediction_method == 'BAYESIAN':
+        # all the traits are sampled in one model, one chain per thread
+        tree, acr_results = by_acr_traits(tree, transformed_dict, model=model, sigma_prior=10, sigma_drift=5.0,
+            cores=threads)
 
-    for key, observed_traits in transformed_dict.items():
-        # Run ACR
-        if prediction_method == 'ML':
-            tree, acr_result = ml_acr(tree, key, observed_traits, model=model, sigma=sigma, alpha=alpha, theta=theta)
-        elif prediction_method == 'BAYESIAN':
-            tree, acr_result = by_acr(tree, key, observed_traits, model=model, sigma_prior=sigma_prior, sigma_drift=sigma_drift, alpha=alpha, theta=theta)
-        acr_results[key] = acr_result
-
-    return acr_result, tree
+    return acr_results, tree
 
 # Calculate delta-statistic of marginal probabilities each discrete trait
-def run_delta(acr_results, tree, run_whole_tree=False, ent_type='LSE', lambda0=0.1, se=0.5, sim=10000, burn=100, thin=10, threads=1):
+def clade_slices(tree):
+    """
+    Internal nodes of the tree in preorder, where the internal nodes of each
+    clade are contiguous, so the clade of nodes[i] is nodes[i:ends[i]].
+
+    Returns:
+    - list of the internal nodes in preorder
+    - array of the end of the clade of each node
+    - array of the number of leaves of each clade
+    """
+    nodes = [node for node in tree.traverse('preorder') if not node.is_leaf]
+    position = {id(node): i for i, node in enumerate(nodes)}
+    ends = np.arange(1, len(nodes) + 1)
+    sizes = np.zeros(len(nodes), dtype=int)
+    # children come after their parent in preorder
+    for i in range(len(nodes) - 1, -1, -1):
+        for child in nodes[i].children:
+            if child.is_leaf:
+                sizes[i] += 1
+            else:
+                j = position[id(child)]
+                ends[i] = max(ends[i], ends[j])
+                sizes[i] += sizes[j]
+    return nodes, ends, sizes
+
+def internal_mask(tree):
+    """
+    Internal nodes of the tree in preorder, the rows of the marginal
+    probabilities of run_acr_discrete.
+    """
+    return np.array([not node.is_leaf for node in tree.traverse('preorder')])
+
+# marginal probabilities in clade order shared by the processes of per-clade delta
+CLADE_SHARED = {}
+
+def init_clade_worker(prop2marginals, options):
+    CLADE_SHARED.update({'marginals': prop2marginals, 'options': options})
+
+def _clade_delta_worker(params):
+    """
+    Delta statistic of the marginal probabilities of the internal nodes of
+    one clade, seeded like the delta of the whole tree.
+    """
+    prop, start, end = params
+    options = CLADE_SHARED['options']
+    np.random.seed(42)
+    delta_result, diagnostics = delta(CLADE_SHARED['marginals'][prop][start:end], options['lambda0'], options['se'], 
+                                      options['sim'], options['thin'], options['burn'], options['ent_type'], 1, 
+                                      chains=options['chains'], target_ess=options['target_ess'], 
+                                      max_rhat=options['max_rhat'], return_diagnostics=True)
+    return prop, start, delta_result, diagnostics
+
+def run_clade_delta(acr_results, tree, min_clade_size=10, threads=1, **options):
+    """
+    Delta statistic of every clade of the tree with at least min_clade_size
+    leaves, and of the root, on the marginal probabilities of the internal
+    nodes of the clade. The marginal probabilities are stored once per trait
+    in clade order, so the ones of each clade are a slice.
+
+    Parameters:
+    - acr_results: dict of trait name to acr result with marginal probabilities
+    - tree: Phylogenetic tree of the acr results
+    - min_clade_size: minimum number of leaves of a clade
+    - threads: number of processes running the clades
+    - options: lambda0, se, sim, thin, burn, ent_type, chains, target_ess and max_rhat of delta
+
+    Returns:
+    - dict of trait name to list of (node, delta)
+    - dict of trait name to list of (node, diagnostics)
+    """
+    nodes, ends, sizes = clade_slices(tree)
+    internal = internal_mask(tree)
+    prop2marginals = {prop: acr_result[0]['marginal_probabilities'].to_numpy(dtype=float)[internal]
+        for prop, acr_result in acr_results.items()}
+
+    # largest clades first, so they do not start last
+    clades = [i for i in np.argsort(-sizes, kind='stable') if i == 0 or sizes[i] >= min_clade_size]
+    params = [(prop, int(i), int(ends[i])) for prop in prop2marginals for i in clades]
+    logger.info(f"Calculating delta statistic of {len(clades)} clades for {len(prop2marginals)} traits...")
+
+    prop2delta = defaultdict(list)
+    prop2diagnostics = defaultdict(list)
+    step = max(1, len(params) // 10)
+    if threads > 1 and len(params) > 1:
+        threads = min(threads, len(params))
+        pool = Pool(threads, initializer=init_clade_worker, initargs=(prop2marginals, options))
+        results = pool.imap_unordered(_clade_delta_worker, params, chunksize=max(1, len(params) // (threads * 16)))
+    else:
+        pool = None
+        init_clade_worker(prop2marginals, options)
+        results = map(_clade_delta_worker, params)
+    try:
+        for done, (prop, i, delta_result, diagnostics) in enumerate(results, 1):
+            prop2delta[prop].append((nodes[i], delta_result))
+            prop2diagnostics[prop].append((nodes[i], diagnostics))
+            if done % step == 0 or done == len(params):
+                logger.info(f"Delta statistic of {done}/{len(params)} clades done")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return dict(prop2delta), dict(prop2diagnostics)
+
+def run_delta(acr_results, tree, run_whole_tree=False, ent_type='LSE', lambda0=0.1, se=0.5, sim=10000, burn=100, thin=10, threads=1,
+              chains=2, target_ess=0, max_rhat=1.01, return_diagnostics=False, min_clade_size=10):
     prop2delta = {}
-    prop2marginals = {}
-    leafnames = tree.leaf_names()
-    node2leaves = tree.get_cached_content(leaves_only=False)
+    prop2diagnostics = {}
     # extract the marginal probabilities for each discrete trait
     if run_whole_tree:
-        for node in tree.traverse():
-            if node.is_leaf:
-                continue
-
-            for prop, acr_result in acr_results.items():
-                # Get the marginal probabilities for each node
-                children_data = acr_result[0]['marginal_probabilities'].loc[[child.name for child in node2leaves[node] if not child.is_leaf]]
-                
-                #internal_nodes_data[node.name] = children_data
-                if node.is_root:
-                    marginal_probs = np.asarray(acr_result[0]['marginal_probabilities'].drop(leafnames))
-                else:
-                    marginal_probs = np.asarray(children_data)
-                # run delta for each discrete trait
-                # load annotations to leaves
-                np.random.seed(42)  # or any integer seed you prefer
-                delta_result = delta(marginal_probs, lambda0, se, sim, burn, thin, ent_type, threads)
+        # delta of each clade, the one of the root is the delta of the whole tree
+        prop2clades, prop2clade_diagnostics = run_clade_delta(acr_results, tree, min_clade_size=min_clade_size, 
+            threads=threads, ent_type=ent_type, lambda0=lambda0, se=se, sim=sim, thin=thin, burn=burn, 
+            chains=chains, target_ess=target_ess, max_rhat=max_rhat)
+        for prop, node2delta in prop2clades.items():
+            for node, delta_result in node2delta:
                 node.add_prop(add_suffix(prop, "delta"), delta_result)
+                if node is tree:
+                    prop2delta[prop] = delta_result
+            for node, diagnostics in prop2clade_diagnostics[prop]:
+                if node is tree:
+                    prop2diagnostics[prop] = diagnostics
     else:
         # this is the case when we only want to calculate delta for the root
         for prop, acr_result in acr_results.items():
             # Get the marginal probabilities for each node
-            marginal_probs = np.asarray(acr_result[0]['marginal_probabilities'].drop(leafnames))
+            marginal_probs = acr_result[0]['marginal_probabilities'].to_numpy(dtype=float)[internal_mask(tree)]
             # run delta for each discrete trait
             # load annotations to leaves
             np.random.seed(42)  # or any integer seed you prefer
-            delta_result = delta(marginal_probs, lambda0, se, sim, burn, thin, ent_type, threads)
+            delta_result, diagnostics = delta(marginal_probs, lambda0, se, sim, thin, burn, ent_type, threads, 
+                                              chains=chains, target_ess=target_ess, max_rhat=max_rhat, 
+                                              return_diagnostics=True)
             #tree.add_prop(add_suffix(prop, "delta"), delta_result)
             prop2delta[prop] = delta_result
-        return prop2delta
+            prop2diagnostics[prop] = diagnostics
+    if return_diagnostics:
+        return prop2delta, prop2diagnostics
+    return prop2delta
+
+# statistics of phylogenetic signal of continuous traits, on the leaf values of TreeArrays
+def _lambda_statistic(arrays, values):
+    return pagel_lambda(arrays, values)[0]
+
+SIGNAL_STATISTICS = {'lambda': _lambda_statistic, 'K': blomberg_k}
+# node values held by each array of a permutation batch, which bounds its memory
+SIGNAL_CELLS = 2 ** 22
+
+# topology and leaf values shared by the processes of signal permutations
+SIGNAL_SHARED = {}
+
+def init_signal_worker(tree, values, statistic):
+    SIGNAL_SHARED.update({'arrays': TreeArrays(tree), 'values': values, 'statistic': statistic})
+
+def _signal_permutations(params):
+    """
+    Statistic of a batch of permutations of the leaf values of one trait,
+    drawn from the seed of the batch.
+    """
+    t, size, seed = params
+    arrays, values = SIGNAL_SHARED['arrays'], SIGNAL_SHARED['values']
+    rng = np.random.default_rng(seed)
+    observed = np.flatnonzero(~np.isnan(values[:, t]))
+    permuted = np.full((len(values), size), np.nan)
+    for k in range(size):
+        permuted[observed, k] = rng.permutation(values[observed, t])
+    return t, SIGNAL_STATISTICS[SIGNAL_SHARED['statistic']](arrays, permuted)
+
+def run_signal(tree, prop2traits, statistic, permutations=100, threads=1, seed=42):
+    """
+    Phylogenetic signal of continuous traits and its p_value by permutation
+    of the leaf values. Permutations are split into batches with their own
+    seed, drawn from seed, so results do not depend on the number of threads.
+
+    Parameters:
+    - tree: Phylogenetic tree
+    - prop2traits: dict of trait name to observed trait values by leaf name
+    - statistic: 'lambda' (Pagel's lambda) or 'K' (Blomberg's K)
+    - permutations: number of permutations of each trait
+    - threads: number of processes running the permutation batches
+    - seed: random seed of the permutations
+
+    Returns:
+    - dict of trait name to {statistic: value, 'pval': p_value}
+    """
+    props = list(prop2traits)
+    worker_tree = topology_clone(tree)
+    arrays = TreeArrays(worker_tree)
+    values = np.array([[prop2traits[prop].get(node.name, np.nan) if leaf else np.nan for prop in props]
+        for node, leaf in zip(arrays.nodes, arrays.is_leaf)], dtype=float)
+    observed = SIGNAL_STATISTICS[statistic](arrays, values)
+
+    # lambda evaluates its grid of points at once
+    points = LAMBDA_GRID if statistic == 'lambda' else 1
+    batch = max(1, SIGNAL_CELLS // (len(arrays.nodes) * points))
+    rng = np.random.default_rng(seed)
+    params = [(t, min(batch, permutations - start), int(rng.integers(2**32)))
+        for t in range(len(props)) for start in range(0, permutations, batch)]
+
+    exceed = np.zeros(len(props), dtype=int)
+    if threads > 1 and len(params) > 1:
+        with Pool(min(threads, len(params)), initializer=init_signal_worker,
+                  initargs=(worker_tree, values, statistic)) as pool:
+            results = list(pool.imap_unordered(_signal_permutations, params))
+    else:
+        SIGNAL_SHARED.update({'arrays': arrays, 'values': values, 'statistic': statistic})
+        results = map(_signal_permutations, params)
+    for t, permuted in results:
+        exceed[t] += np.sum(permuted >= observed[t])
+
+    # the observed statistic counts as one of the permutations
+    return {prop: {statistic: observed[t], 'pval': (exceed[t] + 1) / (permutations + 1)}
+        for t, prop in enumerate(props)}
 
 # Calculate Pagel's lambda statistic for each continuous trait
-def run_lambda():
-    return
+def run_lambda(tree, prop2traits, permutations=100, threads=1, seed=42):
+    return run_signal(tree, prop2traits, 'lambda', permutations=permutations, threads=threads, seed=seed)
 
-# Calculate Blomberg's kappa statistic for each continuous trait
-def run_kappa():
-    return
\ No newline at end of file
+# Calculate Blomberg's K statistic for each continuous trait
+def run_kappa(tree, prop2traits, permutations=100, threads=1, seed=42):
+    return run_signal(tree, prop2traits, 'K', permutations=permutations, threads=threads, seed=seed)
\ No newline at end of file
@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+import os
+import math
+import re
+import time
+import pickle
+import logging
+from collections import Counter
+
+import numpy as np
+from ete4 import Tree
+
+from treeprofiler.src.phylosignal import emcmc, SIGNAL_CELLS
+from treeprofiler.src.acr_discrete import BATCH_METHODS, SF_GRID, SF_ITERATIONS
+from treeprofiler.src.acr_continuous import ALPHA_GRID, ALPHA_ITERATIONS, LAMBDA_GRID, LAMBDA_ITERATIONS, NODE_DRAWS, NODE_CHUNK
+
+logger = logging.getLogger(__name__)
+
+''' Execution planner of the annotate subcommand
+
+The planner inspects the size of the inputs (tree, metadata, data matrix, alignment)
+and the requested analyses, and predicts runtime and peak memory of each annotation
+stage. Unit costs of the main kernels are calibrated by a small micro-benchmark on
+the running machine, the costs which are too expensive to measure at startup
+(pastml, taxonomic database) are reference values scaled by the machine speed.
+'''
+
+# reference costs, in seconds, measured on a machine where REFERENCE_LOOP takes 0.03s
+REFERENCE_LOOP = 0.03
+PASTML_CALL_COST = 0.5          # per pastml acr() call
+PASTML_NODE_COST = 2.5e-5       # per node per squared number of states of each acr() call
+BATCH_ACR_COST = 5e-6           # per node per squared number of states per trait of the batched discrete ACR
+BITSET_COLUMN_COST = 5e-8       # per node per column of the bitset parsimony
+PRUNING_NODE_COST = 3e-7        # per node per column of a continuous pruning pass
+BAYESIAN_SAMPLING_COST = 5.0    # per PyMC model, compilation and sampling
+NODE_DRAW_COST = 2e-8           # per node per trait per posterior draw
+TAXA_LEAF_COST = 2e-4           # per leaf for taxonomic annotation
+PROCESS_START_COST = 0.1        # per worker process of a pool
+
+# memory footprint, in bytes
+NODE_BYTES = 1024               # ete4 node object with its props dict
+PROP_BYTES = 120                # one python value stored in node.props
+METADATA_CELL_BYTES = 150       # one parsed metadata cell (dict + column list)
+TABLE_CELL_BYTES = 8            # one reference in the columns of the output table
+OUTPUT_BUFFER_BYTES = 2**22     # blocks of the streamed .ete and newick outputs
+PICKLE_NODE_BYTES = 60          # one node pickled to a worker process
+
+def calibrate():
+    """
+    Run a small micro-benchmark to measure unit costs on the running machine.
+
+    Returns:
+    - dict of unit costs in seconds
+    """
+    costs = {}
+
+    # pure python speed, used to scale reference costs
+    start = time.perf_counter()
+    s = 0
+    for i in range(200000):
+        s += i
+    costs['speed'] = (time.perf_counter() - start) / REFERENCE_LOOP
+
+    # summary of one property of one leaf, the kernel of internal nodes summary
+    tree = Tree()
+    tree.populate(500)
+    leaves = list(tree.leaves())
+    for i, leaf in enumerate(leaves):
+        leaf.add_prop('cat', str(i % 5))
+        leaf.add_prop('num', float(i))
+    start = time.perf_counter()
+    for _ in range(4):
+        Counter(leaf.props.get('cat') or 'NaN' for leaf in leaves)
+        np.array([leaf.props.get('num') for leaf in leaves], dtype=np.float64).sum()
+    costs['summary'] = (time.perf_counter() - start) / (4 * 2 * len(leaves))
+
+    # pickling of one node, the cost to ship data to worker processes
+    start = time.perf_counter()
+    pickle.dumps(tree)
+    costs['pickle'] = (time.perf_counter() - start) / (2 * len(leaves))
+
+    # one Metropolis-Hastings step of the delta statistic, as a + b * len(x)
+    step_costs = []
+    sizes = (64, 4096)
+    for size in sizes:
+        x = np.random.uniform(0.01, 0.99, size)
+        start = time.perf_counter()
+        emcmc((1.0, 1.0, x, 0.1, 0.5, 100, 10, 10))
+        step_costs.append((time.perf_counter() - start) / 101)
+    slope = max(step_costs[1] - step_costs[0], 0) / (sizes[1] - sizes[0])
+    costs['mcmc_step'] = max(step_costs[0] - slope * sizes[0], 0)
+    costs['mcmc_elem'] = slope
+
+    return costs
+
+def _count_arrow_table(filename, state_columns=()):
+    """Count rows and columns of a parquet or arrow/feather table from its metadata."""
+    with open(filename, 'rb') as f:
+        is_parquet = f.read(4) == b'PAR1'
+    if is_parquet:
+        import pyarrow.parquet as pq
+        parquet_metadata = pq.read_metadata(filename)
+        rows, columns = parquet_metadata.num_rows, parquet_metadata.num_columns - 1
+        names = pq.read_schema(filename).names
+        read_columns = lambda selected: pq.read_table(filename, columns=selected)
+    else:
+        import pyarrow.feather as feather
+        table = feather.read_table(filename, memory_map=True)
+        rows, columns = table.num_rows, table.num_columns - 1
+        names = table.column_names
+        read_columns = lambda selected: table.select(selected)
+
+    column2states = {}
+    selected = [name for name in state_columns if name in names[1:]]
+    if selected:
+        table = read_columns(selected)
+        for name in selected:
+            column2states[name] = len(table[name].drop_null().unique())
+    return rows, columns, column2states
+
+# missing values of metadata cells, as check_missing of tree_annotate
+MISSING_VALUE = re.compile(r'^(?:\W+|none|None|null|Null|NaN|NA|)$')
+
+def _count_table(filename, delimiter='\t', no_headers=False, state_columns=()):
+    """
+    Count rows and columns of a delimited table without parsing it, and the
+    distinct values of state_columns. The first line is the header unless
+    no_headers, then columns are named col0, col1... as parse_csv does.
+
+    Returns:
+    - number of rows, number of columns besides the node name, dict of column to number of states
+    """
+    with open(filename, 'rb') as f:
+        head = f.read(6)
+    if any(head.startswith(magic) for magic in [b'PAR1', b'ARROW1', b'FEA1']):
+        return _count_arrow_table(filename, state_columns)
+
+    rows = 0
+    columns = 0
+    headers = []
+    index2values = None
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith('##'):
+                continue
+            fields = line.rstrip('\n').split(delimiter)
+            if index2values is None:
+                columns = len(fields) - 1
+                headers = [f'col{i}' for i in range(len(fields))] if no_headers else fields
+                index2values = {i: set() for i, name in enumerate(headers) if i and name in state_columns}
+                if not no_headers:
+                    continue
+            for i, values in index2values.items():
+                if i < len(fields) and not MISSING_VALUE.match(fields[i]):
+                    values.add(fields[i])
+            rows += 1
+    column2states = {headers[i]: len(values) for i, values in (index2values or {}).items()}
+    return rows, columns, column2states
+
+def _alignment_length(filename):
+    """Length of the first sequence of a fasta alignment."""
+    length = 0
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                if length:
+                    break
+            else:
+                length += len(line.strip())
+    return length
+
+def inspect_inputs(tree, metadata=None, metadata_sep='\t', data_matrix=None, alignment=None,
+        no_headers=False, acr_discrete_columns=None):
+    """
+    Collect the size of the inputs which drive the annotation cost.
+
+    Returns:
+    - dict with tree, metadata, data matrix and alignment sizes, and the
+      number of states of each discrete ACR column
+    """
+    info = {
+        'leaves': 0,
+        'nodes': 0,
+        'internal': 0,
+        'clade_load': 0, # sum of clade sizes of internal nodes, the cost unit of summaries
+        'metadata_rows': 0,
+        'metadata_columns': 0,
+        'matrix_columns': 0,
+        'alignment_length': 0,
+        'acr_states': {},
+    }
+    node2size = {}
+    for node in tree.traverse("postorder"):
+        info['nodes'] += 1
+        if node.is_leaf:
+            node2size[node] = 1
+            info['leaves'] += 1
+        else:
+            node2size[node] = sum(node2size.pop(child) for child in node.children)
+            info['internal'] += 1
+            info['clade_load'] += node2size[node]
+
+    for filename in metadata or []:
+        if os.path.exists(filename):
+            rows, columns, column2states = _count_table(filename, delimiter=metadata_sep,
+                no_headers=no_headers, state_columns=acr_discrete_columns or ())
+            info['metadata_rows'] += rows
+            info['metadata_columns'] += columns
+            for column, states in column2states.items():
+                info['acr_states'][column] = max(info['acr_states'].get(column, 0), states)
+
+    for filename in data_matrix or []:
+        if os.path.exists(filename):
+            _, columns, _ = _count_table(filename, delimiter=metadata_sep)
+            info['matrix_columns'] += columns
+
+    if alignment and os.path.exists(alignment):
+        info['alignment_length'] = _alignment_length(alignment)
+
+    return info
+
+def choose_threads(serial_time, n_tasks, max_threads, transfer_time=0.0):
+    """
+    Pick the number of worker processes of a stage.
+
+    Runtime with t workers is modeled as serial_time / t + transfer_time + t * PROCESS_START_COST,
+    which is minimal at t = sqrt(serial_time / PROCESS_START_COST). Parallelism is only used
+    when it is faster than the serial run.
+    """
+    if max_threads <= 1 or n_tasks <= 1:
+        return 1
+    best = int(round(math.sqrt(serial_time / PROCESS_START_COST)))
+    best = max(1, min(best, max_threads, n_tasks))
+    parallel_time = serial_time / best + transfer_time + best * PROCESS_START_COST
+    if best == 1 or parallel_time >= serial_time:
+        return 1
+    return best
+
+def _parallel_time(serial_time, threads, transfer_time=0.0):
+    if threads <= 1:
+        return serial_time
+    return serial_time / threads + transfer_time + threads * PROCESS_START_COST
+
+def estimate_stages(info, options, costs, max_threads=1):
+    """
+    Predict strategy, threads, runtime and peak memory of each annotation stage.
+
+    Parameters:
+    - info: input sizes from inspect_inputs
+    - options: dict of annotate options, same keys as run_tree_annotate arguments
+    - costs: unit costs from calibrate
+    - max_threads: maximum number of worker processes
+
+    Returns:
+    - list of stage dicts with keys stage, strategy, threads, time, memory
+    """
+    stages = []
+    speed = costs['speed']
+    nodes = info['nodes']
+    leaves = info['leaves']
+    internal = info['internal']
+    clade_load = info['clade_load']
+    columns = info['metadata_columns']
+    tree_memory = nodes * NODE_BYTES + leaves * columns * PROP_BYTES
+
+    def add_stage(stage, strategy, threads, runtime, memory):
+        stages.append({
+            'stage': stage,
+            'strategy': strategy,
+            'threads': threads,
+            'time': runtime,
+            'memory': memory,
+        })
+
+    # parse metadata
+    cells = info['metadata_rows'] * columns
+    add_stage('parse_metadata', 'serial', 1,
+        cells * costs['summary'] * 5,
+        tree_memory + cells * METADATA_CELL_BYTES)
+
+    # internal nodes summary
+    summary_props = 0
+    if options.get('counter_stat', 'raw') != 'none':
+        summary_props += columns
+    if options.get('num_stat', 'all') != 'none':
+        summary_props += columns
+    serial_time = clade_load * summary_props * costs['summary']
+    if options.get('alignment'):
+        serial_time += clade_load * info['alignment_length'] * costs['summary']
+    # each task pickles the clade of the node
+    transfer_time = clade_load * costs['pickle']
+    threads = choose_threads(serial_time, internal, max_threads, transfer_time)
+    strategy = f'process pool ({threads} workers)' if threads > 1 else 'serial'
+    summary_memory = internal * summary_props * PROP_BYTES
+    add_stage('summary', strategy, threads,
+        _parallel_time(serial_time, threads, transfer_time),
+        tree_memory + summary_memory + (clade_load * PICKLE_NODE_BYTES if threads > 1 else 0))
+    tree_memory += summary_memory
+
+    # discrete ACR with pastml, one acr() call per trait,
+    # or with the batched engine, all the traits in the same passes
+    acr_discrete_columns = options.get('acr_discrete_columns') or []
+    if acr_discrete_columns:
+        prediction_method = options.get('prediction_method', 'MPPA')
+        # number of states of each trait, counted in the metadata
+        column_states = [max(2, info.get('acr_states', {}).get(column, 2)) for column in acr_discrete_columns]
+        states = sum(column_states)
+        # transition probabilities of each node are states x states
+        squared_states = sum(n ** 2 for n in column_states)
+        acr_memory = tree_memory + nodes * states * 8 * 4
+        if prediction_method in BATCH_METHODS:
+            acr_time = nodes * squared_states * BATCH_ACR_COST * speed
+            acr_threads = 1
+            acr_strategy = f'batched {prediction_method}, all traits at once'
+        else:
+            acr_time = (len(acr_discrete_columns) * PASTML_CALL_COST + nodes * squared_states * PASTML_NODE_COST) * speed
+            # one trait per process, the tree is shipped once to each process
+            acr_threads = choose_threads(acr_time, len(acr_discrete_columns), max_threads, nodes * costs['pickle'])
+            acr_strategy = f'pastml {prediction_method}, ' + (f'process pool per trait ({acr_threads} workers)' if acr_threads > 1 else 'serial per trait')
+        add_stage('acr_discrete', acr_strategy, acr_threads,
+            _parallel_time(acr_time, acr_threads, nodes * costs['pickle']),
+            acr_memory * max(acr_threads, 1))
+        tree_memory += len(acr_discrete_columns) * nodes * PROP_BYTES
+
+        if options.get('delta_stats') and prediction_method in ['MPPA', 'MAP', 'BATCH_MPPA', 'BATCH_MAP']:
+            sim = options.get('iteration', 10000)
+            chain_time = (sim + 1) * (costs['mcmc_step'] + costs['mcmc_elem'] * internal)
+            # chains of the observed delta
+            chains = options.get('delta_chains', 2)
+            delta_time = len(acr_discrete_columns) * chains * chain_time
+            if options.get('delta_per_clade'):
+                # one delta per clade, on the marginal probabilities of its internal nodes, at most
+                # as small clades are skipped, the clades are sliced from one array per trait
+                clade_time = len(acr_discrete_columns) * chains * (sim + 1) * \
+                    (internal * costs['mcmc_step'] + clade_load * costs['mcmc_elem'])
+                transfer_time = len(acr_discrete_columns) * nodes * costs['pickle']
+                threads = choose_threads(clade_time, len(acr_discrete_columns) * internal, max_threads, transfer_time)
+                strategy = 'per clade, ' + (f'process pool ({threads} workers)' if threads > 1 else 'serial')
+                add_stage('delta', strategy, threads,
+                    _parallel_time(clade_time, threads, transfer_time),
+                    acr_memory + internal * states * 8 * max(threads, 1))
+            else:
+                add_stage('delta', f'serial, {chains} chains', 1, delta_time, acr_memory)
+
+            # permutations, each one is a full acr plus delta, at most
+            # as sequential testing may stop early
+            permutations = options.get('permutations', 100)
+            if options.get('delta_fixed_parameters'):
+                # the observed model parameters are kept, one bottom-up and one top-down pass
+                # instead of the passes of the scaling factor search
+                fixed_time = nodes * squared_states * BATCH_ACR_COST * speed \
+                    * 2 / (SF_GRID + SF_ITERATIONS)
+                permutation_time = permutations * (fixed_time + delta_time)
+            else:
+                permutation_time = permutations * (acr_time + delta_time)
+            transfer_time = permutations * nodes * costs['pickle']
+            threads = choose_threads(permutation_time, permutations, max_threads, transfer_time)
+            strategy = f'up to {permutations} permutations, ' + (f'process pool ({threads} workers)' if threads > 1 else 'serial')
+            add_stage('delta_pval', strategy, threads,
+                _parallel_time(permutation_time, threads, transfer_time),
+                acr_memory * max(threads, 1))
+
+    # continuous ACR, linear-time pruning, the Bayesian sampler works on sufficient statistics
+    acr_continuous_columns = options.get('acr_continuous_columns') or []
+    if acr_continuous_columns:
+        columns = len(acr_continuous_columns)
+        # the OU selection strength search with its profile passes
+        alpha_passes = 3 * (ALPHA_GRID + ALPHA_ITERATIONS + 2) if options.get('model') == 'OU' else 0
+        prediction_method = options.get('prediction_method', 'ML')
+        if prediction_method == 'ML':
+            add_stage('acr_continuous', 'ML with pruning, all traits at once', 1,
+                columns * (alpha_passes + 2) * nodes * PRUNING_NODE_COST * speed,
+                tree_memory + 40 * nodes * 8)
+        elif prediction_method == 'BAYESIAN':
+            # one chain per thread, each sampling all the traits at once
+            # three pruning and three top-down passes, then the node values drawn from the posterior
+            bayesian_time = columns * (alpha_passes + 6) * nodes * PRUNING_NODE_COST * speed \
+                + BAYESIAN_SAMPLING_COST * speed + columns * nodes * NODE_DRAWS * NODE_DRAW_COST * speed
+            add_stage('acr_continuous', 'BAYESIAN with pruning, one chain per thread', max_threads,
+                bayesian_time, tree_memory + columns * 120 * nodes * 8 + min(nodes, NODE_CHUNK) * NODE_DRAWS * 8 * 4)
+        else:
+            # annotate stops here, continuous traits only support ML and BAYESIAN
+            logger.warning(f"Prediction method {prediction_method} is not supported for continuous traits.")
+            add_stage('acr_continuous', f'{prediction_method} not supported, annotate fails', 1, 0, tree_memory)
+
+        # phylogenetic signal, one pruning pass per permutation for K and the lambda search for lambda
+        signal_passes = (1 if options.get('k_stats') else 0) + \
+            ((LAMBDA_GRID + LAMBDA_ITERATIONS + 2) if options.get('lambda_stats') else 0)
+        if signal_passes:
+            permutations = options.get('signal_permutations', 100) + 1
+            signal_time = columns * permutations * signal_passes * nodes * PRUNING_NODE_COST * speed
+            batches = columns * max(1, permutations * nodes // SIGNAL_CELLS)
+            transfer_time = nodes * costs['pickle']
+            threads = choose_threads(signal_time, batches, max_threads, transfer_time)
+            strategy = f'{permutations - 1} permutations, ' + (f'process pool ({threads} workers)' if threads > 1 else 'serial')
+            add_stage('signal', strategy, threads,
+                _parallel_time(signal_time, threads, transfer_time),
+                tree_memory + 12 * min(SIGNAL_CELLS, permutations * nodes * LAMBDA_GRID) * 8 * max(threads, 1))
+
+    # lineage specificity
+    ls_columns = options.get('ls_columns') or []
+    if ls_columns:
+        add_stage('ls', 'serial', 1,
+            len(ls_columns) * clade_load * 2 * costs['summary'],
+            tree_memory + len(ls_columns) * internal * 3 * PROP_BYTES)
+
+    # taxonomic annotation
+    if options.get('taxon_column'):
+        add_stage('taxonomy', f"{options.get('taxadb') or 'GTDB'} database", 1,
+            leaves * TAXA_LEAF_COST * speed + nodes * 2 * costs['summary'],
+            tree_memory + nodes * 8 * PROP_BYTES)
+        tree_memory += nodes * 8 * PROP_BYTES
+
+    # data matrix
+    if info['matrix_columns']:
+        matrix_stats = 5 if options.get('num_stat', 'all') == 'all' else 1
+        add_stage('data_matrix', 'serial', 1,
+            clade_load * info['matrix_columns'] * costs['summary'] * 0.2,
+            tree_memory + nodes * info['matrix_columns'] * 8 * (1 + matrix_stats) * 4)
+        tree_memory += nodes * info['matrix_columns'] * 8 * (1 + matrix_stats) * 4
+        if options.get('data_matrix_parsimony'):
+            # two bit planes of the columns per node, stored hex encoded in internal nodes
+            add_stage('parsimony', 'bitset ACCTRAN, all columns at once', 1,
+                nodes * info['matrix_columns'] * BITSET_COLUMN_COST * speed,
+                tree_memory + nodes * info['matrix_columns'] / 4)
+            tree_memory += internal * info['matrix_columns'] / 2
+
+    # outputs, .ete and newick are streamed in blocks, the table columns are gathered first
+    props = max(columns + summary_props, 1)
+    add_stage('output', 'serial', 1,
+        nodes * props * costs['pickle'] * 3,
+        tree_memory + nodes * props * TABLE_CELL_BYTES + OUTPUT_BUFFER_BYTES)
+
+    return stages
+
+def plan_annotate(tree, options, metadata=None, metadata_sep='\t', data_matrix=None, max_threads=None,
+        no_headers=False):
+    """
+    Build the execution plan of an annotate run.
+
+    Returns:
+    - info: input sizes
+    - stages: list of stage dicts, see estimate_stages
+    """
+    if not max_threads:
+        max_threads = os.cpu_count() or 1
+    info = inspect_inputs(tree, metadata=metadata, metadata_sep=metadata_sep,
+        data_matrix=data_matrix, alignment=options.get('alignment'), no_headers=no_headers,
+        acr_discrete_columns=options.get('acr_discrete_columns'))
+    costs = calibrate()
+    stages = estimate_stages(info, options, costs, max_threads=max_threads)
+    return info, stages
+
+def _format_time(seconds):
+    if seconds < 60:
+        return f'{seconds:.1f}s'
+    elif seconds < 3600:
+        return f'{seconds / 60:.1f}m'
+    elif seconds < 86400:
+        return f'{seconds / 3600:.1f}h'
+    return f'{seconds / 86400:.1f}d'
+
+def _format_memory(nbytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nbytes < 1024:
+            return f'{nbytes:.0f}{unit}'
+        nbytes /= 1024
+    return f'{nbytes:.1f}TB'
+
+def format_plan(info, stages):
+    """Render the execution plan as a text table."""
+    lines = []
+    lines.append(f"Tree: {info['leaves']} leaves, {info['nodes']} nodes")
+    lines.append(f"Metadata: {info['metadata_rows']} rows, {info['metadata_columns']} columns")
+    if info['matrix_columns']:
+        lines.append(f"Data matrix: {info['matrix_columns']} columns")
+    if info['alignment_length']:
+        lines.append(f"Alignment: {info['alignment_length']} columns")
+    lines.append('')
+    lines.append(f"{'stage':<16}{'strategy':<44}{'threads':>8}{'time':>10}{'memory':>10}")
+    for stage in stages:
+        lines.append(f"{stage['stage']:<16}{stage['strategy']:<44}{stage['threads']:>8}"
+                     f"{_format_time(stage['time']):>10}{_format_memory(stage['memory']):>10}")
+    total_time = sum(stage['time'] for stage in stages)
+    peak_memory = max(stage['memory'] for stage in stages)
+    lines.append(f"{'total':<16}{'':<44}{'':>8}{_format_time(total_time):>10}{_format_memory(peak_memory):>10}")
+    return '\n'.join(lines)
+
+def get_stage2threads(stages):
+    """Map stage names to the number of threads chosen by the planner."""
+    return {stage['stage']: stage['threads'] for stage in stages}
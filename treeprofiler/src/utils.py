@@ -1,5 +1,6 @@
 from __future__ import annotations
 from treeprofiler.src import ete_format
+from ete4.parser import newick
 from ete4.parser.newick import NewickError
 from ete4.core.operations import remove
 from ete4 import Tree, PhyloTree
@@ -23,6 +24,7 @@ import Bio
 import re
 import sys, os
 from io import StringIO
+from types import SimpleNamespace
 
 # conditional syntax calling
 operator_dict = {
@@ -234,14 +236,34 @@ def merge_dictionaries(dict1, dict2):
 class TreeFormatError(Exception):
     pass
 
-def validate_tree(tree_path, input_type, internal_parser=None):
+def validate_tree(tree_path, input_type, internal_parser=None, include_props=None, threads=1, cache=False):
     tree = None  # Initialize tree to None
     eteformat_flag = False
+    # only load requested properties from ete format, tree basics are always kept
+    if include_props is not None:
+        include_props = set(include_props) | {'name', 'dist', 'support'}
+
+    # pick the parser from the first bytes of the file
+    if input_type == 'auto' and tree_path != '-':
+        if not os.path.exists(tree_path):
+            raise FileNotFoundError(f"Input tree {tree_path} does not exist.")
+        if not ete_format.sniff_ete(tree_path):
+            input_type = 'newick'
+
     if input_type in ['ete', 'auto']:
         try:
-            with open(tree_path, 'r') as f:
-                file_content = f.read()
-            tree = ete_format.loads(file_content, encoder='pickle', unpack=False)
+            with open(tree_path, 'rb') as f:
+                columnar = ete_format.is_columnar(f.read(len(ete_format.MAGIC)))
+            if columnar:
+                with open(tree_path, 'rb') as f:
+                    tree = ete_format.loads_columnar(f.read(), include_props=include_props)
+            else:
+                # v1 line format is decoded as it is read
+                with ete_format.open_ete(tree_path) as f:
+                    tree = ete_format.load(f, encoder='pickle', unpack=False,
+                        include_props=include_props, threads=threads)
+            if tree is None:
+                raise TreeFormatError("No tree found in ete content")
             eteformat_flag = True
         except Exception as e:
             if input_type == 'ete':
@@ -256,7 +278,13 @@ def validate_tree(tree_path, input_type, internal_parser=None):
             if not os.path.exists(tree_path):
                 raise FileNotFoundError(f"Input tree {tree_path} does not exist.")
             
-            tree = ete4_parse(open(tree_path), internal_parser=internal_parser)
+            if cache:
+                tree = load_tree_cache(tree_path, internal_parser)
+            if tree is None:
+                with open(tree_path) as f:
+                    tree = ete4_parse(f, internal_parser=internal_parser)
+                if cache:
+                    dump_tree_cache(tree, tree_path, internal_parser)
         #except Exception as e:
         #    raise TreeFormatError(f"Error loading tree in 'newick' format: {e}\n"
         #                          "Please try using the correct parser with --internal-parser option, or check the newick format.")
@@ -266,6 +294,50 @@ def validate_tree(tree_path, input_type, internal_parser=None):
 
     return tree, eteformat_flag
 
+# sidecar cache of parsed newick trees, stored in .ete v2 format with the
+# source file path, mtime and size in its header
+TREE_CACHE_SUFFIX = '.tpcache'
+
+def get_tree_cache_key(tree_path, internal_parser=None):
+    stat = os.stat(tree_path)
+    return {
+        'source': os.path.abspath(tree_path),
+        'mtime': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'internal_parser': internal_parser,
+    }
+
+def load_tree_cache(tree_path, internal_parser=None):
+    """
+    Return the cached parsed tree of tree_path, or None if there is no cache
+    or the tree file changed since it was written.
+    """
+    cache_path = tree_path + TREE_CACHE_SUFFIX
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            data = f.read()
+        header, _ = ete_format.read_columnar_header(data)
+        if header.get('meta') != get_tree_cache_key(tree_path, internal_parser):
+            return None
+        return ete_format.ColumnarLoader(data, tree_class=PhyloTree).load()
+    except Exception:
+        return None
+
+def dump_tree_cache(tree, tree_path, internal_parser=None):
+    # cache is skipped when the tree directory is not writable
+    cache_path = tree_path + TREE_CACHE_SUFFIX
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        data = ete_format.dumps_columnar(tree, meta=get_tree_cache_key(tree_path, internal_parser))
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 # parse ete4 Tree
 def get_internal_parser(internal_parser="name"):
     if internal_parser == "name":
@@ -285,6 +357,8 @@ def get_prop2type(node):
                 output[prop] = float
             elif type(value) == list:
                 output[prop] = list
+            elif type(value) == dict:
+                output[prop] = dict
             else:
                 output[prop] = str    
     return output
@@ -302,6 +376,63 @@ def ete4_parse(newick, internal_parser="name"):
             n.dist = 1
     return tree
 
+# newick output
+def newick_prop_repr(value, list_sep='||'):
+    # list values are joined with list_sep instead of newick's default '|'
+    if type(value) == list:
+        value = list_sep.join(map(str, value))
+    return newick.prop_repr(value)
+
+def newick_content_repr(node, props=None, parser=None, list_sep='||'):
+    """
+    Same as ete4 newick content_repr, without modifying node.props to format
+    list values.
+    """
+    prop0, prop1 = parser['leaf' if node.is_leaf else 'internal']
+    p0_name, p1_name = prop0['pname'], prop1['pname']
+
+    p0_str = prop0['write'](node.props[p0_name]) if p0_name in node.props else ''
+    p1_str = prop1['write'](node.props[p1_name]) if p1_name in node.props else ''
+
+    props = props if props is not None else sorted(node.props)
+    pairs_str = ':'.join('%s=%s' % (k, newick_prop_repr(node.props[k], list_sep)) for k in props
+                         if k in node.props and k not in [p0_name, p1_name])
+
+    return (p0_str + (f':{p1_str}' if p1_str else '') +
+            (f'[&&NHX:{pairs_str}]' if pairs_str else ''))
+
+def dump_newick(tree, fp, props=None, parser=None, format_root_node=True, list_sep='||', chunk_size=2**16):
+    """
+    Write tree in newick format with props in NHX to file handle fp, in
+    chunks of chunk_size characters. Unlike tree.write, the newick is never
+    held in memory as a whole, and list props are written joined by list_sep
+    without being converted in the tree.
+    """
+    parser = parser if type(parser) is dict else newick.PARSERS[parser]
+    chunk, size = [], 0
+    for postorder, node in tree.iter_prepostorder():
+        if postorder:
+            text = ')'
+        else:
+            text = ',' if node.up and node.up.children[0] is not node else ''
+            if not node.is_leaf:
+                chunk.append(text + '(')
+                continue
+        if not node.is_root or format_root_node:
+            text += newick_content_repr(node, props, parser, list_sep)
+        chunk.append(text)
+        size += len(text)
+        if size >= chunk_size:
+            fp.write(''.join(chunk))
+            chunk, size = [], 0
+    chunk.append(';\n')
+    fp.write(''.join(chunk))
+
+def dumps_newick(tree, props=None, parser=None, format_root_node=True, list_sep='||'):
+    OUT = StringIO()
+    dump_newick(tree, OUT, props=props, parser=parser, format_root_node=format_root_node, list_sep=list_sep)
+    return OUT.getvalue().rstrip('\n')
+
 # pruning
 def taxatree_prune(tree, rank_limit='subspecies'):
     taxon2values = defaultdict(list)
@@ -327,6 +458,30 @@ def taxatree_prune(tree, rank_limit='subspecies'):
                         remove(ch)
     return tree, taxon2values
 
+def match_conditions(node, conditions, prop2type):
+    """Return True if node satisfies all the parsed conditions (from to_code)."""
+    final_call = False
+    for condition in conditions:
+        op = condition[1]
+        if op == 'in':
+            value = condition[0]
+            prop = condition[2]
+            datatype = prop2type.get(prop)
+            final_call = call(node, prop, datatype, op, value)
+        elif ":" in condition[0]:
+            internal_prop, leaf_prop = condition[0].split(':')
+            value = condition[2]
+            datatype = prop2type[internal_prop]
+            final_call = counter_call(node, internal_prop, leaf_prop, datatype, op, value)
+        else:
+            prop = condition[0]
+            value = condition[2]
+            datatype = prop2type.get(prop)
+            final_call = call(node, prop, datatype, op, value)
+        if final_call == False:
+            break
+    return final_call
+
 def conditional_prune(tree, conditions_input, prop2type):
     conditional_output = []
     single_one = to_code(conditions_input)
@@ -337,39 +492,72 @@ def conditional_prune(tree, conditions_input, prop2type):
         ex = True
         for n in tree.traverse():
             if not n.is_root:
-                final_call = False
                 for or_condition in conditional_output:
-                    for condition in or_condition:
-                        op = condition[1]
-                        if op == 'in':
-                            value = condition[0]
-                            prop = condition[2]
-                            datatype = prop2type.get(prop)
-                            final_call = call(n, prop, datatype, op, value)
-                        elif ":" in condition[0]:
-                            internal_prop, leaf_prop = condition[0].split(':')
-                            value = condition[2]
-                            datatype = prop2type[internal_prop]
-                            final_call = counter_call(n, internal_prop, leaf_prop, datatype, op, value)
-                        else:
-                            prop = condition[0]
-                            value = condition[2]
-                            datatype = prop2type.get(prop)
-                            final_call = call(n, prop, datatype, op, value)
-                        if final_call == False:
-                            break
-                        else:
-                            continue
-                    if final_call:
+                    if match_conditions(n, or_condition, prop2type):
                         n.detach()
                         ex = False
-                    else:
-                        pass
             # else:
-            #     if n.dist == 0: 
+            #     if n.dist == 0:
             #         n.dist = 1
     return tree
 
+def get_target_clade(tree, targets, prop2type={}, metadata_dict=None):
+    """
+    Resolve the --target-clade query into a single node of the tree.
+
+    targets is a list of strings which can be:
+    - one node name, such as ['Internal_1']
+    - several leaf names, or one string joined by '||', resolved as their common ancestor
+    - one query expression with the same syntax as --pruned-by, such as ['rank=phylum,sci_name=Chlamydiota'],
+      resolved as the common ancestor of all the matching nodes
+
+    Query expressions are evaluated on the node props. If metadata_dict (node name -> metadata row,
+    as returned by parse_csv) is given, the row of each node is evaluated together with its props,
+    so metadata columns can be queried before they are loaded on the tree.
+
+    Returns the target node, or None if nothing matched.
+    """
+    common_ancestor_seperator = '||'
+    condition_seperator = ','
+
+    if isinstance(targets, str):
+        targets = [targets]
+
+    if len(targets) == 1 and common_ancestor_seperator in targets[0]:
+        targets = targets[0].split(common_ancestor_seperator)
+
+    if len(targets) == 1:
+        target = targets[0]
+        hit = next(tree.search_nodes(name=target), None)
+        if hit is not None:
+            return hit
+
+        # query expression
+        conditions = to_code(target.split(condition_seperator))
+        if not conditions:
+            return None
+        if metadata_dict:
+            hits = [n for n in tree.traverse()
+                if match_conditions(SimpleNamespace(props={**n.props, **metadata_dict.get(n.name, {})}),
+                    conditions, prop2type)]
+        else:
+            hits = [n for n in tree.traverse() if match_conditions(n, conditions, prop2type)]
+    else:
+        name2node = {}
+        for n in tree.traverse():
+            if n.name in targets and n.name not in name2node:
+                name2node[n.name] = n
+        if len(name2node) != len(set(targets)):
+            return None
+        hits = list(name2node.values())
+
+    if not hits:
+        return None
+    elif len(hits) == 1:
+        return hits[0]
+    else:
+        return tree.common_ancestor(hits)
+
 # def _tree_prop_array(node, prop, leaf_only=False, numeric=False, list_type=False):
 #     array = []
 #     sep = '||'
@@ -653,6 +841,25 @@ def build_custom_gradient(n_colors, min_color, max_color, mid_color=None):
     
     return color_gradient
     
+def topology_clone(tree, props=('name', 'dist', 'support')):
+    """
+    Return a copy of the tree topology keeping only the given props of each
+    node, much lighter than tree.copy() which pickles every property.
+    """
+    node_class = tree.__class__
+    root = node_class()
+    root.props = {p: tree.props[p] for p in props if p in tree.props}
+    stack = [(tree, root)]
+    while stack:
+        node, clone = stack.pop()
+        for child in node.children:
+            child_clone = node_class()
+            child_clone.props = {p: child.props[p] for p in props if p in child.props}
+            child_clone.up = clone
+            clone.children.append(child_clone)
+            stack.append((child, child_clone))
+    return root
+
 def clear_extra_features(forest, features):
     features = set(features) | {'name', 'dist', 'support'}
     for tree in forest:
@@ -10,8 +10,11 @@ import tarfile
 
 from collections import defaultdict, Counter
 import itertools
+import glob
 import numpy as np
 from scipy import stats
+from scipy import sparse
+from scipy import io as scipy_io
 import requests
 
 from ete4.parser.newick import NewickError
@@ -22,12 +25,20 @@ from ete4 import GTDBTaxa
 from ete4 import NCBITaxa
 
 from treeprofiler.src import utils
-from treeprofiler.src.phylosignal import run_acr_discrete, run_acr_continuous, run_delta
+from treeprofiler.src.phylosignal import run_acr_discrete, run_acr_continuous, run_delta, run_lambda, run_kappa, delta
+from treeprofiler.src.acr_discrete import TreeArrays, load_bit_states, bitset_parsimony, \
+    fixed_marginals, model_parameters
 from treeprofiler.src.ls import run_ls
 from treeprofiler.src import ete_format
+from treeprofiler.src import planner
 
 from multiprocessing import Pool
 
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
 DESC = "annotate tree"
 
 TAXONOMICDICT = {# start with leaf name
@@ -52,7 +63,7 @@ EMAPPER_HEADERS = ["#query", "seed_ortholog", "evalue", "score", "eggNOG_OGs",
 
 # Available methods and models for ACR
 # Discrete traits
-DISCRETE_METHODS = ['MPPA', 'MAP', 'JOINT', 'DOWNPASS', 'ACCTRAN', 'DELTRAN', 'COPY', 'ALL', 'ML', 'MP']
+DISCRETE_METHODS = ['MPPA', 'MAP', 'JOINT', 'DOWNPASS', 'ACCTRAN', 'DELTRAN', 'COPY', 'ALL', 'ML', 'MP', 'BATCH_MPPA', 'BATCH_MAP']
 DISCRETE_MODELS = ['JC', 'F81', 'EFT']
 
 # Continuous traits
@@ -75,11 +86,17 @@ def populate_annotate_args(parser):
         description="Input parameters of METADATA")
     add = gmeta.add_argument
     add('-m', '--metadata', nargs='+',
-        help="<metadata.csv> .csv, .tsv. mandatory input")
+        help="<metadata.csv> .csv, .tsv, or .parquet, .feather, .arrow when pyarrow is installed. mandatory input")
+    add('--metadata-columns', nargs='+',
+        help="<col1> <col2> names of the only metadata columns to read, all of them by default")
     # add('--data-matrix', nargs='+',
     #     help="<metadata.csv> .csv, .tsv. optional input")
     add('--data-matrix',  nargs='+',
         help="<datamatrix.csv> .csv, .tsv. matrix data metadata table as array to tree, please do not provide column headers in this file")
+    add('--sparse-matrix', nargs='+',
+        help=("<matrix.mtx|.npz|.tsv> sparse presence-absence matrix as MatrixMarket (names in <matrix>.mtx.rows and "
+              "<matrix>.mtx.cols), scipy .npz with row_names and col_names arrays, or 'name column [value]' triples. "
+              "Filename will become the property name in the tree"))
     add('-s', '--metadata-sep', default='\t',
         help="column separator of metadata table [default: \\t]")
     add('--no-headers', action='store_true',
@@ -142,6 +159,24 @@ def populate_annotate_args(parser):
         type=float, 
         default=0.7,
         help='Consensus cutoff for alignment annotation. If cutoff is 0.0 means no consensus sequences in ancestor nodes. [default: 0.7]')
+    clade_group = parser.add_argument_group(title='Target clade arguments',
+        description="Restrict annotation to one clade of the tree")
+    clade_group.add_argument('--target-clade', nargs='+',
+        help=("Only annotate the clade given by a node name, the common ancestor of "
+              "listed leaves (<leaf1> <leaf2> or <leaf1>||<leaf2>), or a query expression "
+              "with the same syntax as --pruned-by such as \"phylum=Chlamydiota\". Query "
+              "expressions are evaluated on the props of an annotated tree and on the columns "
+              "of --metadata. The rest of the tree is kept untouched."))
+    clade_group.add_argument('--target-clade-only', action='store_true',
+        help="Output only the target clade instead of the whole tree.")
+    forest_group = parser.add_argument_group(title='Forest arguments',
+        description="Annotate a collection of trees against the same metadata")
+    forest_group.add_argument('--forest', action='store_true',
+        help=("Treat --tree as a collection of trees: a directory, a glob pattern such as \"trees/*.nw\" "
+              "or a multi-newick file. Metadata and taxonomy database are loaded once and trees are "
+              "annotated in --threads processes, a report of each tree is written to forest_report.tsv."))
+    forest_group.add_argument('--forest-chunksize', type=int, default=16,
+        help="Number of trees sent to a process at once in --forest mode [default: 16]")
     annotation_group = parser.add_argument_group(title='Internal nodes annotation arguments',
         description="Annotation parameters")
     annotation_group.add_argument('--column-summary-method', 
@@ -170,6 +205,10 @@ def populate_annotate_args(parser):
     # ACR for discrete traits columns
     acr_group.add_argument('--acr-discrete-columns', nargs='+',
         help=("List of column names (e.g., <col1> <col2>) to perform ACR analysis for discrete traits."))
+    acr_group.add_argument('--data-matrix-parsimony', action='store_true', default=False,
+        help=("Reconstruct the presence/absence (values > 0) of every column of --data-matrix "
+              "in internal nodes by ACCTRAN parsimony, with the number of changes, gains and losses "
+              "of each column in the root."))
     # ACR for continuous traits columns
     acr_group.add_argument('--acr-continuous-columns', nargs='+',
         help=("List of column names (e.g., <col1> <col2>) to perform ACR analysis for continuous traits."))
@@ -193,7 +232,7 @@ def populate_annotate_args(parser):
         default=4,
         type=int,
         required=False,
-        help="Number of threads to use for annotation [default: 4]")
+        help="Number of threads to use for annotation, 0 to choose the number of threads of each stage automatically [default: 4]")
     delta_group = parser.add_argument_group(title='Ancestral Character Reconstruction arguments',
         description="Delta statistic parameters")
     delta_group.add_argument('--delta-stats',
@@ -232,6 +271,56 @@ def populate_annotate_args(parser):
         type=int, 
         default=100, 
         help='Burned-in iterates.')
+    delta_group.add_argument('--delta-permutations', 
+        type=int, 
+        default=100, 
+        help='Maximum number of trait permutations for the p_value of delta statistic. [default: 100]')
+    delta_group.add_argument('--delta-pval-alpha', 
+        type=float, 
+        default=0.05, 
+        help='Significance level of the sequential permutation test, permutations stop once the 95%% confidence interval of p_value excludes it, or after 10 permuted deltas above the observed one (Besag-Clifford). 0 runs all --delta-permutations. [default: 0.05]')
+    delta_group.add_argument('--delta-chains', 
+        type=int, 
+        default=2, 
+        help='Number of MCMC chains of the delta statistic, run in parallel with --threads. [default: 2]')
+    delta_group.add_argument('--delta-target-ess', 
+        type=float, 
+        default=0, 
+        help='Stop the delta chains early once their effective sample size reaches this value and R-hat is below --delta-max-rhat, checked every 500 iterations. 0 runs all --iteration iterations. [default: 0]')
+    delta_group.add_argument('--delta-max-rhat', 
+        type=float, 
+        default=1.01, 
+        help='R-hat below which the delta chains are considered converged for --delta-target-ess. [default: 1.01]')
+    delta_group.add_argument('--delta-per-clade', 
+        action='store_true',
+        required=False,
+        help='Calculate delta statistic of every clade with at least --delta-min-clade-size leaves, clades run in parallel with --threads. [default: False]')
+    delta_group.add_argument('--delta-min-clade-size', 
+        type=int, 
+        default=10, 
+        help='Minimum number of leaves of a clade for --delta-per-clade. [default: 10]')
+    delta_group.add_argument('--delta-fixed-parameters', 
+        action='store_true',
+        required=False,
+        help='Reuse the model parameters estimated on the observed traits for the permutations of the p_value of delta statistic, only recomputing the marginal probabilities of each permuted trait in one pruning pass instead of a full ACR. [default: False]')
+    signal_group = parser.add_argument_group(title='Phylogenetic signal arguments',
+        description="Phylogenetic signal parameters of continuous traits")
+    signal_group.add_argument('--lambda-stats',
+        action='store_true',
+        required=False,
+        help="Calculate Pagel's lambda of the continuous traits of --acr-continuous-columns. [default: False]")
+    signal_group.add_argument('--k-stats',
+        action='store_true',
+        required=False,
+        help="Calculate Blomberg's K of the continuous traits of --acr-continuous-columns. [default: False]")
+    signal_group.add_argument('--signal-permutations',
+        type=int,
+        default=100,
+        help='Number of trait permutations for the p_value of lambda and K, run in parallel with --threads. [default: 100]')
+    signal_group.add_argument('--signal-seed',
+        type=int,
+        default=42,
+        help='Random seed of the lambda and K permutations. [default: 42]')
     ls_group = parser.add_argument_group(title='Lineage Specificity Analysis arguments',
         description="ls parameters")
     ls_group.add_argument('--prec-cutoff',
@@ -255,10 +344,38 @@ def populate_annotate_args(parser):
         default=False,
         action='store_true',
         help="Print the output to stdout")
+    group.add_argument('--plan', '--dry-run',
+        dest='plan',
+        default=False,
+        action='store_true',
+        help="Print the execution plan with predicted runtime and peak memory of each stage, then exit without annotating")
     group.add_argument('-o', '--outdir',
         type=str,
         required=False,
         help="Directory for annotated outputs.")
+    group.add_argument('--ete-version',
+        type=int,
+        choices=[1, 2],
+        default=1,
+        required=False,
+        help="Version of the annotated .ete output. 1 is the text format, 2 is the binary columnar format which is smaller and faster to load for large trees [default: 1]")
+    group.add_argument('--ete-compression',
+        type=str,
+        choices=['none', 'gzip', 'zstd'],
+        default='none',
+        required=False,
+        help="Compress the annotated .ete output of version 1 while it is written, zstd requires the zstandard package [default: none]")
+    group.add_argument('--ete-compression-level',
+        type=int,
+        default=None,
+        required=False,
+        help="Compression level of --ete-compression [default: 6 for gzip, 3 for zstd]")
+    group.add_argument('--table-format',
+        type=str,
+        choices=['tsv', 'parquet', 'feather'],
+        default='tsv',
+        required=False,
+        help="Format of the annotated table output, parquet and feather require the pyarrow package [default: tsv]")
 
 def run_tree_annotate(tree, input_annotated_tree=False,
         metadata_dict={}, node_props=[], columns={}, prop2type={},
@@ -272,8 +389,12 @@ def run_tree_annotate(tree, input_annotated_tree=False,
         acr_discrete_columns=[], acr_continuous_columns=[], prediction_method="MPPA", model="F81", 
         delta_stats=False, ent_type="SE", 
         iteration=100, lambda0=0.1, se=0.5, thin=10, burn=100, 
+        delta_chains=2, delta_target_ess=0, delta_max_rhat=1.01, 
+        delta_permutations=100, delta_pval_alpha=0.05, 
+        delta_per_clade=False, delta_min_clade_size=10, delta_fixed_parameters=False, 
+        lambda_stats=False, k_stats=False, signal_permutations=100, signal_seed=42, 
         ls_columns=None, prec_cutoff=0.95, sens_cutoff=0.95, 
-        threads=1, outdir='./'):
+        threads=1, stage2threads={}, outdir='./', update_taxadb=True):
 
     total_color_dict = []
     layouts = []
@@ -472,7 +593,7 @@ def run_tree_annotate(tree, input_annotated_tree=False,
                     "Molecular Biology and Evolution, msz131.")
         acr_discrete_columns_dict = {k: v for k, v in columns.items() if k in acr_discrete_columns}
         acr_results, annotated_tree = run_acr_discrete(annotated_tree, acr_discrete_columns_dict, \
-        prediction_method=prediction_method, model=model, threads=threads, outdir=outdir)
+        prediction_method=prediction_method, model=model, threads=stage2threads.get('acr_discrete', threads), outdir=outdir)
         
         # Clear extra features
         utils.clear_extra_features([annotated_tree], prop2type.keys())
@@ -481,15 +602,23 @@ def run_tree_annotate(tree, input_annotated_tree=False,
         # only MPPA,MAP method has marginal probabilities to calculate delta
         if delta_stats:
             
-            if prediction_method in ['MPPA', 'MAP']:
+            if prediction_method in ['MPPA', 'MAP', 'BATCH_MPPA', 'BATCH_MAP']:
                 logger.info(f"Performing Delta Statistic analysis with Character {acr_discrete_columns}...\n")
-                prop2delta = run_delta(acr_results, annotated_tree, ent_type=ent_type, 
+                # with delta_per_clade, the delta of the root comes with the ones of the clades
+                prop2delta, prop2diagnostics = run_delta(acr_results, annotated_tree, ent_type=ent_type, 
                 lambda0=lambda0, se=se, sim=iteration, burn=burn, thin=thin, 
-                threads=threads)
+                threads=stage2threads.get('delta', threads), chains=delta_chains, 
+                target_ess=delta_target_ess, max_rhat=delta_max_rhat, return_diagnostics=True, 
+                run_whole_tree=delta_per_clade, min_clade_size=delta_min_clade_size)
 
                 for prop, delta_result in prop2delta.items():
-                    logger.info(f"Delta statistic of {prop} is: {delta_result}")
+                    diagnostics = prop2diagnostics[prop]
+                    logger.info(f"Delta statistic of {prop} is: {delta_result} "
+                        f"(R-hat {diagnostics['rhat']:.4f}, ESS {diagnostics['ess']:.0f}, "
+                        f"{diagnostics['iterations']} iterations)")
                     annotated_tree.add_prop(utils.add_suffix(prop, "delta"), delta_result)
+                    annotated_tree.add_prop(utils.add_suffix(prop, "delta_rhat"), diagnostics['rhat'])
+                    annotated_tree.add_prop(utils.add_suffix(prop, "delta_ess"), diagnostics['ess'])
 
                 # start calculating p_value
                 logger.info(f"Calculating p_value for delta statistic...")
@@ -499,22 +628,29 @@ def run_tree_annotate(tree, input_annotated_tree=False,
                 "[2] Ribeiro, D. et al. (2023). Testing phylogenetic signal with categorical traits and tree uncertainty, "
                 "Bioinformatics, Volume 39, Issue 7, July 2023")
                 
-                # get a copy of the tree
-                dump_tree = annotated_tree.copy()
-                utils.clear_extra_features([dump_tree], ["name", "dist", "support"])
+                # get a topology-only copy of the tree
+                dump_tree = utils.topology_clone(annotated_tree)
                 
+                # only the permuted traits are loaded to the tree of each iteration
                 prop2array = {}
-                for prop in columns.keys():
+                for prop in acr_discrete_columns_dict.keys():
                     prop2array.update(convert_to_prop_array(metadata_dict, prop))
                 
+                # the permuted traits keep the model parameters of the observed ones
+                prop2params = None
+                if delta_fixed_parameters:
+                    prop2params = {prop: model_parameters(acr_result[0]) for prop, acr_result in acr_results.items()}
+
                 prop2delta_array = get_pval(prop2array, dump_tree, acr_discrete_columns_dict, \
-                    iteration=100, prediction_method=prediction_method, model=model,
+                    iteration=delta_permutations, prediction_method=prediction_method, model=model,
                     ent_type=ent_type, lambda0=lambda0, se=se, sim=iteration, burn=burn, thin=thin, 
-                    threads=threads)
+                    chains=delta_chains, target_ess=delta_target_ess, max_rhat=delta_max_rhat, 
+                    prop2delta=prop2delta, pval_alpha=delta_pval_alpha, prop2params=prop2params, 
+                    threads=stage2threads.get('delta_pval', threads))
 
                 for prop, delta_array in prop2delta_array.items():
                     p_value = np.sum(np.array(delta_array) > prop2delta[prop]) / len(delta_array)
-                    logger.info(f"p_value of {prop} is {p_value}")
+                    logger.info(f"p_value of {prop} is {p_value} ({len(delta_array)} permutations)")
                     annotated_tree.add_prop(utils.add_suffix(prop, "pval"), p_value)
                     prop2type.update({
                         utils.add_suffix(prop, "pval"): float
@@ -522,10 +658,12 @@ def run_tree_annotate(tree, input_annotated_tree=False,
 
                 for prop in acr_discrete_columns:
                     prop2type.update({
-                        utils.add_suffix(prop, "delta"): float
+                        utils.add_suffix(prop, "delta"): float,
+                        utils.add_suffix(prop, "delta_rhat"): float,
+                        utils.add_suffix(prop, "delta_ess"): float
                     })
             else:
-                logger.warning(f"Delta statistic analysis only support MPPA and MAP prediction method, {prediction_method} is not supported.")
+                logger.warning(f"Delta statistic analysis only support MPPA, MAP, BATCH_MPPA and BATCH_MAP prediction method, {prediction_method} is not supported.")
 
         end = time.time()
         logger.info(f'Time for acr to run: {end - start}')
@@ -556,10 +694,32 @@ def run_tree_annotate(tree, input_annotated_tree=False,
                 transformed_dict[prop][leaf] = float(props[prop])
 
         start = time.time()
-        acr_results, tree = run_acr_continuous(annotated_tree, transformed_dict, model=model, prediction_method=prediction_method, threads=threads, outdir=outdir)
+        acr_results, tree = run_acr_continuous(annotated_tree, transformed_dict, model=model, prediction_method=prediction_method,
+            threads=stage2threads.get('acr_continuous', threads), outdir=outdir)
+        for prop in acr_continuous_columns:
+            prop2type.update({
+                utils.add_suffix(prop, "ci_lower"): float,
+                utils.add_suffix(prop, "ci_upper"): float,
+            })
         end = time.time()
         logger.info(f'Time for acr to run: {end - start}')
 
+        # phylogenetic signal of the continuous traits
+        for statistic, stats_on, run_signal_stats in (('lambda', lambda_stats, run_lambda), ('K', k_stats, run_kappa)):
+            if not stats_on:
+                continue
+            logger.info(f"Performing {statistic} phylogenetic signal analysis with Character {acr_continuous_columns}...\n")
+            prop2signal = run_signal_stats(annotated_tree, transformed_dict, permutations=signal_permutations,
+                threads=stage2threads.get('signal', threads), seed=signal_seed)
+            for prop, signal in prop2signal.items():
+                logger.info(f"{statistic} of {prop} is {signal[statistic]} (p_value {signal['pval']}, {signal_permutations} permutations)")
+                annotated_tree.add_prop(utils.add_suffix(prop, statistic), signal[statistic])
+                annotated_tree.add_prop(utils.add_suffix(prop, f"{statistic}_pval"), signal['pval'])
+                prop2type.update({
+                    utils.add_suffix(prop, statistic): float,
+                    utils.add_suffix(prop, f"{statistic}_pval"): float,
+                })
+
     # lineage specificity analysis
     if ls_columns:
         logger.info(f"Performing Lineage Specificity analysis with Character {ls_columns}...\n")
@@ -616,8 +776,9 @@ def run_tree_annotate(tree, input_annotated_tree=False,
                 nodes_data.append(node_data)
         
         # Process nodes in parallel if more than one thread is specified
-        if threads > 1:
-            with Pool(threads) as pool:
+        summary_threads = stage2threads.get('summary', threads)
+        if summary_threads > 1:
+            with Pool(summary_threads) as pool:
                 results = pool.map(process_node, nodes_data)
         else:
             # For single-threaded execution, process nodes sequentially
@@ -645,38 +806,9 @@ def run_tree_annotate(tree, input_annotated_tree=False,
             logger.error('Please specify which taxa db using --taxadb <GTDB|NCBI>')
             sys.exit(1)
         else:
-            if taxadb == 'GTDB':
-                if gtdb_version and taxa_dump:
-                    logger.error('Please specify either GTDB version or taxa dump file, not both.')
-                    sys.exit(1)
-                if gtdb_version:
-                    # get taxadump from ete-data
-                    gtdbtaxadump = get_gtdbtaxadump(gtdb_version)
-                    logger.info(f"Loading GTDB database dump file {gtdbtaxadump}...")
-                    GTDBTaxa().update_taxonomy_database(gtdbtaxadump)
-                elif taxa_dump:
-                    logger.info(f"Loading GTDB database dump file {taxa_dump}...")
-                    GTDBTaxa().update_taxonomy_database(taxa_dump)
-                else:
-                    logger.info("No specific version or dump file provided; using latest GTDB data...")
-                    GTDBTaxa().update_taxonomy_database()
-            elif taxadb == 'MOTUS':
-                if gtdb_version and taxa_dump:
-                    logger.error('Please specify either GTDB version or taxa dump file, not both.')
-                    sys.exit(1)
-                if taxa_dump:
-                    logger.info(f"Loading GTDB database dump file {taxa_dump}...")
-                    GTDBTaxa().update_taxonomy_database(taxa_dump)
-                else:
-                    logger.info("No specific version or dump file provided; using latest GTDB data...")
-                    motus_dump = download_motus_dump()
-                    GTDBTaxa().update_taxonomy_database(motus_dump)
-            elif taxadb == 'NCBI':
-                if taxa_dump:
-                    logger.info(f"Loading NCBI database dump file {taxa_dump}...")
-                    NCBITaxa().update_taxonomy_database(taxa_dump)
-                # else:
-                #     NCBITaxa().update_taxonomy_database()
+            if update_taxadb:
+                load_taxonomy_database(taxadb, gtdb_version=gtdb_version, taxa_dump=taxa_dump)
+                TAXA_DB_CACHE.clear()
 
             annotated_tree, rank2values = annotate_taxa(annotated_tree, db=taxadb, \
                     taxid_attr=taxon_column, sp_delimiter=taxon_delimiter, sp_field=taxa_field, \
@@ -738,6 +870,88 @@ def run_array_annotate(tree, array_dict, num_stat='none', column2method={}, prop
     return tree
 
 
+def run_array_parsimony(tree, array_dict, prop2type={}):
+    """
+    Reconstruct the presence/absence of every column of the data matrices with
+    bitset ACCTRAN parsimony:
+    - <prop>_parsimony: in internal nodes, the absent and present bit planes
+      of the columns as hex encoded little-endian uint64 words, decoded by
+      decode_bit_states into 1 present, 0 absent and NaN when both are
+      equally parsimonious
+    - <prop>_steps, <prop>_gains and <prop>_losses: in the root, the number of
+      changes of each column, and of those resolved as gains and losses
+    """
+    start = time.time()
+    arrays = TreeArrays(tree)
+    internal = np.flatnonzero(~arrays.is_leaf)
+    for prop, leaf2values in array_dict.items():
+        n_columns = max((len(values) for values in leaf2values.values() if values is not None), default=0)
+        if not n_columns:
+            continue
+        absent, present = load_bit_states(arrays, leaf2values, n_columns)
+        absent, present, steps, gains, losses = bitset_parsimony(arrays, absent, present, n_columns)
+        # the states stay packed, 2 bits per column in each node
+        for i in internal:
+            arrays.nodes[i].add_prop(utils.add_suffix(prop, 'parsimony'), 
+                [absent[i].astype('<u8').tobytes().hex(), present[i].astype('<u8').tobytes().hex()])
+        tree.add_prop(utils.add_suffix(prop, 'steps'), steps.tolist())
+        tree.add_prop(utils.add_suffix(prop, 'gains'), gains.tolist())
+        tree.add_prop(utils.add_suffix(prop, 'losses'), losses.tolist())
+        for suffix in ['parsimony', 'steps', 'gains', 'losses']:
+            prop2type[utils.add_suffix(prop, suffix)] = list
+    end = time.time()
+    logger.info(f'Time for run_array_parsimony to run: {end - start}')
+    return tree
+
+def run_sparse_annotate(tree, sparse_dict, prop2type={}):
+    """
+    Annotate sparse matrices to the leaves, as dicts of their nonzero
+    columns, and summarize them on internal nodes by merging the dicts of the
+    children bottom-up:
+    - <prop>_sum: sum of the values of each column in the clade
+    - <prop>_prevalence: fraction of leaves of the clade where each column is nonzero
+    """
+    start = time.time()
+    for prop, rows in sparse_dict.items():
+        # presence-absence counts are the sums, they are only tracked apart for other values
+        binary = all(value == 1 for row in rows.values() for value in row.values())
+        merged_dicts = [{}] if binary else [{}, {}] # node to clade sums, and clade counts
+        node2size = {}
+        for node in tree.traverse('postorder'):
+            if node.is_leaf:
+                row = rows.get(node.name)
+                if row:
+                    node.add_prop(prop, row)
+                merged_dicts[0][node] = row or {}
+                if not binary:
+                    merged_dicts[1][node] = dict.fromkeys(row or {}, 1)
+                node2size[node] = 1
+                continue
+
+            node2size[node] = sum(node2size.pop(child) for child in node.children)
+            for node2merged in merged_dicts:
+                child_dicts = sorted((node2merged.pop(child) for child in node.children), key=len, reverse=True)
+                merged = dict(child_dicts[0])
+                for child_dict in child_dicts[1:]:
+                    for column, value in child_dict.items():
+                        merged[column] = merged.get(column, 0) + value
+                node2merged[node] = merged
+
+            clade_sum = merged_dicts[0][node]
+            clade_count = merged_dicts[-1][node]
+            if clade_sum:
+                size = node2size[node]
+                node.add_prop(utils.add_suffix(prop, 'sum'), clade_sum)
+                node.add_prop(utils.add_suffix(prop, 'prevalence'),
+                    {column: count / size for column, count in clade_count.items()})
+
+        prop2type[prop] = dict
+        prop2type[utils.add_suffix(prop, 'sum')] = dict
+        prop2type[utils.add_suffix(prop, 'prevalence')] = dict
+    end = time.time()
+    logger.info(f'Time for run_sparse_annotate to run: {end - start}')
+    return tree
+
 def run(args):
     total_color_dict = []
     layouts = []
@@ -755,7 +969,7 @@ def run(args):
                 sys.exit(1)
 
     # Validation: Ensure at least one of --outdir or --stdout is selected
-    if not args.outdir and not args.stdout:
+    if not args.outdir and not args.stdout and not args.plan:
         logger.error("You must specify either --outdir or --stdout to output results.")
         sys.exit(1)
 
@@ -763,11 +977,19 @@ def run(args):
         if not os.path.exists(args.outdir):
             logger.error(f"Output directory {args.outdir} does not exist.") 
             sys.exit(1)
+
+    if args.table_format != 'tsv' and pa is None:
+        logger.error(f"--table-format {args.table_format} requires the pyarrow package.")
+        sys.exit(1)
         
+    if args.forest:
+        return run_forest(args)
+
 
     # parsing tree
     try:
-        tree, eteformat_flag = utils.validate_tree(args.tree, args.input_type, args.internal)
+        tree, eteformat_flag = utils.validate_tree(args.tree, args.input_type, args.internal,
+            threads=max(args.threads, 1), cache=args.tree_cache)
         # get tree orignal properties
         for path, node in tree.iter_prepostorder():
             prop2type.update(utils.get_prop2type(node))
@@ -795,16 +1017,83 @@ def run(args):
 
     logger.info(f'Loaded tree: {args.tree} \n{tree.describe()}')
 
+    # restrict annotation to target clade, the clade is detached and annotated
+    # as an independent tree, then attached back to its parent before output
+    full_tree = None
+    parsed_metadata = None
+    if args.target_clade:
+        target_clade = utils.get_target_clade(tree, args.target_clade, prop2type)
+        if target_clade is None and args.metadata:
+            # query on metadata columns, evaluated against the metadata rows of the whole tree
+            parsed_metadata = parse_csv(args.metadata, delimiter=args.metadata_sep, \
+            no_headers=args.no_headers, duplicate=args.duplicate, \
+            target_nodes={node.name for node in tree.traverse()}, include_props=args.metadata_columns)
+            target_clade = utils.get_target_clade(tree, args.target_clade,
+                {**prop2type, **parsed_metadata[3]}, metadata_dict=parsed_metadata[0])
+        if target_clade is None:
+            logger.error(f"Target clade {' '.join(args.target_clade)} not found in tree.")
+            sys.exit(1)
+
+        if not target_clade.is_root:
+            # name nodes in the context of the whole tree to keep names unique
+            tree = name_nodes(tree)
+            full_tree = tree
+            clade_parent = target_clade.up
+            clade_index = clade_parent.children.index(target_clade)
+            target_clade.detach()
+            tree = target_clade
+        logger.info(f'Target clade: {tree.name} with {len(tree)} leaves')
+
+    # execution plan
+    stage2threads = {}
+    if args.plan or args.threads == 0:
+        plan_options = {
+            "alignment": args.alignment,
+            "counter_stat": args.counter_stat,
+            "num_stat": args.num_stat,
+            "acr_discrete_columns": args.acr_discrete_columns,
+            "acr_continuous_columns": args.acr_continuous_columns,
+            "prediction_method": args.prediction_method,
+            "model": args.model,
+            "delta_stats": args.delta_stats,
+            "iteration": args.iteration,
+            "delta_chains": args.delta_chains,
+            "delta_per_clade": args.delta_per_clade,
+            "delta_fixed_parameters": args.delta_fixed_parameters,
+            "permutations": args.delta_permutations,
+            "lambda_stats": args.lambda_stats,
+            "k_stats": args.k_stats,
+            "signal_permutations": args.signal_permutations,
+            "data_matrix_parsimony": args.data_matrix_parsimony,
+            "ls_columns": args.ls_columns,
+            "taxon_column": args.taxon_column,
+            "taxadb": args.taxadb,
+        }
+        max_threads = args.threads if args.threads > 0 else None
+        plan_info, plan_stages = planner.plan_annotate(tree, plan_options, metadata=args.metadata,
+            metadata_sep=args.metadata_sep, data_matrix=args.data_matrix, max_threads=max_threads,
+            no_headers=args.no_headers)
+        if args.plan:
+            print(planner.format_plan(plan_info, plan_stages))
+            return
+        stage2threads = planner.get_stage2threads(plan_stages)
+        logger.info(f'Threads chosen for each stage: {stage2threads}')
+
     # parse csv to metadata table
     start = time.time()
     logger.info(f'start parsing...')
 
     # extrac nodes name for filtering metadata
-    node_names = {node.name for node in tree.traverse()} 
+    node_names = {node.name for node in tree.traverse()}
     # parsing metadata
-    if args.metadata: # make a series of metadatas
+    if parsed_metadata is not None: # already parsed to resolve the target clade
+        metadata_dict, node_props, columns, metadata_prop2type = parsed_metadata
+        metadata_dict = {name: row for name, row in metadata_dict.items() if name in node_names}
+        columns = get_columns(metadata_dict, node_props)
+        prop2type.update(metadata_prop2type)
+    elif args.metadata: # make a series of metadatas
         metadata_dict, node_props, columns, metadata_prop2type = parse_csv(args.metadata, delimiter=args.metadata_sep, \
-        no_headers=args.no_headers, duplicate=args.duplicate, target_nodes=node_names)
+        no_headers=args.no_headers, duplicate=args.duplicate, target_nodes=node_names, include_props=args.metadata_columns)
         
         prop2type.update(metadata_prop2type)
     else: # annotated_tree
@@ -813,6 +1102,8 @@ def run(args):
     
     if args.data_matrix:
         array_dict = parse_tsv_to_array(args.data_matrix, delimiter=args.metadata_sep)
+    if args.sparse_matrix:
+        sparse_dict = parse_sparse_matrix(args.sparse_matrix, delimiter=args.metadata_sep, target_nodes=node_names)
     end = time.time()
     logger.info(f'Time for parse_csv to run: {end - start}')
     
@@ -879,6 +1170,18 @@ def run(args):
         "se": args.se,
         "thin": args.thin,
         "burn": args.burn,
+        "delta_chains": args.delta_chains,
+        "delta_target_ess": args.delta_target_ess,
+        "delta_max_rhat": args.delta_max_rhat,
+        "delta_permutations": args.delta_permutations,
+        "delta_pval_alpha": args.delta_pval_alpha,
+        "delta_per_clade": args.delta_per_clade,
+        "delta_min_clade_size": args.delta_min_clade_size,
+        "delta_fixed_parameters": args.delta_fixed_parameters,
+        "lambda_stats": args.lambda_stats,
+        "k_stats": args.k_stats,
+        "signal_permutations": args.signal_permutations,
+        "signal_seed": args.signal_seed,
         "ls_columns": args.ls_columns,
         "prec_cutoff": args.prec_cutoff,
         "sens_cutoff": args.sens_cutoff,
@@ -913,7 +1216,8 @@ def run(args):
     output_options = {
         "rank_limit": args.rank_limit,
         "pruned_by": args.pruned_by,
-        "threads": args.threads,
+        "threads": max(args.threads, 1),
+        "stage2threads": stage2threads,
         "outdir": args.outdir,
     }
     
@@ -937,70 +1241,21 @@ def run(args):
         # update prop2type
         for filename in array_dict.keys():
             prop2type[filename] = list
+        if args.data_matrix_parsimony:
+            annotated_tree = run_array_parsimony(annotated_tree, array_dict, prop2type=prop2type)
 
-    if args.outdir:
-        base=os.path.splitext(os.path.basename(args.tree))[0]
-        out_newick = base + '_annotated.nw'
-        out_prop2tpye = base + '_prop2type.txt'
-        out_ete = base+'_annotated.ete'
-        out_tsv = base+'_annotated.tsv'
+    if args.sparse_matrix:
+        annotated_tree = run_sparse_annotate(annotated_tree, sparse_dict, prop2type=prop2type)
 
-        
-        ### output prop2type
-        with open(os.path.join(args.outdir, base+'_prop2type.txt'), "w") as f:
-            #f.write(first_line + "\n")
-            for key, value in prop2type.items():
-                f.write("{}\t{}\n".format(key, value.__name__))
+    # put the annotated clade back to the whole tree
+    if full_tree is not None and not args.target_clade_only:
+        clade_parent.children.insert(clade_index, annotated_tree)
+        annotated_tree.up = clade_parent
+        annotated_tree = full_tree
 
-        ### out ete
-        with open(os.path.join(args.outdir, base+'_annotated.ete'), 'w') as f:
-            f.write(ete_format.dumps(annotated_tree, encoder='pickle', pack=False))
-
-        ### out tsv
-        prop_keys = list(prop2type.keys())
-        if args.taxon_column:
-            prop_keys.extend(list(TAXONOMICDICT.keys()))
-        if args.annotated_tree:
-            tree2table(annotated_tree, internal_node=True, props=None, outfile=os.path.join(args.outdir, out_tsv))
-        else:
-            tree2table(annotated_tree, internal_node=True, props=prop_keys, outfile=os.path.join(args.outdir, out_tsv))
-
-        ### out newick
-        ## need to correct wrong symbols in the newick tree, such as ',' -> '||'
-        # Find all keys where the value is of type list
-
-        list_keys = [key for key, value in prop2type.items() if value == list]
-        # Replace all commas in the tree with '||'
-        list_sep = '||'
-        if args.data_matrix and args.num_stat != 'none':
-            for node in annotated_tree.traverse():
-                for key in list_keys:
-                    if node.props.get(key):
-                        cont2str = list(map(str, node.props.get(key)))
-                        list2str = list_sep.join(cont2str)
-                        node.add_prop(key, list2str)
-        else:
-            for node in annotated_tree.leaves():
-                for key in list_keys:
-                    if node.props.get(key):
-                        cont2str = list(map(str, node.props.get(key)))
-                        list2str = list_sep.join(cont2str)
-                        node.add_prop(key, list2str)
-
-                    
-        avail_props = list(prop2type.keys())
-
-        #del avail_props[avail_props.index('name')]
-        del avail_props[avail_props.index('dist')]
-        
-        if args.internal == 'name':
-            del avail_props[avail_props.index('name')]
-        
-        if 'support' in avail_props:
-            del avail_props[avail_props.index('support')]
-        
-        annotated_tree.write(outfile=os.path.join(args.outdir, out_newick), props=avail_props, 
-                    parser=utils.get_internal_parser(args.internal), format_root_node=True)
+    if args.outdir:
+        base=os.path.splitext(os.path.basename(args.tree))[0]
+        write_annotated_tree(annotated_tree, prop2type, base, args)
     
     if args.stdout:
         avail_props = list(prop2type.keys())
@@ -1008,13 +1263,356 @@ def run(args):
         del avail_props[avail_props.index('dist')]
         if 'support' in avail_props:
             del avail_props[avail_props.index('support')]
-        print(annotated_tree.write(props=avail_props, parser=utils.get_internal_parser(args.internal), 
-        format_root_node=True))
+        utils.dump_newick(annotated_tree, sys.stdout, props=avail_props,
+            parser=utils.get_internal_parser(args.internal), format_root_node=True)
 
     # if args.outtsv:
     #     tree2table(annotated_tree, internal_node=True, outfile=args.outtsv)
     return
 
+def write_annotated_tree(annotated_tree, prop2type, base, args):
+    """
+    Write the annotated tree outputs of annotate to args.outdir, named after base.
+    """
+    out_newick = base + '_annotated.nw'
+    out_prop2tpye = base + '_prop2type.txt'
+    out_ete = base+'_annotated.ete'
+    out_tsv = base+'_annotated.'+args.table_format
+
+    
+    ### output prop2type
+    with open(os.path.join(args.outdir, base+'_prop2type.txt'), "w") as f:
+        #f.write(first_line + "\n")
+        for key, value in prop2type.items():
+            f.write("{}\t{}\n".format(key, value.__name__))
+
+    ### out ete
+    if args.ete_version == 2:
+        with open(os.path.join(args.outdir, base+'_annotated.ete'), 'wb') as f:
+            f.write(ete_format.dumps_columnar(annotated_tree))
+    elif args.ete_compression != 'none':
+        with open(os.path.join(args.outdir, base+'_annotated.ete'), 'wb') as f:
+            ete_format.dump(annotated_tree, f, encoder='pickle',
+                compression=args.ete_compression, level=args.ete_compression_level)
+    else:
+        with open(os.path.join(args.outdir, base+'_annotated.ete'), 'w') as f:
+            ete_format.dump(annotated_tree, f, encoder='pickle')
+
+    ### out tsv
+    prop_keys = list(prop2type.keys())
+    if args.taxon_column:
+        prop_keys.extend(list(TAXONOMICDICT.keys()))
+    if args.annotated_tree:
+        tree2table(annotated_tree, internal_node=True, props=None, outfile=os.path.join(args.outdir, out_tsv),
+            table_format=args.table_format)
+    else:
+        tree2table(annotated_tree, internal_node=True, props=prop_keys, outfile=os.path.join(args.outdir, out_tsv),
+            table_format=args.table_format)
+
+    ### out newick
+    ## list props are written joined by '||', as ',' is not allowed in newick
+    avail_props = list(prop2type.keys())
+
+    #del avail_props[avail_props.index('name')]
+    del avail_props[avail_props.index('dist')]
+    
+    if args.internal == 'name':
+        del avail_props[avail_props.index('name')]
+    
+    if 'support' in avail_props:
+        del avail_props[avail_props.index('support')]
+    
+    with open(os.path.join(args.outdir, out_newick), 'w') as f:
+        utils.dump_newick(annotated_tree, f, props=avail_props,
+            parser=utils.get_internal_parser(args.internal), format_root_node=True)
+
+def iter_forest(tree_path):
+    """
+    Yield (name, tree_file, newick) of each tree of a forest given as a
+    directory, a glob pattern or a multi-newick file. newick is None for trees
+    which are read from their own file.
+    """
+    if os.path.isdir(tree_path):
+        tree_files = [os.path.join(tree_path, f) for f in sorted(os.listdir(tree_path))]
+    elif not os.path.exists(tree_path) and glob.has_magic(tree_path):
+        tree_files = sorted(glob.glob(tree_path))
+    else:
+        tree_files = None
+
+    if tree_files is not None:
+        for tree_file in tree_files:
+            if not os.path.isfile(tree_file) or tree_file.endswith(utils.TREE_CACHE_SUFFIX):
+                continue
+            yield os.path.splitext(os.path.basename(tree_file))[0], tree_file, None
+        return
+
+    base = os.path.splitext(os.path.basename(tree_path))[0]
+    with open(tree_path) as f:
+        for i, newick in enumerate(split_newicks(f), 1):
+            yield f'{base}_{i}', tree_path, newick
+
+def split_newicks(lines):
+    """
+    Yield the newick strings of a multi-newick stream, which are ended by ';'
+    outside of quoted names and [] comments.
+    """
+    chunk = []
+    quote = None
+    comment = False
+    for line in lines:
+        start = 0
+        for i, c in enumerate(line):
+            if quote:
+                if c == quote:
+                    quote = None
+            elif comment:
+                if c == ']':
+                    comment = False
+            elif c in '\'"':
+                quote = c
+            elif c == '[':
+                comment = True
+            elif c == ';':
+                chunk.append(line[start:i+1])
+                newick = ''.join(chunk).strip()
+                chunk = []
+                start = i + 1
+                if newick != ';':
+                    yield newick
+        chunk.append(line[start:])
+    if ''.join(chunk).strip():
+        raise NewickError('last tree of the multi-newick file does not end with ";"')
+
+# data shared by the processes of forest mode
+FOREST_SHARED = {}
+
+def init_forest_worker(shared):
+    FOREST_SHARED.update(shared)
+    # each process works on a single tree at a time
+    logger.setLevel(logging.CRITICAL)
+
+def annotate_forest_tree(item):
+    """
+    Annotate one tree of a forest with the shared metadata and write its
+    outputs. Return (name, status, seconds, error, newick).
+    """
+    name, tree_file, newick = item
+    args = FOREST_SHARED['args']
+    start = time.time()
+    try:
+        if newick is None:
+            tree, _ = utils.validate_tree(tree_file, args.input_type, args.internal, cache=args.tree_cache)
+        else:
+            tree = utils.ete4_parse(newick, internal_parser=args.internal)
+
+        prop2type = {}
+        for path, node in tree.iter_prepostorder():
+            prop2type.update(utils.get_prop2type(node))
+        for prop in ['name', 'dist', '__id', 'support']:
+            prop2type.pop(prop, None)
+
+        if args.resolve_polytomy:
+            tree.resolve_polytomy()
+        if args.midgroup:
+            tree.set_outgroup(tree.get_midpoint_outgroup())
+
+        # restrict the shared metadata to the nodes of this tree, in traversal order
+        shared_metadata = FOREST_SHARED['metadata_dict']
+        metadata_dict = {}
+        for node in tree.traverse():
+            if node.name in shared_metadata:
+                metadata_dict[node.name] = shared_metadata[node.name]
+        node_names = set(metadata_dict)
+        prop2type.update(FOREST_SHARED['prop2type'])
+
+        # the lists of properties are extended by run_tree_annotate, the values 
+        # of each column are those of the rows of this tree
+        metadata_options = {k: v.copy() if isinstance(v, (list, dict)) else v
+            for k, v in FOREST_SHARED['metadata_options'].items()}
+        metadata_options['columns'] = get_columns(metadata_dict, metadata_options['node_props'])
+        annotated_tree, prop2type = run_tree_annotate(tree,
+            metadata_dict=metadata_dict, prop2type=prop2type, **metadata_options,
+            threads=1, outdir=None, update_taxadb=False)
+
+        array_dict = FOREST_SHARED['array_dict']
+        if array_dict:
+            annotated_tree = run_array_annotate(annotated_tree, array_dict, num_stat=args.num_stat,
+                column2method=metadata_options['column2method'], prop2type=prop2type)
+            for filename in array_dict.keys():
+                prop2type[filename] = list
+
+        sparse_dict = FOREST_SHARED['sparse_dict']
+        if sparse_dict:
+            tree_sparse_dict = {filename: {n: rows[n] for n in node_names if n in rows}
+                for filename, rows in sparse_dict.items()}
+            annotated_tree = run_sparse_annotate(annotated_tree, tree_sparse_dict, prop2type=prop2type)
+
+        if args.outdir:
+            write_annotated_tree(annotated_tree, prop2type, name, args)
+
+        out_newick = None
+        if args.stdout:
+            avail_props = [p for p in prop2type if p not in ('dist', 'support')]
+            out_newick = utils.dumps_newick(annotated_tree, props=avail_props,
+                parser=utils.get_internal_parser(args.internal), format_root_node=True)
+        return name, 'ok', time.time() - start, '', out_newick
+    except (Exception, SystemExit) as e:
+        error = ' '.join(str(e).split()) or type(e).__name__
+        return name, 'failed', time.time() - start, error, None
+
+def get_columns(metadata_dict, node_props):
+    """
+    Values of each property in the metadata rows, as the columns of parse_csv.
+    """
+    columns = {prop: [] for prop in node_props}
+    for row in metadata_dict.values():
+        for prop, value in row.items():
+            if prop in columns:
+                if isinstance(value, list):
+                    columns[prop].extend(value)
+                else:
+                    columns[prop].append(value)
+    return columns
+
+def run_forest(args):
+    """
+    Annotate every tree of the forest in args.tree. Shared inputs are parsed
+    once, trees are annotated in a pool of args.threads processes and a
+    report line is written as each tree is done.
+    """
+    if args.plan or args.target_clade:
+        logger.error("--plan and --target-clade can not be used with --forest.")
+        sys.exit(1)
+    if args.quiet:
+        logger.setLevel(logging.CRITICAL)
+
+    if not os.path.exists(args.tree) and not glob.has_magic(args.tree):
+        logger.error(f"Input forest {args.tree} does not exist.")
+        sys.exit(1)
+
+    start = time.time()
+    metadata_dict, node_props, columns, prop2type = {}, [], {}, {}
+    if args.metadata:
+        metadata_dict, node_props, columns, prop2type = parse_csv(args.metadata, delimiter=args.metadata_sep,
+            no_headers=args.no_headers, duplicate=args.duplicate, target_nodes=None,
+            include_props=args.metadata_columns)
+    emapper_mode = False
+    if args.emapper_annotations:
+        emapper_mode = True
+        emapper_metadata_dict, emapper_node_props, emapper_columns = parse_emapper_annotations(args.emapper_annotations)
+        metadata_dict = utils.merge_dictionaries(metadata_dict, emapper_metadata_dict)
+        node_props.extend(emapper_node_props)
+        columns.update(emapper_columns)
+    array_dict = parse_tsv_to_array(args.data_matrix, delimiter=args.metadata_sep) if args.data_matrix else {}
+    sparse_dict = {}
+    if args.sparse_matrix:
+        sparse_dict = parse_sparse_matrix(args.sparse_matrix, delimiter=args.metadata_sep)
+    logger.info(f'Time for parsing shared inputs: {time.time() - start}')
+
+    if args.taxon_column:
+        load_taxonomy_database(args.taxadb, gtdb_version=args.gtdb_version, taxa_dump=args.taxa_dump)
+
+    metadata_options = {
+        "input_annotated_tree": args.annotated_tree,
+        "node_props": list(dict.fromkeys(node_props + list(columns))),
+        "text_prop": args.text_prop,
+        "text_prop_idx": args.text_prop_idx,
+        "multiple_text_prop": args.multiple_text_prop,
+        "num_prop": args.num_prop,
+        "num_prop_idx": args.num_prop_idx,
+        "bool_prop": args.bool_prop,
+        "bool_prop_idx": args.bool_prop_idx,
+        "prop2type_file": args.prop2type,
+        "counter_stat": args.counter_stat,
+        "num_stat": args.num_stat,
+        "column2method": process_column_summary_methods(args.column_summary_method) if args.column_summary_method else {},
+        "alignment": args.alignment,
+        "consensus_cutoff": args.consensus_cutoff,
+        "taxadb": args.taxadb,
+        "taxon_column": args.taxon_column,
+        "taxon_delimiter": args.taxon_delimiter,
+        "taxa_field": args.taxa_field,
+        "ignore_unclassified": args.ignore_unclassified,
+        "sos_thr": args.sos_thr,
+        "acr_discrete_columns": args.acr_discrete_columns,
+        "acr_continuous_columns": args.acr_continuous_columns,
+        "prediction_method": args.prediction_method,
+        "model": args.model,
+        "delta_stats": args.delta_stats,
+        "ent_type": args.ent_type,
+        "iteration": args.iteration,
+        "lambda0": args.lambda0,
+        "se": args.se,
+        "thin": args.thin,
+        "burn": args.burn,
+        "delta_chains": args.delta_chains,
+        "delta_target_ess": args.delta_target_ess,
+        "delta_max_rhat": args.delta_max_rhat,
+        "delta_permutations": args.delta_permutations,
+        "delta_pval_alpha": args.delta_pval_alpha,
+        "delta_per_clade": args.delta_per_clade,
+        "delta_min_clade_size": args.delta_min_clade_size,
+        "delta_fixed_parameters": args.delta_fixed_parameters,
+        "lambda_stats": args.lambda_stats,
+        "k_stats": args.k_stats,
+        "signal_permutations": args.signal_permutations,
+        "signal_seed": args.signal_seed,
+        "ls_columns": args.ls_columns,
+        "prec_cutoff": args.prec_cutoff,
+        "sens_cutoff": args.sens_cutoff,
+        "emapper_mode": emapper_mode,
+        "emapper_pfam": args.emapper_pfam,
+        "emapper_smart": args.emapper_smart,
+        "rank_limit": args.rank_limit,
+        "pruned_by": args.pruned_by,
+    }
+    shared = {
+        "args": args,
+        "metadata_dict": metadata_dict,
+        "prop2type": prop2type,
+        "metadata_options": metadata_options,
+        "array_dict": array_dict,
+        "sparse_dict": sparse_dict,
+    }
+
+    threads = args.threads if args.threads > 0 else os.cpu_count()
+    report = None
+    if args.outdir:
+        report = open(os.path.join(args.outdir, 'forest_report.tsv'), 'w')
+        report.write('#tree\tstatus\tseconds\terror\n')
+
+    n_ok = n_failed = 0
+    trees = iter_forest(args.tree)
+    try:
+        if threads > 1:
+            pool = Pool(threads, initializer=init_forest_worker, initargs=(shared,))
+            results = pool.imap_unordered(annotate_forest_tree, trees, chunksize=max(args.forest_chunksize, 1))
+        else:
+            pool = None
+            FOREST_SHARED.update(shared)
+            results = map(annotate_forest_tree, trees)
+
+        for name, status, seconds, error, out_newick in results:
+            if status == 'ok':
+                n_ok += 1
+            else:
+                n_failed += 1
+                logger.warning(f'Failed to annotate tree {name}: {error}')
+            if report:
+                report.write(f'{name}\t{status}\t{seconds:.3f}\t{error}\n')
+                report.flush()
+            if out_newick is not None:
+                sys.stdout.write(out_newick + '\n')
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if report:
+            report.close()
+
+    logger.info(f'Annotated {n_ok} trees, {n_failed} failed, in {time.time() - start:.1f}s')
+    return
+
 def check_missing(input_string):
     """
     define missing:
@@ -1042,10 +1640,80 @@ def check_tar_gz(file_path):
 
 
 
-def parse_csv(input_files, delimiter='\t', no_headers=False, duplicate=False, target_nodes=set()):
+# magic bytes of parquet, arrow ipc (feather v2) and feather v1 files
+ARROW_MAGICS = [b'PAR1', b'ARROW1', b'FEA1']
+
+def check_arrow(file_path):
+    with open(file_path, 'rb') as f:
+        head = f.read(6)
+    return any(head.startswith(magic) for magic in ARROW_MAGICS)
+
+def read_arrow_metadata(input_file, include_props=None, target_nodes=None):
+    """
+    Read a parquet or arrow/feather metadata table, keeping only the columns
+    in include_props and the rows of target_nodes. The first column holds
+    the node names.
+
+    Returns:
+    - pyarrow Table
+    """
+    if pa is None:
+        raise Exception(f"Reading metadata {input_file} requires the pyarrow package")
+    import pyarrow.compute as pc
+    with open(input_file, 'rb') as f:
+        is_parquet = f.read(4) == b'PAR1'
+    if is_parquet:
+        import pyarrow.parquet as pq
+        names = pq.read_schema(input_file).names
+        columns = [names[0]] + [name for name in names[1:] if include_props is None or name in include_props]
+        table = pq.read_table(input_file, columns=columns)
+    else:
+        # memory mapped, unselected columns are never read
+        import pyarrow.feather as feather
+        table = feather.read_table(input_file, memory_map=True)
+        names = table.column_names
+        columns = [names[0]] + [name for name in names[1:] if include_props is None or name in include_props]
+        table = table.select(columns)
+
+    node_header = names[0]
+
+    if target_nodes:
+        node_column = table[node_header]
+        if not pa.types.is_string(node_column.type):
+            node_column = pc.cast(node_column, pa.string())
+        table = table.filter(pc.is_in(node_column, value_set=pa.array(list(target_nodes), pa.string())))
+    return table
+
+def arrow_column_to_values(column):
+    """
+    Convert an arrow column to the python values of parse_csv, with the
+    datatype given by the arrow type. Missing values are None.
+
+    Returns:
+    - list of values, datatype
+    """
+    ctype = column.type
+    if pa.types.is_integer(ctype) or pa.types.is_floating(ctype) or pa.types.is_decimal(ctype):
+        values = [None if v is None or math.isnan(v) else v
+            for v in column.cast(pa.float64()).to_pylist()]
+        return values, float
+    elif pa.types.is_boolean(ctype):
+        # boolean values are summarized as text
+        return [None if v is None else str(v) for v in column.to_pylist()], bool
+    elif pa.types.is_list(ctype) or pa.types.is_large_list(ctype):
+        values = [None if not v else ','.join(str(x) for x in v) for v in column.to_pylist()]
+        return values, list
+    else:
+        if not pa.types.is_string(ctype):
+            column = column.cast(pa.string())
+        values = [None if check_missing(v) else v for v in column.to_pylist()]
+        return values, str
+
+def parse_csv(input_files, delimiter='\t', no_headers=False, duplicate=False, target_nodes=set(), include_props=None):
     """
     Parses metadata and filters nodes based on `target_nodes`.
-    Handles metadata with varying fields efficiently.
+    Handles metadata with varying fields efficiently. Parquet and arrow/feather
+    files are read with their column types when pyarrow is installed.
     
     Returns:
     - metadata: dict {nodename: {property: value(s)}}
@@ -1074,7 +1742,8 @@ def parse_csv(input_files, delimiter='\t', no_headers=False, duplicate=False, ta
                 continue  
 
             # Remove missing values
-            row = {k: v for k, v in row.items() if not check_missing(v)}
+            row = {k: v for k, v in row.items() if not check_missing(v)
+                and (include_props is None or k in include_props)}
 
             if nodename not in metadata:
                 metadata[nodename] = defaultdict(list) if duplicate else {}
@@ -1088,13 +1757,36 @@ def parse_csv(input_files, delimiter='\t', no_headers=False, duplicate=False, ta
             
     def update_prop2type(node_props):
         for prop in node_props:
+            if include_props is not None and prop not in include_props:
+                continue
             if set(columns[prop]) == {'NaN'}:
                 prop2type[prop] = str
             else:
                 prop2type[prop] = infer_dtype(columns[prop])
 
+    def update_arrow_metadata(table):
+        node_header = table.column_names[0]
+        node_names = table[node_header].cast(pa.string()).to_pylist()
+        for prop in table.column_names[1:]:
+            values, dtype = arrow_column_to_values(table[prop])
+            prop2type[prop] = dtype if any(v is not None for v in values) else str
+            for nodename, value in zip(node_names, values):
+                if value is None or nodename is None or nodename.startswith('##'):
+                    continue
+                if nodename not in metadata:
+                    metadata[nodename] = defaultdict(list) if duplicate else {}
+                if duplicate:
+                    metadata[nodename][prop].append(str(value))
+                else:
+                    metadata[nodename][prop] = value
+                columns[prop].append(value)
+
     for input_file in input_files:
-        if check_tar_gz(input_file):
+        if check_arrow(input_file):
+            table = read_arrow_metadata(input_file, include_props=include_props, target_nodes=target_nodes)
+            update_arrow_metadata(table)
+
+        elif check_tar_gz(input_file):
             with tarfile.open(input_file, 'r:gz') as tar:
                 for member in tar.getmembers():
                     if member.isfile() and member.name.endswith('.tsv'):
@@ -1179,6 +1871,65 @@ def parse_tsv_to_array(input_files, delimiter='\t', no_headers=True):
         matrix2array[prefix] = leaf2array        
     return matrix2array
 
+def parse_sparse_matrix(input_files, delimiter='\t', target_nodes=None):
+    """
+    Parses sparse matrices into a dictionary with the row names as keys and
+    a dict of the nonzero columns of each row as values, keeping only rows in
+    target_nodes if given. Supported formats:
+    - MatrixMarket .mtx, with one row name per line in <file>.rows and one
+      column name per line in <file>.cols (column indexes if missing)
+    - scipy sparse .npz (save_npz) with row_names and col_names arrays added
+    - text triples of row name, column name and optional value (1 if missing)
+
+    :return: A dictionary with filenames as keys and {row name: {column: value}} as values.
+    """
+    matrix2rows = {}
+    for input_file in input_files:
+        prefix = os.path.basename(input_file)
+        if input_file.endswith('.mtx') or input_file.endswith('.npz'):
+            if input_file.endswith('.mtx'):
+                matrix = sparse.csr_matrix(scipy_io.mmread(input_file))
+                row_names = read_names(input_file + '.rows')
+                if row_names is None:
+                    raise Exception(f"Row names of {input_file} not found in {input_file}.rows")
+                col_names = read_names(input_file + '.cols') or [f'col{i}' for i in range(matrix.shape[1])]
+            else:
+                matrix = sparse.csr_matrix(sparse.load_npz(input_file))
+                with np.load(input_file, allow_pickle=False) as npz:
+                    row_names = npz['row_names'].astype(str).tolist()
+                    col_names = npz['col_names'].astype(str).tolist()
+            matrix.eliminate_zeros()
+            col_names = np.array(col_names, dtype=object)
+            indptr, indices, data = matrix.indptr, matrix.indices, matrix.data
+            rows = {}
+            for i, name in enumerate(row_names):
+                if target_nodes and name not in target_nodes:
+                    continue
+                start, end = indptr[i], indptr[i+1]
+                if start < end:
+                    rows[name] = dict(zip(col_names[indices[start:end]].tolist(), data[start:end].tolist()))
+        else:
+            rows = defaultdict(dict)
+            with open(input_file, 'r') as f:
+                for line in f:
+                    if line.startswith('#') or not line.strip():
+                        continue
+                    fields = line.rstrip('\n').split(delimiter)
+                    if target_nodes and fields[0] not in target_nodes:
+                        continue
+                    value = float(fields[2]) if len(fields) > 2 and fields[2] != '' else 1
+                    if value:
+                        rows[fields[0]][fields[1]] = value
+            rows = dict(rows)
+        matrix2rows[prefix] = rows
+    return matrix2rows
+
+def read_names(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        return [line.rstrip('\n') for line in f]
+
 def process_column_summary_methods(column_summary_methods):
     column_methods = {}
     if column_summary_methods:
@@ -1638,6 +2389,52 @@ def get_gtdbtaxadump(version):
         f.write(requests.get(url).content)
     return fname
 
+def load_taxonomy_database(taxadb, gtdb_version=None, taxa_dump=None):
+    """
+    Build the local taxonomy database of taxadb from the given GTDB version or
+    dump file, before annotating trees with it.
+    """
+    if taxadb == 'GTDB':
+        if gtdb_version and taxa_dump:
+            logger.error('Please specify either GTDB version or taxa dump file, not both.')
+            sys.exit(1)
+        if gtdb_version:
+            # get taxadump from ete-data
+            gtdbtaxadump = get_gtdbtaxadump(gtdb_version)
+            logger.info(f"Loading GTDB database dump file {gtdbtaxadump}...")
+            GTDBTaxa().update_taxonomy_database(gtdbtaxadump)
+        elif taxa_dump:
+            logger.info(f"Loading GTDB database dump file {taxa_dump}...")
+            GTDBTaxa().update_taxonomy_database(taxa_dump)
+        else:
+            logger.info("No specific version or dump file provided; using latest GTDB data...")
+            GTDBTaxa().update_taxonomy_database()
+    elif taxadb == 'MOTUS':
+        if gtdb_version and taxa_dump:
+            logger.error('Please specify either GTDB version or taxa dump file, not both.')
+            sys.exit(1)
+        if taxa_dump:
+            logger.info(f"Loading GTDB database dump file {taxa_dump}...")
+            GTDBTaxa().update_taxonomy_database(taxa_dump)
+        else:
+            logger.info("No specific version or dump file provided; using latest GTDB data...")
+            motus_dump = download_motus_dump()
+            GTDBTaxa().update_taxonomy_database(motus_dump)
+    elif taxadb == 'NCBI':
+        if taxa_dump:
+            logger.info(f"Loading NCBI database dump file {taxa_dump}...")
+            NCBITaxa().update_taxonomy_database(taxa_dump)
+        # else:
+        #     NCBITaxa().update_taxonomy_database()
+
+# taxonomy database handles, opened once per process
+TAXA_DB_CACHE = {}
+
+def get_taxa_db(db):
+    if db not in TAXA_DB_CACHE:
+        TAXA_DB_CACHE[db] = NCBITaxa() if db == "NCBI" else GTDBTaxa()
+    return TAXA_DB_CACHE[db]
+
 def annotate_taxa(tree, db="GTDB", taxid_attr="name", sp_delimiter='.', sp_field=0, ignore_unclassified=False):
     global rank2values
     logger.info(f"\n==============Annotating tree with {db} taxonomic database============")
@@ -1677,7 +2474,7 @@ def annotate_taxa(tree, db="GTDB", taxid_attr="name", sp_delimiter='.', sp_field
 
 
     if db == "GTDB" or "MOTUS":
-        gtdb = GTDBTaxa()
+        gtdb = get_taxa_db("GTDB")
         tree.set_species_naming_function(return_spcode_gtdb)
         gtdb.annotate_tree(tree,  taxid_attr="species", ignore_unclassified=ignore_unclassified)
         suffix_to_rank_dict = {
@@ -1705,7 +2502,7 @@ def annotate_taxa(tree, db="GTDB", taxid_attr="name", sp_delimiter='.', sp_field
                 n.add_prop("lca", utils.dict_to_string(lca_dict))
 
     if db == "NCBI":
-        ncbi = NCBITaxa()
+        ncbi = get_taxa_db("NCBI")
         # extract sp codes from leaf names
         tree.set_species_naming_function(return_spcode_ncbi)
         ncbi.annotate_tree(tree, taxid_attr="species", ignore_unclassified=ignore_unclassified)
@@ -2002,62 +2799,157 @@ def parse_fasta(fastafile):
     fasta_dict[head] = seq
     return fasta_dict
 
-def _worker_function(iteration_data):
+# topology and traits shared by the processes of delta p-value permutations
+PVAL_SHARED = {}
 
-    import hashlib
-    # Derive a unique seed per worker using time or iteration data
-    unique_string = str(iteration_data) + str(time.time())
-    seed = int(hashlib.sha256(unique_string.encode()).hexdigest(), 16) % (2**32)
-    np.random.seed(seed)
-    
-    # Unpack the necessary data for one iteration
-    prop2array, dump_tree, acr_discrete_columns_dict, prediction_method, model, ent_type, lambda0, se, sim, burn, thin, threads = iteration_data
+def init_pval_worker(dump_tree, prop2array, acr_discrete_columns_dict, options):
+    """
+    Keep the topology and traits in the process, and resolve once the tree
+    nodes each trait value is loaded to.
+    """
+    name2node = defaultdict(list)
+    for node in dump_tree.traverse():
+        if node.name:
+            name2node[node.name].append(node)
 
-    shuffled_dict = {}
-    for column, trait in acr_discrete_columns_dict.items():
-        # Shuffle traits
-        shuffled_trait = np.random.choice(trait, len(trait), replace=False)
-        prop2array[column][1] = list(shuffled_trait)
-        shuffled_dict[column] = list(shuffled_trait)
+    column2nodes = {}
+    for column in acr_discrete_columns_dict:
+        target_nodes = []
+        for name in prop2array[column][0]:
+            if name in name2node:
+                target_nodes.append(name2node[name])
+            elif '||' in name:
+                target_nodes.append([dump_tree.common_ancestor(name.split('||'))])
+            else:
+                target_nodes.append([])
+        column2nodes[column] = target_nodes
+
+    PVAL_SHARED.clear()
+    PVAL_SHARED.update({
+        'tree': dump_tree,
+        'column2nodes': column2nodes,
+        'column2trait': {c: np.asarray(t, dtype=object) for c, t in acr_discrete_columns_dict.items()},
+        'options': options,
+    })
+    if options.get('prop2params'):
+        PVAL_SHARED['arrays'] = TreeArrays(dump_tree)
+
+def _worker_function(seed):
+    """
+    Run ACR and delta on the shared tree with the traits permuted by seed.
+    """
+    tree = PVAL_SHARED['tree']
+    options = PVAL_SHARED['options']
+    rng = np.random.RandomState(seed)
 
-    # Converting back to the original dictionary format
-    new_metadata_dict = convert_back_to_original(prop2array)
-    updated_tree = load_metadata_to_tree(dump_tree, new_metadata_dict)
+    shuffled_dict = {}
+    for column, trait in PVAL_SHARED['column2trait'].items():
+        # Shuffle traits and load them to their nodes
+        shuffled_trait = rng.permutation(trait).tolist()
+        for target_nodes, value in zip(PVAL_SHARED['column2nodes'][column], shuffled_trait):
+            for target_node in target_nodes:
+                target_node.add_prop(column, value)
+        shuffled_dict[column] = shuffled_trait
+
+    if options.get('prop2params'):
+        # marginal probabilities with the model parameters of the observed traits, 
+        # then delta as run_delta on the internal nodes
+        arrays = PVAL_SHARED['arrays']
+        random_delta = {}
+        for column, marginal_probs in fixed_marginals(arrays, options['prop2params']).items():
+            np.random.seed(42)
+            random_delta[column] = delta(marginal_probs[~arrays.is_leaf], options['lambda0'], options['se'], 
+                                         options['sim'], options['thin'], options['burn'], options['ent_type'], 1, 
+                                         chains=options['chains'], target_ess=options['target_ess'], 
+                                         max_rhat=options['max_rhat'])
+        return random_delta
 
     # Run ACR
-    random_acr_results, updated_tree = run_acr_discrete(updated_tree, shuffled_dict, 
-                                                        prediction_method=prediction_method, 
-                                                        model=model, threads=threads, outdir=None)
-    random_delta = run_delta(random_acr_results, updated_tree, ent_type=ent_type, 
-                             lambda0=lambda0, se=se, sim=sim, burn=burn, thin=thin, 
-                             threads=threads)
-
-    # Clear extra features from the tree
+    random_acr_results, updated_tree = run_acr_discrete(tree, shuffled_dict, 
+                                                        prediction_method=options['prediction_method'], 
+                                                        model=options['model'], threads=1, outdir=None)
+    random_delta = run_delta(random_acr_results, updated_tree, ent_type=options['ent_type'], 
+                             lambda0=options['lambda0'], se=options['se'], sim=options['sim'], 
+                             burn=options['burn'], thin=options['thin'], threads=1, 
+                             chains=options['chains'], target_ess=options['target_ess'], 
+                             max_rhat=options['max_rhat'])
+
+    # Clear extra features from the tree for the next iteration
     utils.clear_extra_features([updated_tree], ["name", "dist", "support"])
     return random_delta
     
+def pval_decided(exceed, n, alpha=0.05, confidence=0.95, exceed_limit=10):
+    """
+    Whether the permutation test can stop with exceed permuted statistics
+    above the observed one out of n: after exceed_limit exceedances
+    (Besag-Clifford), or once the Clopper-Pearson interval of the p_value
+    excludes alpha.
+    """
+    if exceed >= exceed_limit:
+        return True
+    tail = (1 - confidence) / 2
+    lower = stats.beta.ppf(tail, exceed, n - exceed + 1) if exceed > 0 else 0.0
+    upper = stats.beta.ppf(1 - tail, exceed + 1, n - exceed) if exceed < n else 1.0
+    return upper < alpha or lower > alpha
+
 def get_pval(prop2array, dump_tree, acr_discrete_columns_dict, iteration=100, 
              prediction_method="MPPA", model="F81", ent_type='SE', 
-             lambda0=0.1, se=0.5, sim=10000, burn=100, thin=10, threads=1):
+             lambda0=0.1, se=0.5, sim=10000, burn=100, thin=10, threads=1, 
+             chains=2, target_ess=0, max_rhat=1.01, 
+             prop2delta=None, pval_alpha=0.05, min_iteration=20, prop2params=None):
+    """
+    Delta statistics of up to iteration permutations of the traits. With the
+    observed prop2delta, permutations are stopped once the p_value of every
+    trait is decided against pval_alpha (see pval_decided), after at least
+    min_iteration permutations. With prop2params, the model parameters of the
+    observed traits (see model_parameters), the marginal probabilities of the
+    permuted traits are computed with them instead of a full ACR.
+    """
     prop2delta_array = {}
+    prop2exceed = defaultdict(int)
+
+    # the tree and traits are sent once to each process, iterations only get a seed
+    options = {
+        'prediction_method': prediction_method, 'model': model, 'ent_type': ent_type,
+        'lambda0': lambda0, 'se': se, 'sim': sim, 'burn': burn, 'thin': thin,
+        'chains': chains, 'target_ess': target_ess, 'max_rhat': max_rhat,
+        'prop2params': prop2params,
+    }
+    initargs = (dump_tree, prop2array, acr_discrete_columns_dict, options)
+    seeds = np.random.randint(0, 2**32, size=iteration, dtype=np.uint64).tolist()
+    sequential = prop2delta is not None and pval_alpha > 0
 
-    # Prepare data for each iteration
-    iteration_data = [(prop2array, dump_tree, acr_discrete_columns_dict, prediction_method, model, ent_type, lambda0, se, sim, burn, thin, threads) for _ in range(iteration)]
-
-    # Use multiprocessing pool
+    # results are consumed in the order of the seeds, so the test stops on the 
+    # same permutations whatever the threads, and the pool is terminated once decided
+    pool = None
     if threads > 1:
-        with Pool(threads) as pool:
-            results = pool.map(_worker_function, iteration_data)
+        pool = Pool(threads, initializer=init_pval_worker, initargs=initargs)
+        results = pool.imap(_worker_function, seeds)
     else:
-        results = map(_worker_function, iteration_data)
+        init_pval_worker(*initargs)
+        results = map(_worker_function, seeds)
 
-    # Aggregate results
-    for delta_result in results:
-        for prop, result in delta_result.items():
-            if prop in prop2delta_array:
-                prop2delta_array[prop].append(result)
-            else:
-                prop2delta_array[prop] = [result]
+    try:
+        for n, delta_result in enumerate(results, 1):
+            for prop, result in delta_result.items():
+                if prop in prop2delta_array:
+                    prop2delta_array[prop].append(result)
+                else:
+                    prop2delta_array[prop] = [result]
+                if sequential and result > prop2delta[prop]:
+                    prop2exceed[prop] += 1
+
+            if n % 10 == 0:
+                logger.info(f"Delta permutations: {n}/{iteration}")
+
+            if sequential and n >= min_iteration and n < iteration and \
+                all(pval_decided(prop2exceed[prop], n, alpha=pval_alpha) for prop in prop2delta_array):
+                logger.info(f"p_value of delta decided after {n} permutations")
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
     return prop2delta_array
 
@@ -2069,40 +2961,90 @@ def build_matrix_string(node, name2seq):
             matrix += f">{leaf.name}\n{name2seq.get(leaf.name)}\n"
     return matrix
 
-def tree2table(tree, internal_node=True, props=None, outfile='tree2table.csv'):
-    node2leaves = {}
-    leaf2annotations = {}
-    if not props:
-        props = set()
-        for node in tree.traverse():
-            props |= node.props.keys()
-        props = [ p for p in props if not p.startswith("_") ]
+def _table_cell(value):
+    if type(value) == list:
+        return '|'.join(str(v) for v in value)
+    elif type(value) == dict:
+        return '|'.join(f'{k}:{v}' for k, v in value.items())
+    return value
 
-    with open(outfile, 'w', newline='') as csvfile:
-        if '_speciesFunction' in props:
-            props.remove('_speciesFunction')
-        fieldnames = ['name', 'dist', 'support']
-        fieldnames.extend(x for x in sorted(props) if x not in fieldnames)
+def tree2columns(tree, internal_node=True, props=None):
+    """
+    Gather node properties into one column per property, in a single
+    traversal. Only named nodes are included, internal ones if internal_node.
 
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter='\t', extrasaction='ignore')
-        writer.writeheader()
-        for node in tree.traverse():
-            if node.name:
-                # if '_speciesFunction' in node.props:
-                #     node.del_prop('_speciesFunction')
-
-                if node.is_leaf:
-                    output_row = dict(node.props)
-                    for k, prop in output_row.items():
-                        if type(prop) == list:
-                            output_row[k] = '|'.join(str(v) for v in prop)
-                    writer.writerow(output_row)
-                else:
-                    if internal_node:
-                        output_row = dict(node.props)
-                        for k, prop in output_row.items():
-                            if type(prop) == list:
-                                output_row[k] = '|'.join(str(v) for v in prop)
-                        writer.writerow(output_row)
-                    else:
-                        pass
+    Returns:
+    - list of fieldnames, and dict of fieldname to list of values (None where missing)
+    """
+    nodes = [node for node in tree.traverse() if node.name and (node.is_leaf or internal_node)]
+    if props:
+        props = [p for p in props if p != '_speciesFunction']
+        prop2column = {prop: [node.props.get(prop) for node in nodes] for prop in set(props) | {'name', 'dist', 'support'}}
+    else:
+        # rows and values of each property, filled into full columns at the end
+        prop2rows = defaultdict(lambda: ([], []))
+        for i, node in enumerate(nodes):
+            for prop, value in node.props.items():
+                rows, values = prop2rows[prop]
+                rows.append(i)
+                values.append(value)
+        prop2column = {}
+        for prop, (rows, values) in prop2rows.items():
+            if len(rows) == len(nodes):
+                prop2column[prop] = values
+            else:
+                column = prop2column[prop] = [None] * len(nodes)
+                for i, value in zip(rows, values):
+                    column[i] = value
+        props = [p for p in prop2column if not p.startswith("_")]
+
+    fieldnames = ['name', 'dist', 'support']
+    fieldnames.extend(x for x in sorted(props) if x not in fieldnames)
+    return fieldnames, {field: prop2column.get(field, [None] * len(nodes)) for field in fieldnames}
+
+def tree2table(tree, internal_node=True, props=None, outfile='tree2table.csv', table_format='tsv', block_size=10000):
+    """
+    Write node properties of tree as a table, one row per named node. List
+    values are joined with '|' in tsv, parquet and feather keep them as lists
+    when their values share a type.
+
+    Parameters:
+    - table_format: 'tsv', or 'parquet' and 'feather' which require pyarrow
+    - block_size: number of tsv rows written at once
+    """
+    fieldnames, columns = tree2columns(tree, internal_node=internal_node, props=props)
+
+    if table_format in ['parquet', 'feather']:
+        write_arrow_table(fieldnames, columns, outfile, table_format)
+        return
+
+    with open(outfile, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter='\t')
+        writer.writerow(fieldnames)
+        n_rows = len(columns['name'])
+        for start in range(0, n_rows, block_size):
+            block = [[_table_cell(v) for v in columns[field][start:start+block_size]] for field in fieldnames]
+            writer.writerows(zip(*block))
+
+def write_arrow_table(fieldnames, columns, outfile, table_format='parquet'):
+    if pa is None:
+        raise Exception(f"{table_format} output requires the pyarrow package")
+    arrays = []
+    for field in fieldnames:
+        try:
+            if any(type(v) == dict for v in columns[field]):
+                # sparse columns, as maps instead of structs of every key
+                arrays.append(pa.array([None if v is None else list(v.items()) for v in columns[field]],
+                    type=pa.map_(pa.string(), pa.float64())))
+            else:
+                arrays.append(pa.array(columns[field]))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # mixed types are written as in tsv
+            arrays.append(pa.array([None if v is None else str(_table_cell(v)) for v in columns[field]]))
+    table = pa.Table.from_arrays(arrays, names=fieldnames)
+    if table_format == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, outfile)
+    else:
+        import pyarrow.feather as feather
+        feather.write_feather(table, outfile)
@@ -371,6 +371,54 @@ def poplulate_plot_args(plot_args_p):
 
 
 ### visualize tree
+# properties always shown in the tree view
+TAXONOMY_PROPS = ['rank', 'sci_name', 'taxid', 'lineage', 'named_lineage',
+    'evoltype', 'dup_sp', 'dup_percent', 'lca']
+
+# suffixes of properties summarized or inferred by annotate
+ANNOTATED_SUFFIXES = ['counter', 'avg', 'sum', 'max', 'min', 'std',
+    'delta', 'delta_rhat', 'delta_ess', 'pval', 'prec', 'sens', 'f1', 'ls_clade', 'prevalence',
+    'ci_lower', 'ci_upper', 'lambda', 'lambda_pval', 'K', 'K_pval']
+
+def get_include_props(args):
+    """
+    Get the properties used by the chosen layouts and queries, so that only
+    those are loaded from ete format trees.
+
+    Parameters:
+    - args: parsed plot arguments
+
+    Returns:
+    - list of properties, or None if they cannot be known before loading the tree
+    """
+    # emapper layouts and queries from files use properties not given in arguments
+    if args.emapper_layout:
+        return None
+    conditions = []
+    for condition_strings in [args.collapsed_by, args.highlighted_by, args.pruned_by]:
+        for condition in condition_strings or []:
+            if os.path.isfile(condition):
+                return None
+            conditions.extend(condition.replace('||', ',').split(','))
+
+    props = []
+    for key, value in vars(args).items():
+        if key.endswith('_layout') and isinstance(value, list):
+            props.extend(value)
+    props.extend(left_value for left_value, _, _ in utils.to_code(conditions))
+    if args.barplot_colorby:
+        props.append(args.barplot_colorby)
+
+    include_props = list(TAXONOMY_PROPS)
+    for prop in props:
+        include_props.append(prop)
+        include_props.extend(utils.add_suffix(prop, suffix) for suffix in ANNOTATED_SUFFIXES)
+    if args.alignment_layout:
+        include_props.append('alignment')
+    if args.domain_layout:
+        include_props.append('dom_arq')
+    return include_props
+
 def run(args):
     global prop2type, properties, tree
     node_props=[]
@@ -387,7 +435,8 @@ def run(args):
     import time
     start = time.time()
     try:
-        tree, eteformat_flag = utils.validate_tree(args.tree, args.input_type, args.internal)
+        tree, eteformat_flag = utils.validate_tree(args.tree, args.input_type, args.internal,
+            include_props=get_include_props(args), cache=args.tree_cache)
     except utils.TreeFormatError as e:
         print(e)
         sys.exit(1)
@@ -490,7 +539,7 @@ def run(args):
             visualized_props.extend(args.acr_discrete_layout)
 
             #delta statistic 
-            for suffix in ['delta', 'pval']:
+            for suffix in ['delta', 'delta_rhat', 'delta_ess', 'pval']:
                 visualized_props.extend([utils.add_suffix(prop, suffix) for prop in args.acr_discrete_layout])
            
         if layout == 'acr-continuous-layout':
@@ -2436,6 +2485,58 @@ def numerical2matrix(tree, profiling_props, count_negative=True, internal_num_re
 
     return node2matrix_single, minval_single, maxval_single, value2color_single, results_list, list_props, single_props, gradientscolor
 
+def get_sparse_columns(tree, prop):
+    """
+    Sorted columns of a sparse matrix prop, or None if prop is not sparse.
+    """
+    clade_sum = tree.props.get(utils.add_suffix(prop, 'sum'))
+    if isinstance(clade_sum, dict):
+        return sorted(clade_sum)
+    leaf_values = [leaf.props.get(prop) for leaf in tree.leaves()]
+    if any(isinstance(value, dict) for value in leaf_values):
+        return sorted(set(column for value in leaf_values if isinstance(value, dict) for column in value))
+    return None
+
+def sparse2row(node, prop, columns):
+    """
+    Presence of each column in a leaf, or prevalence in the clade of an
+    internal node, of a sparse matrix prop.
+    """
+    if node.is_leaf:
+        row = node.props.get(prop) or {}
+        return [1 if row.get(column) else 0 for column in columns]
+    prevalence = node.props.get(utils.add_suffix(prop, 'prevalence'))
+    if prevalence is None:
+        return []
+    return [prevalence.get(column, 0) for column in columns]
+
+def sparse2matrix(tree, prop, profiling_list=None):
+    """
+    Presence-absence profiling matrix of a sparse matrix prop, with the
+    prevalence of each column on internal nodes.
+
+    Output:
+    node2matrix, value2color, all columns
+    """
+    precence_color = '#E60A0A'  # red
+    absence_color = '#EBEBEB'   # grey
+    columns = profiling_list or get_sparse_columns(tree, prop) or []
+    node2matrix = {}
+    for node in tree.traverse():
+        row = sparse2row(node, prop, columns)
+        if row:
+            node2matrix[node.name] = row
+
+    ncolors = 40
+    gradientscolor = utils.build_custom_gradient(ncolors, min_color=absence_color, max_color=precence_color)
+    value2color = {1: gradientscolor[ncolors], 0: gradientscolor[1]}
+    index_values = np.linspace(0, 1, len(gradientscolor))
+    for search_value in set(utils.flatten(node2matrix.values())):
+        if search_value not in value2color:
+            index = np.abs(index_values - search_value).argmin() + 1
+            value2color[search_value] = gradientscolor[index]
+    return node2matrix, value2color, columns
+
 def binary2matrix(tree, profiling_props, color_config=None):
     """
     Input:
@@ -2453,10 +2554,20 @@ def binary2matrix(tree, profiling_props, color_config=None):
     all_props_wildcard = '*'
     value2color = {}
 
+    # sparse matrix props, drawn as one column per matrix column
+    prop2columns = {}
+    for profiling_prop in profiling_props:
+        sparse_columns = get_sparse_columns(tree, profiling_prop)
+        if sparse_columns is not None:
+            prop2columns[profiling_prop] = sparse_columns
+
     for node in tree.traverse():
         node2matrix[node.name] = []
         for profiling_prop in profiling_props:
-            if node.is_leaf:
+            if profiling_prop in prop2columns:
+                is_list = True
+                node2matrix[node.name].extend(sparse2row(node, profiling_prop, prop2columns[profiling_prop]))
+            elif node.is_leaf:
                 prop_value = node.props.get(profiling_prop)  
                 if prop_value is not None:  
                     if isinstance(prop_value, list):  # Check if the property value is a list
@@ -2617,6 +2728,8 @@ def multiple2matrix(tree, profiling_prop, prop2type=None, color_config=None, ete
 
     # Determine the data type of the profiling property
     data_type = prop2type.get(profiling_prop)
+    if data_type == dict:
+        return sparse2matrix(tree, profiling_prop, profiling_list=profiling_list)
     node2leaves = tree.get_cached_content()
     # Get all categorical values based on whether data_type is a list and eteformat_flag
 